@@ -0,0 +1,310 @@
+"""Benchmarks for the storage layer, the agent glue and the webhook pipeline.
+
+    python benchmarks/bench.py                         # quick run (10k and 100k line logs)
+    python benchmarks/bench.py --sizes 10000,1000000,10000000 --only memory_file
+    python benchmarks/bench.py compare benchmarks/results/OLD.json benchmarks/results/NEW.json
+
+Everything runs against synthetic data in a temporary directory, with the model and the
+DingTalk sender stubbed out, so the numbers measure this code only. Results are written
+as JSON (`--out`, default `benchmarks/results/<git commit>.json`); `compare` prints the
+relative change of every metric between two result files.
+
+Benchmarks:
+- memory_file: `get_user_memories` / `list_users` latency against log size
+- facts_file: `set_user_facts` cost against the number of users in the facts file
+- reminders: `memory.get_due_memories` + `bump_next_push` throughput
+- webhook: end-to-end requests/s and p50/p99 latency of ordinary messages
+- scheduler: `run_cycle` duration against the number of active users
+"""
+
+import argparse
+import atexit
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+WORKDIR = tempfile.mkdtemp(prefix="dingbot-bench-")
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+
+# point every store at the scratch directory before dingbot reads its settings
+os.environ.update({
+    "MEMORY_FILE": os.path.join(WORKDIR, "memory.jsonl"),
+    "FACTS_FILE": os.path.join(WORKDIR, "facts.json"),
+    "SUMMARY_FILE": os.path.join(WORKDIR, "summary.json"),
+    "ACTIVITY_FILE": os.path.join(WORKDIR, "activity.json"),
+    "DATABASE_PATH": os.path.join(WORKDIR, "memory.db"),
+    "OUTBOX_PATH": os.path.join(WORKDIR, "outbox.db"),
+    "DINGBOT_DISABLE_NETWORK": "1",
+    "OUTBOX_ENABLED": "0",
+    "SUMMARY_EVERY_N": "0",
+    "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+})
+os.environ.pop("GEMINI_API_KEY", None)
+sys.path.insert(0, ROOT)
+
+from dingbot import agent, facts_file, memory, memory_file, scheduler, sender  # noqa: E402
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    s = sorted(samples)
+    return {
+        "n": len(s),
+        "mean_ms": round(statistics.fmean(s) * 1000, 3),
+        "p50_ms": round(s[len(s) // 2] * 1000, 3),
+        "p99_ms": round(s[min(len(s) - 1, int(len(s) * 0.99))] * 1000, 3),
+        "max_ms": round(s[-1] * 1000, 3),
+    }
+
+
+def _time(fn: Callable[[], Any], repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _write_log(path: str, lines: int, users: int) -> None:
+    """Synthetic JSONL message log: `lines` messages spread over `users` users."""
+    rnd = random.Random(lines)
+    now = int(time.time()) - lines
+    with open(path, "w", encoding="utf-8") as f:
+        chunk = []
+        for i in range(lines):
+            uid = f"user{rnd.randrange(users)}"
+            chunk.append(json.dumps({"user_id": uid, "content": f"message {i} 我喜欢猫和咖啡", "timestamp": now + i},
+                                    ensure_ascii=False))
+            if len(chunk) >= 10000:
+                f.write("\n".join(chunk) + "\n")
+                chunk = []
+        if chunk:
+            f.write("\n".join(chunk) + "\n")
+
+
+def bench_memory_file(sizes: List[int], repeat: int) -> Dict[str, Any]:
+    out = {}
+    for n in sizes:
+        users = max(10, n // 100)
+        start = time.perf_counter()
+        _write_log(memory_file.MEMORY_FILE, n, users)
+        gen = time.perf_counter() - start
+        reps = max(1, repeat if n <= 100_000 else repeat // 10)
+        out[str(n)] = {
+            "users": users,
+            "generate_seconds": round(gen, 3),
+            "get_user_memories": _summary(_time(lambda: memory_file.get_user_memories("user1", limit=20), reps)),
+            "list_users": _summary(_time(memory_file.list_users, reps)),
+        }
+        print(f"  memory_file {n} lines: get_user_memories p50 {out[str(n)]['get_user_memories']['p50_ms']}ms, "
+              f"list_users p50 {out[str(n)]['list_users']['p50_ms']}ms", file=sys.stderr)
+    os.remove(memory_file.MEMORY_FILE)
+    return out
+
+
+def bench_facts_file(user_counts: List[int], repeat: int) -> Dict[str, Any]:
+    out = {}
+    facts = [{"fact": "喜欢猫"}, {"fact": "在北京工作"}, {"fact": "每天喝咖啡"}]
+    for n in user_counts:
+        with open(facts_file.FACTS_FILE, "w", encoding="utf-8") as f:
+            json.dump({f"user{i}": facts for i in range(n)}, f, ensure_ascii=False)
+        out[str(n)] = {"set_user_facts": _summary(_time(lambda: facts_file.set_user_facts("user1", facts), repeat))}
+        print(f"  facts_file {n} users: set_user_facts p50 {out[str(n)]['set_user_facts']['p50_ms']}ms", file=sys.stderr)
+    os.remove(facts_file.FACTS_FILE)
+    return out
+
+
+def bench_reminders(counts: List[int], repeat: int) -> Dict[str, Any]:
+    out = {}
+    for n in counts:
+        if os.path.exists(memory.DB_PATH):
+            os.remove(memory.DB_PATH)
+        memory.init_db()
+        conn = memory._get_conn()
+        now = int(time.time())
+        # half of the reminders are due
+        conn.executemany(
+            "INSERT INTO memories (user_id, content, interval, next_push, created_at) VALUES (?,?,?,?,?)",
+            [(f"user{i % 1000}", f"reminder {i}", 3600, now - 1 if i % 2 else now + 3600, now) for i in range(n)],
+        )
+        conn.commit()
+        conn.close()
+        query = _time(memory.get_due_memories, repeat)
+        due = memory.get_due_memories()
+        start = time.perf_counter()
+        for row in due:
+            memory.bump_next_push(row["id"])
+        bump = time.perf_counter() - start
+        out[str(n)] = {
+            "get_due_memories": _summary(query),
+            "due": len(due),
+            "bump_per_second": round(len(due) / max(bump, 1e-9), 1),
+        }
+        print(f"  reminders {n}: get_due p50 {out[str(n)]['get_due_memories']['p50_ms']}ms, "
+              f"bump {out[str(n)]['bump_per_second']}/s", file=sys.stderr)
+    return out
+
+
+def bench_webhook(requests: int, concurrency: int) -> Dict[str, Any]:
+    from dingbot import server
+
+    agent._call_model = lambda prompt, timeout=8: json.dumps({"reply": "好的"}, ensure_ascii=False)
+    sender.send_text_from_env = lambda msg, at_user_ids=None, priority=None: {"errcode": 0}
+    server.init_app(start_scheduler=False, start_summarizer=False)
+    samples: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(w: int, count: int):
+        client = server.app.test_client()
+        mine = []
+        for i in range(count):
+            payload = {"msgtype": "text", "msgId": f"bench-{w}-{i}", "text": {"content": f"今天天气不错 {i}"},
+                       "senderId": f"user{(w * count + i) % 500}", "senderNick": "bench"}
+            start = time.perf_counter()
+            r = client.post("/webhook", json=payload)
+            mine.append(time.perf_counter() - start)
+            if r.status_code != 200:
+                errors[0] += 1
+        with lock:
+            samples.extend(mine)
+
+    per = max(1, requests // concurrency)
+    threads = [threading.Thread(target=worker, args=(w, per)) for w in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    out = {"concurrency": concurrency, "requests_per_second": round(len(samples) / elapsed, 1),
+           "errors": errors[0], "latency": _summary(samples)}
+    print(f"  webhook: {out['requests_per_second']} req/s, p50 {out['latency']['p50_ms']}ms, "
+          f"p99 {out['latency']['p99_ms']}ms", file=sys.stderr)
+    return out
+
+
+def bench_scheduler(user_counts: List[int]) -> Dict[str, Any]:
+    from dingbot import activity, config
+
+    agent.extract_facts_for_user = lambda uid, *a, **k: [{"fact": f"fact-{uid}"}]
+    agent.generate_push_from_facts = lambda uid, facts: f"push {uid}"
+    sender.send_text_from_env = lambda msg, at_user_ids=None, priority=None: {"errcode": 0}
+    config.CHECK_INTERVAL_SECONDS = 10 ** 6  # no budget cut-off
+    out = {}
+    for n in user_counts:
+        for path in (memory_file.MEMORY_FILE, facts_file.FACTS_FILE, activity.ACTIVITY_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        activity.reset()
+        _write_log(memory_file.MEMORY_FILE, n * 3, n)
+        start = time.perf_counter()
+        scheduler.run_cycle()
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        scheduler.run_cycle()
+        idle = time.perf_counter() - start
+        out[str(n)] = {"cycle_seconds": round(first, 3), "users_per_second": round(n / max(first, 1e-9), 1),
+                       "idle_cycle_seconds": round(idle, 4)}
+        print(f"  scheduler {n} users: {out[str(n)]['cycle_seconds']}s "
+              f"({out[str(n)]['users_per_second']} users/s), no-change cycle {out[str(n)]['idle_cycle_seconds']}s",
+              file=sys.stderr)
+    return out
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+
+    def walk(a, b, prefix=""):
+        for key, value in b.items():
+            name = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, dict) and isinstance(a.get(key), dict):
+                walk(a[key], value, name)
+            elif isinstance(value, (int, float)) and isinstance(a.get(key), (int, float)) and a[key]:
+                change = (value - a[key]) / a[key] * 100
+                print(f"{name:70s} {a[key]:>12} -> {value:<12} {change:+7.1f}%")
+
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    walk(old.get("results", {}), new.get("results", {}))
+
+
+BENCHMARKS = ("memory_file", "facts_file", "reminders", "webhook", "scheduler")
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        parser = argparse.ArgumentParser(prog="bench.py compare")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.old, args.new)
+        return
+
+    parser = argparse.ArgumentParser(description="DingBot benchmarks")
+    parser.add_argument("--sizes", default="10000,100000", help="message log sizes (lines)")
+    parser.add_argument("--fact-users", default="1000,10000,50000", help="users in the facts file")
+    parser.add_argument("--reminders", default="1000,10000,100000", help="reminders in the SQLite store")
+    parser.add_argument("--requests", type=int, default=2000, help="webhook requests")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent webhook clients")
+    parser.add_argument("--cycle-users", default="100,1000", help="active users per scheduler cycle")
+    parser.add_argument("--repeat", type=int, default=20, help="repetitions of each timed call")
+    parser.add_argument("--only", help="comma-separated subset of: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--out", help="result file (default: benchmarks/results/<commit>.json)")
+    args = parser.parse_args()
+
+    def ints(value: str) -> List[int]:
+        return [int(v) for v in value.split(",") if v]
+
+    only = set(args.only.split(",")) if args.only else set(BENCHMARKS)
+    results: Dict[str, Any] = {}
+    runs = {
+        "memory_file": lambda: bench_memory_file(ints(args.sizes), args.repeat),
+        "facts_file": lambda: bench_facts_file(ints(args.fact_users), args.repeat),
+        "reminders": lambda: bench_reminders(ints(args.reminders), args.repeat),
+        "webhook": lambda: bench_webhook(args.requests, args.concurrency),
+        "scheduler": lambda: bench_scheduler(ints(args.cycle_users)),
+    }
+    for name in BENCHMARKS:
+        if name in only:
+            print(f"{name}:", file=sys.stderr)
+            results[name] = runs[name]()
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "results": results,
+    }
+    out = args.out or os.path.join(ROOT, "benchmarks", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results written to {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
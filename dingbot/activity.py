@@ -0,0 +1,206 @@
+"""Per-user activity tracking for change-driven scheduling.
+
+The scheduler tails the memory log (`memory_file.MEMORY_FILE`) from the byte offset it
+reached last time; every user with a new message since then is marked dirty. Because
+the log itself is the feed, appends made by any web worker process are seen, and
+nothing is lost across restarts. State lives in `ACTIVITY_FILE`:
+
+    {"log_path": ..., "offset": <bytes read>,
+     "users": {uid: {"last_message": ts, "last_offset": <end of the latest message>,
+                     "last_processed": ts, "last_push": ts, "dirty": bool,
+                     "name": <latest sender nick, if any>}}}
+
+`dirty_users()` are the users to re-extract facts for; `idle_users(seconds)` are users
+without news whose last message and last push are both older than `seconds`, for
+re-engagement pushes on their stored facts. The first refresh of a log (no state yet)
+marks every user in it dirty.
+
+Scheduler nodes in a cluster each keep their own file: a `{node}` in `ACTIVITY_FILE` is
+replaced by the node id. `merge()` applies another node's processing of a user.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import config, memory_file
+from .cluster import default_node_id
+from .filelock import FileLock
+
+ACTIVITY_FILE = os.environ.get("ACTIVITY_FILE", "dingbot_activity.json")
+
+
+def _path() -> str:
+    if "{node}" not in ACTIVITY_FILE:
+        return ACTIVITY_FILE
+    return ACTIVITY_FILE.replace("{node}", config.SCHEDULER_NODE_ID or default_node_id())
+
+
+_lock = FileLock(_path)
+_mu = threading.Lock()
+_state: Optional[Dict[str, Any]] = None
+_state_path: Optional[str] = None
+
+
+def _empty() -> Dict[str, Any]:
+    return {"log_path": None, "offset": 0, "users": {}}
+
+
+def _load() -> Dict[str, Any]:
+    global _state, _state_path
+    path = _path()
+    if _state is None or _state_path != path:
+        state = _empty()
+        with _lock.shared():
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    try:
+                        state.update(json.load(f))
+                    except Exception:
+                        pass
+        _state, _state_path = state, path
+    return _state
+
+
+def _iter_lines(path: str, start: int):
+    """Yield (entry, end_offset) for each complete JSONL line from `start`."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                # partially written line; picked up next time
+                break
+            pos += len(raw)
+            try:
+                yield json.loads(raw), pos
+            except Exception:
+                yield None, pos
+
+
+def refresh() -> int:
+    """Mark users with messages appended since the last refresh as dirty; returns how many lines were read."""
+    path = memory_file.MEMORY_FILE
+    with _mu:
+        state = _load()
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if state["log_path"] != path:
+            # a different log: start over
+            state.update(_empty(), log_path=path)
+        elif size < state["offset"]:
+            # truncated or replaced log: read it again from the start
+            state["offset"] = 0
+        if size == state["offset"]:
+            return 0
+        users = state["users"]
+        n = 0
+        with memory_file._lock.shared():
+            for entry, pos in _iter_lines(path, state["offset"]):
+                state["offset"] = pos
+                n += 1
+                uid = entry.get("user_id") if entry else None
+                if not uid:
+                    continue
+                rec = users.setdefault(uid, {"last_message": 0, "last_processed": 0, "last_push": 0})
+                rec["last_message"] = max(rec.get("last_message") or 0, entry.get("timestamp") or 0)
+                rec["last_offset"] = pos
+                rec["dirty"] = True
+                if entry.get("sender_name"):
+                    rec["name"] = entry["sender_name"]
+        return n
+
+
+def dirty_users() -> List[str]:
+    """Users with new messages, oldest activity first."""
+    with _mu:
+        users = _load()["users"]
+        dirty = [u for u, r in users.items() if r.get("dirty")]
+        return sorted(dirty, key=lambda u: users[u].get("last_message") or 0)
+
+
+def idle_users(idle_seconds: float, now: Optional[float] = None) -> List[str]:
+    """Users without news whose last message and last push are older than `idle_seconds`."""
+    if idle_seconds <= 0:
+        return []
+    now = time.time() if now is None else now
+    with _mu:
+        users = _load()["users"]
+        due = [u for u, r in users.items()
+               if not r.get("dirty") and now - max(r.get("last_message") or 0, r.get("last_push") or 0) >= idle_seconds]
+        return sorted(due, key=lambda u: users[u].get("last_push") or 0)
+
+
+def mark_processed(user_id: str, pushed: bool, now: Optional[float] = None) -> None:
+    now = int(time.time() if now is None else now)
+    with _mu:
+        rec = _load()["users"].setdefault(user_id, {"last_message": 0, "last_processed": 0, "last_push": 0})
+        rec["dirty"] = False
+        rec["last_processed"] = now
+        if pushed:
+            rec["last_push"] = now
+
+
+def position(user_id: str) -> Tuple[Optional[str], int]:
+    """(log path, end offset of the user's latest message read so far)."""
+    with _mu:
+        state = _load()
+        return state["log_path"], (state["users"].get(user_id) or {}).get("last_offset") or 0
+
+
+def display_name(user_id: str) -> Optional[str]:
+    """The user's latest DingTalk nick seen in the log, or None."""
+    with _mu:
+        return (_load()["users"].get(user_id) or {}).get("name")
+
+
+def merge(user_id: str, log_path: Optional[str], log_offset: int, processed_at: float, pushed_at: float) -> None:
+    """Apply another node's processing of `user_id`: it is no longer dirty if that covered
+    the user's latest message, and its push counts for re-engagement."""
+    with _mu:
+        state = _load()
+        rec = state["users"].get(user_id)
+        if rec is None:
+            return
+        rec["last_push"] = max(rec.get("last_push") or 0, int(pushed_at or 0))
+        covered = log_path == state["log_path"] and "last_offset" in rec and log_offset >= rec["last_offset"]
+        if rec.get("dirty") and covered:
+            rec["dirty"] = False
+            rec["last_processed"] = max(rec.get("last_processed") or 0, int(processed_at or 0))
+
+
+def mark_pushed(user_ids: List[str], now: Optional[float] = None) -> None:
+    """Record a push that was sent after the users were processed (digest mode)."""
+    now = int(time.time() if now is None else now)
+    with _mu:
+        users = _load()["users"]
+        for uid in user_ids:
+            users.setdefault(uid, {"last_message": 0, "last_processed": 0, "last_push": 0})["last_push"] = now
+
+
+def save() -> None:
+    with _mu:
+        state = _load()
+        data = json.dumps(state, ensure_ascii=False)
+    path = _path()
+    with _lock.exclusive():
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def reset() -> None:
+    """Forget the cached state (the file is re-read on next use)."""
+    global _state
+    with _mu:
+        _state = None
+
+
+def stats() -> Dict[str, Any]:
+    with _mu:
+        state = _load()
+        users = state["users"]
+        return {"users": len(users), "dirty": sum(1 for r in users.values() if r.get("dirty")),
+                "offset": state["offset"]}
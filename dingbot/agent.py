@@ -8,25 +8,27 @@ It will send a JSON payload {"model": <name>, "input": <prompt>} and expect a pl
 """
 
 import json
-import requests
+import importlib.util
 from typing import List, Dict, Any, Optional
 
-from . import config
+from . import config, metrics, tracing
 
 import logging
 import time
 import concurrent.futures
+import contextvars
 import os
+import threading
 
-# Prefer the new official GenAI client if available: `from google import genai` and `from google.genai import types`
+# Prefer the new official GenAI client if available: `from google import genai` and `from google.genai import types`.
+# Importing it takes a large share of startup time, so only check that it is installed here;
+# `_ensure_genai` imports it on the first model call.
 try:
-    from google import genai  # type: ignore
-    from google.genai import types  # type: ignore
-    GENAI_CLIENT_AVAILABLE = True
+    GENAI_CLIENT_AVAILABLE = importlib.util.find_spec("google.genai") is not None
 except Exception:
-    genai = None  # type: ignore
-    types = None  # type: ignore
     GENAI_CLIENT_AVAILABLE = False
+genai = None  # type: ignore
+types = None  # type: ignore
 
 # Backwards-compatible alias for older test code
 GENAI_AVAILABLE = GENAI_CLIENT_AVAILABLE
@@ -34,6 +36,111 @@ GENAI_AVAILABLE = GENAI_CLIENT_AVAILABLE
 logger = logging.getLogger(__name__)
 
 
+def _ensure_genai() -> None:
+    """Import the google.genai SDK on first use (tests may already have put a fake in `genai`)."""
+    global genai, types, GENAI_CLIENT_AVAILABLE
+    if genai is not None or not GENAI_CLIENT_AVAILABLE:
+        return
+    try:
+        from google import genai as _genai  # type: ignore
+        from google.genai import types as _types  # type: ignore
+    except Exception:
+        logger.exception("Agent: google.genai is installed but failed to import")
+        GENAI_CLIENT_AVAILABLE = False
+        return
+    genai, types = _genai, _types
+
+
+_client_lock = threading.Lock()
+_client = None
+# the `genai` module the shared client was created from (tests swap in fakes)
+_client_source = None
+# preferred model name -> resolved name, for the current client
+_resolved_models: Dict[str, Optional[str]] = {}
+
+
+def get_client():
+    """The process-wide SDK client, created on first use and reused by every call."""
+    global _client, _client_source
+    with _client_lock:
+        if _client is None or _client_source is not genai:
+            _client = genai.Client()
+            _client_source = genai
+            _resolved_models.clear()
+        return _client
+
+
+def resolve_model(preferred: Optional[str], refresh: bool = False) -> Optional[str]:
+    """Resolve a user-provided model name to an available model via the SDK.
+
+    If the SDK is available and an API key is present, this will list models and
+    attempt to find the best match. It prefers exact matches, then substring
+    matches (e.g., 'gemini-3' -> 'models/gemini-3-pro-preview'), then sensible
+    fallbacks like gemini-2.5 models. Results are cached per client; `refresh`
+    lists the models again (e.g. after the resolved model was reported missing).
+    """
+    if not (GENAI_CLIENT_AVAILABLE and config.GEMINI_API_KEY):
+        return preferred
+    client = get_client()
+    key = preferred or ""
+    if not refresh and key in _resolved_models:
+        return _resolved_models[key]
+    try:
+        with tracing.span("agent.list_models"):
+            names = [getattr(m, "name", None) for m in client.models.list()]
+            names = [n for n in names if n]
+    except Exception:
+        logger.exception("Agent: model resolution via list failed")
+        return preferred
+    if not names:
+        return preferred
+    resolved = _match_model(preferred, names)
+    if client is _client:
+        _resolved_models[key] = resolved
+    return resolved
+
+
+def _match_model(preferred: Optional[str], names: List[str]) -> str:
+    # If preferred already looks like a full model resource or exact match, return it
+    if not preferred:
+        # pick a reasonable default: prefer gemini-3, then gemini-2.5, then first
+        for n in names:
+            if "gemini-3" in n:
+                return n
+        for n in names:
+            if "gemini-2.5" in n:
+                return n
+        return names[0]
+
+    if preferred in names or preferred.startswith("models/") or "/" in preferred:
+        return preferred
+
+    # substring / suffix match
+    for n in names:
+        if preferred in n:
+            return n
+    bare = preferred.split('/')[-1]
+    for n in names:
+        if bare in n:
+            return n
+    # fallback to first gemini-3 or first model
+    for n in names:
+        if "gemini-3" in n:
+            return n
+    return names[0]
+
+
+def warmup() -> Dict[str, Any]:
+    """Import the SDK, create the shared client and resolve the configured model ahead of the first call."""
+    if os.getenv("FORCE_MOCK_GENAI") or not (GENAI_CLIENT_AVAILABLE and config.GEMINI_API_KEY):
+        return {"skipped": True}
+    _ensure_genai()
+    if genai is None:
+        return {"skipped": True}
+    raw_model = config.GEMINI_MODEL or "gemini-3"
+    return {"model": resolve_model(raw_model) or raw_model}
+
+
 def _call_model(prompt: str, timeout: int = 8) -> str:
     """Call Gemini model using the official Google client with a timeout and clear logging.
 
@@ -60,56 +167,9 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
             "reply": "抱歉，机器人未启用 Gemini SDK（缺少 'google-genai'）。管理员请安装并重启服务。",
         })
 
+    _ensure_genai()
     start = time.perf_counter()
 
-    def _resolve_model_name(preferred: Optional[str]) -> Optional[str]:
-        """Resolve a user-provided model name to an available model via the SDK.
-
-        If the SDK is available and an API key is present, this will list models and
-        attempt to find the best match. It prefers exact matches, then substring
-        matches (e.g., 'gemini-3' -> 'models/gemini-3-pro-preview'), then sensible
-        fallbacks like gemini-2.5 models.
-        """
-        if not (GENAI_CLIENT_AVAILABLE and config.GEMINI_API_KEY):
-            return preferred
-        try:
-            client = genai.Client()
-            names = [getattr(m, "name", None) for m in client.models.list()]
-            names = [n for n in names if n]
-            if not names:
-                return preferred
-
-            # If preferred already looks like a full model resource or exact match, return it
-            if not preferred:
-                # pick a reasonable default: prefer gemini-3, then gemini-2.5, then first
-                for n in names:
-                    if "gemini-3" in n:
-                        return n
-                for n in names:
-                    if "gemini-2.5" in n:
-                        return n
-                return names[0]
-
-            if preferred in names or preferred.startswith("models/") or "/" in preferred:
-                return preferred
-
-            # substring / suffix match
-            for n in names:
-                if preferred in n:
-                    return n
-            bare = preferred.split('/')[-1]
-            for n in names:
-                if bare in n:
-                    return n
-            # fallback to first gemini-3 or first model
-            for n in names:
-                if "gemini-3" in n:
-                    return n
-            return names[0]
-        except Exception:
-            logger.exception("Agent: model resolution via list failed")
-            return preferred
-
     def _call_official():
         # Use the official google.genai client if available
         # This follows the pattern:
@@ -117,9 +177,9 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
         #   from google.genai import types
         #   client = genai.Client()
         #   resp = client.models.generate_content(...)
-        client = genai.Client()
+        client = get_client()
         raw_model = config.GEMINI_MODEL or "gemini-3"
-        model = _resolve_model_name(raw_model) or raw_model
+        model = resolve_model(raw_model) or raw_model
 
         def _call_with_model(m: str):
             if types is not None:
@@ -137,7 +197,7 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
             msg = str(e).lower()
             if "not found" in msg or "is not found" in msg or "not supported" in msg:
                 logger.warning("Agent: model '%s' not found, attempting to resolve a compatible model", model)
-                fallback = _resolve_model_name(raw_model)
+                fallback = resolve_model(raw_model, refresh=True)
                 if fallback and fallback != model:
                     logger.info("Agent: retrying with resolved model %s", fallback)
                     try:
@@ -163,6 +223,8 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
         return str(resp)
 
     def _http_fallback():
+        import requests
+
         payload = {"model": config.GEMINI_MODEL, "input": prompt}
         headers = {"Authorization": f"Bearer {config.GEMINI_API_KEY}", "Content-Type": "application/json"}
         resp = requests.post(config.GEMINI_API_URL, json=payload, headers=headers, timeout=timeout)
@@ -174,7 +236,7 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
         logger.info("Agent: calling older genai.generate_text API")
         try:
             with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(lambda: genai.generate_text(model=config.GEMINI_MODEL or "models/gemini-3", prompt=prompt))
+                fut = ex.submit(contextvars.copy_context().run, lambda: genai.generate_text(model=config.GEMINI_MODEL or "models/gemini-3", prompt=prompt))
                 try:
                     resp = fut.result(timeout=timeout)
                 except concurrent.futures.TimeoutError:
@@ -200,7 +262,7 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
         logger.info("Agent: calling google.genai client for model %s", config.GEMINI_MODEL)
         try:
             with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(_call_official)
+                fut = ex.submit(contextvars.copy_context().run, _call_official)
                 try:
                     resp = fut.result(timeout=timeout)
                 except concurrent.futures.TimeoutError:
@@ -222,30 +284,84 @@ def _call_model(prompt: str, timeout: int = 8) -> str:
         logger.warning("Gemini API key present but official SDK not available; REST calls are disabled by policy. Install 'google-genai' to enable SDK usage.")
 
 from .memory_file import get_user_memories
+from . import retrieval, summary_file
+
+
+def _model_label() -> str:
+    """The model calls go to: the resolved name once `resolve_model` has run, else the
+    configured one. Only reads the cache, so labelling never lists the models."""
+    raw_model = config.GEMINI_MODEL or "gemini-3"
+    return _resolved_models.get(raw_model) or raw_model
+
+
+def _timed_model_call(call_site: str, prompt: str, **kwargs) -> str:
+    """`_call_model` recorded in the model-call latency histogram under `call_site`."""
+    start = time.perf_counter()
+    with tracing.span("agent.model_call", call_site=call_site, model=_model_label(), prompt_chars=len(prompt)):
+        try:
+            return _call_model(prompt, **kwargs)
+        finally:
+            # labelled after the call, which resolves the model on first use
+            metrics.MODEL_CALL_SECONDS.observe(time.perf_counter() - start, call_site=call_site, model=_model_label())
+
+
+def _summary_state(user_id: str) -> Dict[str, Any]:
+    """The user's summary record ({"summary", "count", "last_timestamp"}), or {} if unavailable."""
+    try:
+        return summary_file.get_user_summary(user_id)
+    except Exception:
+        logger.exception("Agent: failed to load summary for %s", user_id)
+        return {}
+
+
+def _user_summary(user_id: str) -> str:
+    """The user's rolling conversation summary (bounded to SUMMARY_MAX_CHARS), or ''."""
+    return (_summary_state(user_id).get("summary") or "")[:config.SUMMARY_MAX_CHARS]
+
+
+def _history_context(user_id: str, content: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Relevant + recent history and facts for the prompt, within the token budget."""
+    try:
+        return retrieval.build_context(user_id, content)
+    except Exception:
+        logger.exception("Agent: retrieval failed for %s; falling back to recent messages", user_id)
+        return {"messages": get_user_memories(user_id, limit=10), "facts": []}
+
 
 def analyze_and_reply(content: str, sender_name: str, user_id: str = None) -> Dict[str, Any]:
     """Return a dict with keys: reply (str), optional save_memory dict {interval, content}.
 
-    每次对话都带上用户 memory 作为上下文。
+    每次对话都带上与当前消息相关的历史消息、最近几条消息以及用户事实作为上下文。
     """
-    prompt_parts = [f"你是一个贴心的助手。请简洁回复用户 '{sender_name}'。\n用户消息:\n{content}"]
-    # 加载用户历史 memory
-    memories = get_user_memories(user_id, limit=10) if user_id else []
-    if memories:
-        prompt_parts.append("用户历史消息：")
-        for m in memories:
-            prompt_parts.append(f"- {m['content']} ({m['timestamp']})")
-    prompt_parts.append("\n只需返回 JSON: {\"reply\": <text>}，不要包含其它内容。")
-    prompt = "\n".join(prompt_parts)
+    # 加载用户历史 memory（相关 + 最近，受 token 预算限制）
+    with tracing.span("agent.history_load"), metrics.STAGE_SECONDS.time(stage="history_load"):
+        context = _history_context(user_id, content) if user_id else {"messages": [], "facts": []}
+        summary = _user_summary(user_id) if user_id else ""
+    with metrics.STAGE_SECONDS.time(stage="prompt_build"):
+        prompt_parts = [f"你是一个贴心的助手。请简洁回复用户 '{sender_name}'。\n用户消息:\n{content}"]
+        memories = context["messages"]
+        if summary:
+            prompt_parts.append(f"此前对话摘要：\n{summary}")
+        if memories:
+            prompt_parts.append("用户历史消息：")
+            for m in memories:
+                prompt_parts.append(f"- {m['content']} ({m['timestamp']})")
+        if context["facts"]:
+            prompt_parts.append("已知用户事实：")
+            for f in context["facts"]:
+                prompt_parts.append(f"- {f['fact']}")
+        prompt_parts.append("\n只需返回 JSON: {\"reply\": <text>}，不要包含其它内容。")
+        prompt = "\n".join(prompt_parts)
 
     try:
-        raw = _call_model(prompt)
+        raw = _timed_model_call("reply", prompt)
         if raw is None or not str(raw).strip():
             logger.warning("Agent: model returned empty response for prompt")
             return {"reply": "抱歉，未收到模型回复，请稍候再试。"}
         raw_s = str(raw).strip()
         try:
-            parsed = json.loads(raw_s)
+            with metrics.STAGE_SECONDS.time(stage="json_parse"):
+                parsed = json.loads(raw_s)
             if isinstance(parsed, dict):
                 return parsed
             return {"reply": parsed if isinstance(parsed, str) else json.dumps(parsed)}
@@ -262,7 +378,7 @@ def generate_push_message(memory: Dict[str, Any]) -> str:
     content = memory.get("content")
     prompt = f"Write a friendly short reminder message for: {content}\nOutput only the message text."
     try:
-        raw = _call_model(prompt)
+        raw = _timed_model_call("push_message", prompt)
         # if model returned JSON, try parse; else return raw
         try:
             parsed = json.loads(raw)
@@ -273,26 +389,54 @@ def generate_push_message(memory: Dict[str, Any]) -> str:
         return f"提醒: {content}"
 
 
-def extract_facts_for_user(user_id: str, max_messages: int = 50) -> List[Dict[str, Any]]:
+def extract_facts_for_user(user_id: str, max_messages: int = 50,
+                           messages: Optional[List[Dict[str, Any]]] = None,
+                           strict: bool = False) -> Optional[List[Dict[str, Any]]]:
     """Use the model to extract objective facts from a user's recent messages.
 
-    Returns a list of dicts representing facts (e.g., [{"fact": "喜欢猫"}, ...])
+    `messages` (chronological) saves the memory-file scan when the caller already has them.
+    Returns a list of dicts representing facts (e.g., [{"fact": "喜欢猫"}, ...]). A failed
+    or empty model call gives [] too, unless `strict`, where it gives None so that batch
+    callers can tell it from "no facts".
     """
-    from .memory_file import get_user_memories
-    msgs = get_user_memories(user_id, limit=max_messages)
-    if not msgs:
+    from .memory_file import get_user_memories, get_user_messages
+    state = _summary_state(user_id)
+    summary = (state.get("summary") or "")[:config.SUMMARY_MAX_CHARS]
+    window = config.SUMMARY_RECENT_WINDOW
+    if not summary:
+        msgs = list(messages) if messages is not None else get_user_memories(user_id, limit=max_messages)
+    elif messages is not None:
+        # the summary covers older history: every message newer than it, and at least
+        # the recent window for context
+        msgs = list(messages)
+        last_ts = state.get("last_timestamp") or 0
+        newer = sum(1 for m in msgs if (m.get("timestamp") or 0) > last_ts)
+        keep = max(newer, window)
+        msgs = msgs[-keep:] if keep > 0 else []
+    else:
+        msgs = get_user_messages(user_id, offset=state.get("count") or 0)
+        if len(msgs) < window:
+            msgs = get_user_memories(user_id, limit=window)
+    # more than max_messages new ones: the newest (the summarizer folds in the rest)
+    msgs = msgs[-max_messages:] if max_messages > 0 else []
+    if not msgs and not summary:
         return []
-    prompt_parts = ["从以下用户消息中提取客观事实（不包含主观判断）。\n请以 JSON 数组的形式返回，每个元素为 {\"fact\": <简短事实文本>} 。\n消息列表："]
+    prompt_parts = ["从以下用户消息中提取客观事实（不包含主观判断）。\n请以 JSON 数组的形式返回，每个元素为 {\"fact\": <简短事实文本>} 。"]
+    if summary:
+        prompt_parts.append(f"此前对话摘要：\n{summary}")
+    prompt_parts.append("消息列表：")
     for m in msgs:
         prompt_parts.append(f"- {m.get('content')}")
     prompt = "\n".join(prompt_parts)
     try:
-        raw = _call_model(prompt, timeout=10)
+        raw = _timed_model_call("extract_facts", prompt, timeout=10)
         if not raw or not str(raw).strip():
-            return []
+            # _call_model gives nothing back when every backend failed
+            return None if strict else []
         raw_s = str(raw).strip()
         try:
-            parsed = json.loads(raw_s)
+            with metrics.STAGE_SECONDS.time(stage="json_parse"):
+                parsed = json.loads(raw_s)
             # normalize to list of dicts
             if isinstance(parsed, list):
                 res = []
@@ -367,7 +511,36 @@ def extract_facts_for_user(user_id: str, max_messages: int = 50) -> List[Dict[st
             return facts
     except Exception:
         logger.exception("Agent: extract_facts_for_user failed for %s", user_id)
-        return []
+        return None if strict else []
+
+
+def summarize_conversation(previous: str, messages: List[Dict[str, Any]]) -> Optional[str]:
+    """Fold `messages` into the `previous` rolling summary.
+
+    Returns the new summary text, or None if the model gave nothing usable (the
+    caller keeps the old summary and retries later).
+    """
+    prompt_parts = [f"请将以下新消息合并进已有的对话摘要，保留用户的重要信息、偏好和未完成的事项，输出不超过 {config.SUMMARY_MAX_CHARS // 2} 字的摘要文本（仅输出摘要）。"]
+    prompt_parts.append(f"已有摘要：\n{previous or '（无）'}")
+    prompt_parts.append("新消息：")
+    for m in messages:
+        prompt_parts.append(f"- {m.get('content')} ({m.get('timestamp')})")
+    prompt = "\n".join(prompt_parts)
+    try:
+        raw = _timed_model_call("summarize", prompt, timeout=10)
+        if not raw or not str(raw).strip():
+            return None
+        raw_s = str(raw).strip()
+        try:
+            parsed = json.loads(raw_s)
+            if isinstance(parsed, dict):
+                raw_s = str(parsed.get("summary") or parsed.get("reply") or "").strip()
+        except json.JSONDecodeError:
+            pass
+        return raw_s[:config.SUMMARY_MAX_CHARS] or None
+    except Exception:
+        logger.exception("Agent: summarize_conversation failed")
+        return None
 
 
 def generate_push_from_facts(user_id: str, facts: List[Dict[str, Any]]) -> str:
@@ -377,7 +550,7 @@ def generate_push_from_facts(user_id: str, facts: List[Dict[str, Any]]) -> str:
     facts_text = "\n".join([f"- {f.get('fact')}" for f in facts])
     prompt = f"为用户写一段友好的、简短的推送消息，基于以下事实（不要@用户，输出仅为消息文本）：\n{facts_text}\n请仅输出最终消息。"
     try:
-        raw = _call_model(prompt, timeout=8)
+        raw = _timed_model_call("push_from_facts", prompt, timeout=8)
         if not raw or not str(raw).strip():
             return "提醒: 保持关注，今天也要注意身体哦。"
         try:
@@ -386,4 +559,36 @@ def generate_push_from_facts(user_id: str, facts: List[Dict[str, Any]]) -> str:
         except Exception:
             return str(raw).strip()
     except Exception:
-        return "提醒: 保持关注，今天也要注意身体哦。"
\ No newline at end of file
+        return "提醒: 保持关注，今天也要注意身体哦。"
+
+
+def generate_pushes_for_users(user_facts: Dict[str, List[Dict[str, Any]]]) -> Dict[str, str]:
+    """Generate push messages for several users with a single model call.
+
+    Returns {user_id: message}. Users the model's answer doesn't cover (or all of them,
+    if it can't be parsed) fall back to `generate_push_from_facts`.
+    """
+    users = [uid for uid, facts in user_facts.items() if facts]
+    out: Dict[str, str] = {}
+    if users:
+        parts = ["为下面每位用户各写一段友好的、简短的推送消息，基于其事实（不要@用户）。",
+                 "请以 JSON 对象返回，键为用户编号（如 \"1\"），值为该用户的消息文本。"]
+        for i, uid in enumerate(users, 1):
+            facts_text = "\n".join(f"- {f.get('fact')}" for f in user_facts[uid])
+            parts.append(f"用户 {i}:\n{facts_text}")
+        try:
+            raw = str(_timed_model_call("push_batch", "\n".join(parts), timeout=15) or "").strip()
+            with metrics.STAGE_SECONDS.time(stage="json_parse"):
+                start, end = raw.find("{"), raw.rfind("}")
+                parsed = json.loads(raw[start:end + 1]) if start != -1 and end > start else {}
+            if isinstance(parsed, dict):
+                for i, uid in enumerate(users, 1):
+                    text = parsed.get(str(i))
+                    if isinstance(text, str) and text.strip():
+                        out[uid] = text.strip()
+        except Exception:
+            logger.exception("Agent: batched push generation failed for %d users", len(users))
+    for uid, facts in user_facts.items():
+        if uid not in out:
+            out[uid] = generate_push_from_facts(uid, facts)
+    return out
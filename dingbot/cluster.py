@@ -0,0 +1,151 @@
+"""Scheduler node membership for running the scheduler on several nodes.
+
+Every scheduler node holds a lease row in the `nodes` table of a SQLite database on a
+shared volume (`SCHEDULER_CLUSTER_DB`) and renews it every few seconds. The live nodes
+(unexpired leases) split the users between them by rendezvous hashing of the user id,
+so each user is handled by exactly one node, and adding or losing a node only moves
+that node's share. When a node dies, its lease expires after `SCHEDULER_LEASE_SECONDS`
+and its users move to the remaining nodes. Node ids default to the host name, so a
+restarted node takes back the same users.
+
+Every node reads the whole memory log, so when a user moves, the new owner may still
+hold messages the previous owner already handled. The `users` table records how far
+into the log each user was processed; the new owner skips what is already covered.
+
+Table `nodes`:
+- node_id TEXT PRIMARY KEY
+- lease_until REAL (unix timestamp)
+- started_at REAL
+
+Table `users`:
+- user_id TEXT PRIMARY KEY
+- log_path TEXT, log_offset INTEGER (end of the user's latest processed message)
+- processed_at REAL, pushed_at REAL
+- node_id TEXT
+"""
+
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from .hashing import rendezvous
+
+logger = logging.getLogger(__name__)
+
+_create_sql = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id TEXT PRIMARY KEY,
+    lease_until REAL NOT NULL,
+    started_at REAL NOT NULL
+)
+"""
+_create_users_sql = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    log_path TEXT,
+    log_offset INTEGER NOT NULL DEFAULT 0,
+    processed_at REAL NOT NULL DEFAULT 0,
+    pushed_at REAL NOT NULL DEFAULT 0,
+    node_id TEXT
+)
+"""
+
+
+def default_node_id() -> str:
+    """Stable across restarts, so a restarted node does not move users around."""
+    return socket.gethostname()
+
+
+class Membership:
+    def __init__(self, path: str, node_id: Optional[str] = None, lease_seconds: float = 30):
+        self.path = path
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = float(lease_seconds)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(_create_sql)
+            self._conn.execute(_create_users_sql)
+            self._conn.commit()
+        self._nodes: List[str] = []
+
+    def heartbeat(self, now: Optional[float] = None) -> List[str]:
+        """Renew this node's lease and return the live nodes."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO nodes (node_id, lease_until, started_at) VALUES (?,?,?)"
+                " ON CONFLICT(node_id) DO UPDATE SET lease_until=excluded.lease_until",
+                (self.node_id, now + self.lease_seconds, now),
+            )
+            # forget nodes that have been gone for a while
+            self._conn.execute("DELETE FROM nodes WHERE lease_until<?", (now - 10 * self.lease_seconds,))
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT node_id FROM nodes WHERE lease_until>=? ORDER BY node_id", (now,)
+            ).fetchall()
+        nodes = [r[0] for r in rows]
+        if nodes != self._nodes:
+            logger.info("Cluster: live scheduler nodes changed to %s (this node: %s)", nodes, self.node_id)
+            self._nodes = nodes
+        return nodes
+
+    def nodes(self) -> List[str]:
+        """Live nodes as of the last heartbeat."""
+        return list(self._nodes)
+
+    def owner(self, user_id: str) -> Optional[str]:
+        return rendezvous(user_id, self._nodes or [self.node_id])
+
+    def owns(self, user_id: str) -> bool:
+        return self.owner(user_id) == self.node_id
+
+    def leave(self) -> None:
+        """Drop this node's lease so its users move over immediately."""
+        with self._lock:
+            self._conn.execute("DELETE FROM nodes WHERE node_id=?", (self.node_id,))
+            self._conn.commit()
+        self._nodes = []
+
+    def record_processed(self, user_id: str, log_path: str, log_offset: int, pushed: bool,
+                         now: Optional[float] = None) -> None:
+        """Record that this node handled `user_id` up to `log_offset` of the log."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO users (user_id, log_path, log_offset, processed_at, pushed_at, node_id)"
+                " VALUES (?,?,?,?,?,?) ON CONFLICT(user_id) DO UPDATE SET log_path=excluded.log_path,"
+                " log_offset=excluded.log_offset, processed_at=excluded.processed_at,"
+                " pushed_at=MAX(users.pushed_at, excluded.pushed_at), node_id=excluded.node_id",
+                (user_id, log_path, log_offset, now, now if pushed else 0, self.node_id),
+            )
+            self._conn.commit()
+
+    def record_pushed(self, user_ids: Iterable[str], now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.executemany("UPDATE users SET pushed_at=? WHERE user_id=?", [(now, u) for u in user_ids])
+            self._conn.commit()
+
+    def processed(self, user_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """The shared processing records of `user_ids` (users never processed are left out)."""
+        user_ids = list(user_ids)
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                rows = self._conn.execute(
+                    "SELECT user_id, log_path, log_offset, processed_at, pushed_at FROM users"
+                    f" WHERE user_id IN ({','.join('?' * len(chunk))})", chunk,
+                ).fetchall()
+                for uid, log_path, log_offset, processed_at, pushed_at in rows:
+                    out[uid] = {"log_path": log_path, "log_offset": log_offset,
+                                "processed_at": processed_at, "pushed_at": pushed_at}
+        return out
+
+    def stats(self) -> dict:
+        return {"node_id": self.node_id, "nodes": self.nodes(), "lease_seconds": self.lease_seconds}
@@ -0,0 +1,92 @@
+"""Per-key debounce window that merges bursts of messages into one batch.
+
+Items added for the same key are held until no new item has arrived for `window`
+seconds, or until `max_wait` seconds have passed since the first held item, and are
+then handed to `flush(key, items)` together. A single background thread tracks all
+deadlines; `flush` is called on that thread and should be quick (e.g. enqueue work).
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    def __init__(self, window: float, max_wait: float, flush: Callable[[Any, List[Any]], None], name: str = "coalescer"):
+        self.window = float(window)
+        self.max_wait = max(float(max_wait), self.window)
+        self.flush = flush
+        self.name = name
+        self._pending: Dict[Any, Dict[str, Any]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self.items_added = 0
+        self.batches_flushed = 0
+
+    def start(self) -> "Coalescer":
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def add(self, key: Any, item: Any) -> None:
+        now = time.monotonic()
+        with self._cond:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = {"items": [], "first": now}
+            batch["items"].append(item)
+            batch["deadline"] = min(now + self.window, batch["first"] + self.max_wait)
+            self.items_added += 1
+            self._cond.notify()
+
+    def _take_due(self, now: float) -> List[tuple]:
+        due = [k for k, b in self._pending.items() if b["deadline"] <= now]
+        return [(k, self._pending.pop(k)["items"]) for k in due]
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        # flush whatever is left so nothing is lost on shutdown
+                        ready = [(k, b["items"]) for k, b in self._pending.items()]
+                        self._pending.clear()
+                        break
+                    now = time.monotonic()
+                    ready = self._take_due(now)
+                    if ready:
+                        break
+                    timeout = min((b["deadline"] for b in self._pending.values()), default=None)
+                    self._cond.wait(None if timeout is None else max(0.0, timeout - now))
+                self.batches_flushed += len(ready)
+            for key, items in ready:
+                try:
+                    self.flush(key, items)
+                except Exception:
+                    logger.exception("Coalescer %s: flush failed for %s", self.name, key)
+            if self._stopped:
+                return
+
+    def stop(self, wait: bool = True) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if wait and self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "window_seconds": self.window,
+                "max_wait_seconds": self.max_wait,
+                "pending_keys": len(self._pending),
+                "items_added": self.items_added,
+                "batches_flushed": self.batches_flushed,
+            }
@@ -2,6 +2,8 @@ import os
 
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 SECRET = os.getenv("SECRET")
+# DingTalk API endpoint; point it at a local stand-in (`python -m dingbot.loadgen fake-dingtalk`) for load tests
+DINGTALK_API_BASE = os.getenv("DINGTALK_API_BASE", "https://oapi.dingtalk.com")
 
 # Gemini (user provided API key + url)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -17,3 +19,164 @@ CHECK_INTERVAL_SECONDS = int(os.getenv("CHECK_INTERVAL_SECONDS", "60"))
 # Model name to pass to the Gemini endpoint (if needed)
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-3-pro-preview")
 
+
+# Prompt context retrieval: top-k relevant history items plus the most recent few,
+# within an approximate token budget
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+RETRIEVAL_RECENT = int(os.getenv("RETRIEVAL_RECENT", "3"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1200"))
+# in-memory retrieval indexes (messages and facts) kept for at most this many users
+RETRIEVAL_MAX_INDEXES = int(os.getenv("RETRIEVAL_MAX_INDEXES", "2000"))
+
+# Rolling per-user conversation summaries: fold new messages into the summary every N
+# messages (0 disables); prompts use the summary plus the messages newer than it
+SUMMARY_EVERY_N = int(os.getenv("SUMMARY_EVERY_N", "20"))
+SUMMARY_MAX_FOLD = int(os.getenv("SUMMARY_MAX_FOLD", "50"))
+SUMMARY_RECENT_WINDOW = int(os.getenv("SUMMARY_RECENT_WINDOW", "10"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "800"))
+
+# Acknowledge-first webhook mode: validate + enqueue, reply later from background workers
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0").lower() in ("1", "true", "yes")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", "1000"))
+
+# Webhook redelivery dedup: remember processed message ids / fingerprints for a while
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "300"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+DEDUP_FALLBACK_WINDOW_SECONDS = int(os.getenv("DEDUP_FALLBACK_WINDOW_SECONDS", "10"))
+# SQLite file shared by all web workers, so a redelivery that lands on another worker is
+# recognised too (empty = a cache per process)
+DEDUP_DB = os.getenv("DEDUP_DB", "dingbot_dedup.db")
+
+# Per-user coalescing: messages within the window are answered as one model turn
+# (0 disables). Enabling it implies the acknowledge-first webhook mode.
+COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", "0"))
+COALESCE_MAX_WAIT_SECONDS = float(os.getenv("COALESCE_MAX_WAIT_SECONDS", "5"))
+
+# Admission control for model turns (0 disables a limit); over-limit messages get a busy reply
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "32"))
+ADMISSION_USER_RATE_PER_MINUTE = float(os.getenv("ADMISSION_USER_RATE_PER_MINUTE", "30"))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "10"))
+ADMISSION_GROUP_RATE_PER_MINUTE = float(os.getenv("ADMISSION_GROUP_RATE_PER_MINUTE", "120"))
+ADMISSION_GROUP_BURST = float(os.getenv("ADMISSION_GROUP_BURST", "30"))
+
+# Process role: "all" (web + scheduler, development default), "web" (serve webhooks only)
+# or "scheduler" (background jobs only). At most one process per host runs the scheduler,
+# guarded by SCHEDULER_LOCK_FILE.
+DINGBOT_ROLE = os.getenv("DINGBOT_ROLE", "all").lower()
+SCHEDULER_LOCK_FILE = os.getenv("SCHEDULER_LOCK_FILE", "dingbot_scheduler.lock")
+
+# Request tracing: fraction of webhook requests / scheduler cycles traced, JSON span logs
+# on the `dingbot.trace` logger, optional OTLP/HTTP JSON export endpoint
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_LOG = os.getenv("TRACE_LOG", "1").lower() in ("1", "true", "yes")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "dingbot")
+
+# Directory shared by the gunicorn workers and the scheduler: each process writes its
+# metrics there every METRICS_SNAPSHOT_SECONDS and /metrics returns all of them, labelled
+# by process (empty = /metrics shows only the worker that serves the scrape)
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_SNAPSHOT_SECONDS = float(os.getenv("METRICS_SNAPSHOT_SECONDS", "5"))
+
+# Sampled profiling: fraction of webhook requests and every Nth scheduler cycle (0 = off)
+# run under cProfile, written as .prof files to PROFILE_DIR (oldest pruned beyond the max)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SCHEDULER_EVERY = int(os.getenv("PROFILE_SCHEDULER_EVERY", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "dingbot_profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+# Token for the /admin/* endpoints (sent as the X-Admin-Token header); unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Logging: level, "text" or "json" records, optional non-blocking queue in front of the
+# handler, per-logger sampling of INFO/DEBUG ("dingbot.server=0.1,werkzeug=0.05"), and
+# redaction/truncation of logged webhook payloads
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_ASYNC = os.getenv("LOG_ASYNC", "0").lower() in ("1", "true", "yes")
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "512"))
+LOG_REDACT_KEYS = os.getenv("LOG_REDACT_KEYS", "token,secret,sign,webhook")
+
+# DingTalk sender: shared keep-alive session and pool size, timeouts, retries for
+# connection errors / 429 / 503, and how long a signed URL is reused
+SENDER_POOL_MAXSIZE = int(os.getenv("SENDER_POOL_MAXSIZE", "10"))
+SENDER_CONNECT_TIMEOUT = float(os.getenv("SENDER_CONNECT_TIMEOUT", "3"))
+SENDER_READ_TIMEOUT = float(os.getenv("SENDER_READ_TIMEOUT", "10"))
+SENDER_RETRIES = int(os.getenv("SENDER_RETRIES", "2"))
+SENDER_RETRY_BACKOFF = float(os.getenv("SENDER_RETRY_BACKOFF", "0.5"))
+SENDER_SIGN_REUSE_SECONDS = float(os.getenv("SENDER_SIGN_REUSE_SECONDS", "60"))
+
+# Outbound queue in front of the robot: DingTalk allows ~20 messages/minute per robot, so
+# keep burst + rate under that (0 sends inline); "send too fast" answers are retried.
+# The per-robot buckets live in SENDER_RATE_DB so all processes sharing the file (web
+# workers and the scheduler) stay under the limit together ("" = per process).
+SENDER_RATE_PER_MINUTE = float(os.getenv("SENDER_RATE_PER_MINUTE", "18"))
+SENDER_BURST = float(os.getenv("SENDER_BURST", "2"))
+SENDER_RATE_DB = os.getenv("SENDER_RATE_DB", "dingbot_sender_rate.db")
+SENDER_QUEUE_MAX = int(os.getenv("SENDER_QUEUE_MAX", "1000"))
+SENDER_THROTTLE_RETRIES = int(os.getenv("SENDER_THROTTLE_RETRIES", "3"))
+SENDER_THROTTLE_BACKOFF_SECONDS = float(os.getenv("SENDER_THROTTLE_BACKOFF_SECONDS", "10"))
+
+# Scheduled pushes: "per_user" (one message per user), "digest" (one markdown message per
+# cycle, one model call per user) or "digest_batch" (also one model call per PUSH_BATCH_SIZE users)
+PUSH_MODE = os.getenv("PUSH_MODE", "per_user").lower()
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "20"))
+PUSH_DIGEST_TITLE = os.getenv("PUSH_DIGEST_TITLE", "今日提醒")
+# robot (DINGTALK_ROBOTS name) that receives digests; empty = the first healthy shard robot
+PUSH_DIGEST_ROBOT = os.getenv("PUSH_DIGEST_ROBOT", "")
+# markdown messages longer than this are split into several sends
+SENDER_MARKDOWN_MAX_BYTES = int(os.getenv("SENDER_MARKDOWN_MAX_BYTES", "5000"))
+
+# Durable outbox: queued messages are written to SQLite first and delivered (with
+# retries and exponential backoff) in the background; pending ones are replayed on start
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1").lower() in ("1", "true", "yes")
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "dingbot_outbox.db")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_RETENTION_SECONDS = float(os.getenv("OUTBOX_RETENTION_SECONDS", "86400"))
+
+# Several robots / groups: JSON list of {"name", "access_token", "secret",
+# "conversation_ids": [...], "shard": true}; defaults to the ACCESS_TOKEN/SECRET pair.
+# Sends to different robots run concurrently on SENDER_CONCURRENCY threads.
+DINGTALK_ROBOTS = os.getenv("DINGTALK_ROBOTS", "")
+SENDER_CONCURRENCY = int(os.getenv("SENDER_CONCURRENCY", "4"))
+ROBOT_UNHEALTHY_AFTER = int(os.getenv("ROBOT_UNHEALTHY_AFTER", "3"))
+# an unhealthy robot gets one trial send this often; success makes it healthy again
+ROBOT_RETRY_AFTER_SECONDS = float(os.getenv("ROBOT_RETRY_AFTER_SECONDS", "60"))
+
+# Scheduler cycle: users processed in parallel, and the time budget after which a cycle
+# stops starting users (0 = 90% of CHECK_INTERVAL_SECONDS); the rest carry over
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "4"))
+SCHEDULER_CYCLE_BUDGET_SECONDS = float(os.getenv("SCHEDULER_CYCLE_BUDGET_SECONDS", "0"))
+# "cycle" (all due users at the start of each interval) or "spread" (each user at a stable
+# slot within the interval, handled by a tick every SCHEDULER_TICK_SECONDS plus jitter)
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "cycle").lower()
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "5"))
+SCHEDULER_TICK_JITTER_SECONDS = float(os.getenv("SCHEDULER_TICK_JITTER_SECONDS", "1"))
+
+# Several scheduler nodes: SQLite database on a shared volume holding the node leases
+# and how far each user was processed ("" = a single scheduler). Users are split between
+# the live nodes; a dead node's users move over after SCHEDULER_LEASE_SECONDS. Node ids
+# default to the host name; SCHEDULER_LOCK_FILE still allows one node per host.
+SCHEDULER_CLUSTER_DB = os.getenv("SCHEDULER_CLUSTER_DB", "")
+SCHEDULER_NODE_ID = os.getenv("SCHEDULER_NODE_ID", "")
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "30"))
+
+# Only users with new messages are re-extracted each cycle (tracked in ACTIVITY_FILE);
+# users without news get a re-engagement push from their stored facts once per
+# REENGAGE_INTERVAL_SECONDS (0 = never), at most REENGAGE_MAX_PER_CYCLE per cycle (0 = no cap)
+REENGAGE_INTERVAL_SECONDS = int(os.getenv("REENGAGE_INTERVAL_SECONDS", str(7 * 86400)))
+REENGAGE_MAX_PER_CYCLE = int(os.getenv("REENGAGE_MAX_PER_CYCLE", "50"))
+
+# Startup warmup (off by default): in the background after init_app, create the model
+# client and resolve the model name, open DingTalk connections and build the retrieval
+# indexes of the WARMUP_RECENT_USERS most recently active users. `/` answers 503 until it
+# finishes, or until WARMUP_TIMEOUT_SECONDS have passed.
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "0").lower() in ("1", "true", "yes")
+WARMUP_RECENT_USERS = int(os.getenv("WARMUP_RECENT_USERS", "200"))
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "30"))
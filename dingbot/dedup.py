@@ -0,0 +1,281 @@
+"""Bounded TTL caches used to make webhook deliveries idempotent.
+
+DingTalk re-delivers callbacks it considers slow. Each delivery is keyed by the
+payload's `msgId`, or, when that is missing, by a fingerprint of sender, content and
+creation time (or, without one, the time the same content was first seen). The first
+delivery is processed normally and its response stored; later deliveries of the same
+key get the stored response (or a fast ack while the first one is still in flight)
+instead of re-running the pipeline.
+
+`DedupCache` keeps this in the process. `SharedDedupCache` keeps it in a SQLite file
+(DEDUP_DB), so a redelivery that lands on another gunicorn worker is still recognised.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+PENDING = object()
+
+
+# sender+content hash -> when it was first seen without a createAt (wall clock), oldest first
+_first_seen: "OrderedDict[str, float]" = OrderedDict()
+_first_seen_lock = threading.Lock()
+
+
+def _first_seen_at(content_hash: str, now: float) -> float:
+    """When `content_hash` was first seen, if that is within DEDUP_FALLBACK_WINDOW_SECONDS
+    of `now`; otherwise `now` becomes its new first-seen time."""
+    window = max(1, config.DEDUP_FALLBACK_WINDOW_SECONDS)
+    with _first_seen_lock:
+        first = _first_seen.get(content_hash)
+        if first is not None and now - first < window:
+            return first
+        _first_seen[content_hash] = now
+        _first_seen.move_to_end(content_hash)
+        while len(_first_seen) > max(1, config.DEDUP_MAX_ENTRIES) or (
+            _first_seen and now - next(iter(_first_seen.values())) >= window
+        ):
+            _first_seen.popitem(last=False)
+        return now
+
+
+def message_key(data: Dict[str, Any], first_seen: Callable[[str, float], float] = _first_seen_at) -> Optional[str]:
+    """Stable dedup key for a webhook payload, or None if it cannot be identified.
+
+    `first_seen(content_hash, now)` gives the start of the fallback window; pass the
+    cache's `first_seen_at` so that workers sharing a cache agree on it.
+    """
+    msg_id = data.get("msgId") or data.get("msgid")
+    if msg_id:
+        return f"id:{msg_id}"
+    sender = data.get("senderId") or data.get("senderStaffId") or data.get("userid") or data.get("senderNick")
+    content = (data.get("text") or {}).get("content")
+    if not sender or content is None:
+        return None
+    created = data.get("createAt")
+    if not created:
+        # no creation time in the payload: identical messages within the fallback window
+        # of the first one are one delivery
+        content_hash = hashlib.sha1(f"{sender}\x00{content}".encode("utf-8")).hexdigest()
+        created = "s%r" % first_seen(content_hash, time.time())
+    digest = hashlib.sha1(f"{sender}\x00{content}\x00{created}".encode("utf-8")).hexdigest()
+    return f"fp:{digest}"
+
+
+class DedupCache:
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 300):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _purge(self, now: float) -> None:
+        # entries are kept in insertion order and share one TTL, so expired ones are at the front
+        while self._entries:
+            key, (expires, _) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def begin(self, key: str) -> Tuple[bool, Any]:
+        """Claim `key`. Returns (True, None) for a new key; (False, result) for a duplicate,
+        where result is the stored result or `PENDING` if the first delivery is in flight."""
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return False, entry[1]
+            self.misses += 1
+            self._entries[key] = (now + self.ttl, PENDING)
+            self._purge(now)
+            return True, None
+
+    def complete(self, key: str, result: Any) -> None:
+        with self._lock:
+            if key in self._entries:
+                expires, _ = self._entries[key]
+                self._entries[key] = (expires, result)
+
+    def forget(self, key: str) -> None:
+        """Drop `key` so a later delivery is processed again (e.g. after a failure)."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def first_seen_at(self, content_hash: str, now: float) -> float:
+        return _first_seen_at(content_hash, now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+class SharedDedupCache:
+    """`DedupCache` kept in a SQLite file, so every worker process using it sees the
+    same deliveries.
+
+    Stored results must be `(body, status, mimetype)` response tuples. Expiry uses wall
+    clock time. If the file cannot be used, a delivery is treated as new (it may then be
+    processed twice, rather than dropped). Hit/miss counters are per process.
+    """
+
+    _create_sql = (
+        "CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, expires REAL NOT NULL,"
+        " body BLOB, status INTEGER, mimetype TEXT)",
+        "CREATE INDEX IF NOT EXISTS deliveries_expires ON deliveries (expires)",
+        "CREATE TABLE IF NOT EXISTS first_seen (hash TEXT PRIMARY KEY, first REAL NOT NULL)",
+    )
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl_seconds: float = 300):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # one connection per process: a connection must not be used across a fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            for sql in self._create_sql:
+                conn.execute(sql)
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def _transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return result
+
+    def begin(self, key: str) -> Tuple[bool, Any]:
+        now = time.time()
+
+        def claim(conn):
+            conn.execute("DELETE FROM deliveries WHERE expires <= ?", (now,))
+            row = conn.execute("SELECT body, status, mimetype FROM deliveries WHERE key=?", (key,)).fetchone()
+            if row is not None:
+                return False, PENDING if row[1] is None else (row[0], row[1], row[2])
+            conn.execute("INSERT INTO deliveries (key, expires) VALUES (?, ?)", (key, now + self.ttl))
+            conn.execute(
+                "DELETE FROM deliveries WHERE key IN (SELECT key FROM deliveries ORDER BY expires"
+                " LIMIT max(0, (SELECT count(*) FROM deliveries) - ?))",
+                (self.max_entries,),
+            )
+            return True, None
+
+        try:
+            is_new, result = self._transaction(claim)
+        except sqlite3.Error:
+            logger.warning("Dedup store %s unavailable", self.path, exc_info=True)
+            return True, None
+        with self._lock:
+            if is_new:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return is_new, result
+
+    def complete(self, key: str, result: Any) -> None:
+        body, status, mimetype = result
+        self._write("UPDATE deliveries SET body=?, status=?, mimetype=? WHERE key=?", (body, status, mimetype, key))
+
+    def forget(self, key: str) -> None:
+        self._write("DELETE FROM deliveries WHERE key=?", (key,))
+
+    def first_seen_at(self, content_hash: str, now: float) -> float:
+        window = max(1, config.DEDUP_FALLBACK_WINDOW_SECONDS)
+
+        def lookup(conn):
+            row = conn.execute("SELECT first FROM first_seen WHERE hash=?", (content_hash,)).fetchone()
+            if row is not None and now - row[0] < window:
+                return row[0]
+            conn.execute("DELETE FROM first_seen WHERE first <= ?", (now - window,))
+            conn.execute(
+                "INSERT INTO first_seen (hash, first) VALUES (?, ?)"
+                " ON CONFLICT(hash) DO UPDATE SET first=excluded.first",
+                (content_hash, now),
+            )
+            return now
+
+        try:
+            return self._transaction(lookup)
+        except sqlite3.Error:
+            logger.warning("Dedup store %s unavailable", self.path, exc_info=True)
+            return _first_seen_at(content_hash, now)
+
+    def _write(self, sql: str, args: Tuple) -> None:
+        try:
+            with self._lock:
+                self._db().execute(sql, args)
+        except sqlite3.Error:
+            logger.warning("Dedup store %s unavailable", self.path, exc_info=True)
+
+    def clear(self) -> None:
+        self._write("DELETE FROM deliveries", ())
+        self._write("DELETE FROM first_seen", ())
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            with self._lock:
+                size = self._db().execute("SELECT count(*) FROM deliveries WHERE expires > ?", (time.time(),)).fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": size,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "shared": True,
+            }
+
+
+def from_config():
+    """The webhook dedup cache: shared through DEDUP_DB when set, otherwise per process."""
+    if config.DEDUP_DB:
+        return SharedDedupCache(config.DEDUP_DB, config.DEDUP_MAX_ENTRIES, config.DEDUP_TTL_SECONDS)
+    return DedupCache(config.DEDUP_MAX_ENTRIES, config.DEDUP_TTL_SECONDS)
@@ -1,28 +1,40 @@
 import json
 import os
-import threading
 from typing import Dict, List, Any
 
+from .filelock import FileLock
+
 FACTS_FILE = os.environ.get("FACTS_FILE", "dingbot_fact.json")
-_lock = threading.Lock()
+# shared with other worker processes through FACTS_FILE + ".lock"
+_lock = FileLock(lambda: FACTS_FILE)
 
 
-def load_all_facts() -> Dict[str, List[Any]]:
+def _load_unlocked() -> Dict[str, List[Any]]:
     if not os.path.exists(FACTS_FILE):
         return {}
-    with _lock:
-        with open(FACTS_FILE, "r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return {}
+    with open(FACTS_FILE, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except Exception:
+            return {}
+
+
+def load_all_facts() -> Dict[str, List[Any]]:
+    with _lock.shared():
+        return _load_unlocked()
 
 
 def set_user_facts(user_id: str, facts: List[Dict[str, Any]]):
-    data = load_all_facts()
-    data[user_id] = facts
-    tmp = FACTS_FILE + ".tmp"
-    with _lock:
+    set_many_facts({user_id: facts})
+
+
+def set_many_facts(user_facts: Dict[str, List[Dict[str, Any]]]):
+    """Replace the facts of several users in one rewrite of the file."""
+    # hold the lock across read-modify-write so concurrent writers don't drop each other's users
+    with _lock.exclusive():
+        data = _load_unlocked()
+        data.update(user_facts)
+        tmp = FACTS_FILE + ".tmp"
         with open(tmp, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
         os.replace(tmp, FACTS_FILE)
@@ -0,0 +1,90 @@
+"""Cross-process file locks for the file-backed stores.
+
+`FileLock` combines an in-process reentrant lock with an `fcntl.flock` on a sidecar
+`<path>.lock` file, so JSONL/JSON stores stay consistent when several worker
+processes share them. Readers take a shared lock, writers an exclusive one.
+On platforms without `fcntl` only the in-process lock is used.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+from typing import Callable, IO, Optional, Union
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None  # type: ignore
+    FCNTL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    def __init__(self, path: Union[str, Callable[[], str]]):
+        # `path` may be a callable so the lock follows a module-level path that can change
+        self._path = path
+        self._tlock = threading.RLock()
+        self._local = threading.local()
+
+    def lock_path(self) -> str:
+        path = self._path() if callable(self._path) else self._path
+        return path + ".lock"
+
+    @contextlib.contextmanager
+    def _hold(self, mode: int):
+        with self._tlock:
+            depth = getattr(self._local, "depth", 0)
+            if depth or not FCNTL_AVAILABLE:
+                # nested use in the same thread: the outer level holds the file lock
+                self._local.depth = depth + 1
+                try:
+                    yield
+                finally:
+                    self._local.depth = depth
+                return
+            f = open(self.lock_path(), "a+")
+            try:
+                fcntl.flock(f.fileno(), mode)
+                self._local.depth = 1
+                try:
+                    yield
+                finally:
+                    self._local.depth = 0
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            finally:
+                f.close()
+
+    def shared(self):
+        """Context manager for readers."""
+        return self._hold(fcntl.LOCK_SH if FCNTL_AVAILABLE else 0)
+
+    def exclusive(self):
+        """Context manager for writers."""
+        return self._hold(fcntl.LOCK_EX if FCNTL_AVAILABLE else 0)
+
+
+def try_lock_exclusive(path: str) -> Optional[IO]:
+    """Take a host-wide exclusive lock on `path` without blocking.
+
+    Returns the open lock file (keep it referenced for as long as the lock should be
+    held), or None if another process holds it. Always succeeds without `fcntl`.
+    """
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    f = open(path, "a+")
+    if not FCNTL_AVAILABLE:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
@@ -0,0 +1,14 @@
+# gunicorn settings for `gunicorn -c dingbot/gunicorn.conf.py dingbot.wsgi:app`
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+# threads per worker: webhook requests mostly wait on the model / DingTalk
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "8"))
+timeout = int(os.environ.get("WEB_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+errorlog = "-"
@@ -0,0 +1,26 @@
+"""Stable hashing helpers shared by the sharding code.
+
+Python's built-in `hash()` is salted per process, so anything that must map a key to
+the same node in every process (and after restarts) uses these instead.
+"""
+
+import hashlib
+from typing import Hashable, Optional, Sequence, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+
+def stable_hash(key: str) -> int:
+    """64-bit hash of `key` that is identical across processes and runs."""
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def rendezvous(key: str, nodes: Sequence[T]) -> Optional[T]:
+    """Highest-random-weight choice of a node for `key`.
+
+    Removing a node only moves the keys that were on it; adding one only takes over
+    about 1/n of the keys.
+    """
+    if not nodes:
+        return None
+    return max(nodes, key=lambda n: stable_hash(f"{n}\0{key}"))
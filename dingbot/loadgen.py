@@ -0,0 +1,347 @@
+"""Load generator for the webhook, with a local stand-in for the DingTalk robot API.
+
+    # 1) the stand-in for oapi.dingtalk.com records every robot send
+    python -m dingbot.loadgen fake-dingtalk --port 9100
+    # 2) the bot under test sends to it
+    DINGTALK_API_BASE=http://127.0.0.1:9100 ACCESS_TOKEN=t SECRET=s python -m dingbot.server
+    # 3) offered load: 20 msg/s over 500 users in 20 groups, plus a burst of 50 every 10s
+    python -m dingbot.loadgen run --rate 20 --duration 60 --users 500 --groups 20 \\
+        --burst-size 50 --burst-every 10 --fake-stats http://127.0.0.1:9100
+
+`run` is open-loop: messages go out at their planned arrival times (Poisson arrivals at
+`--rate`, plus bursts) on `--concurrency` client threads, whether or not earlier
+requests have returned; `lag` in the report shows how far sends fell behind the plan.
+`--replay FILE` posts recorded webhook payloads (one JSON object per line) instead of
+generated ones, at their recorded spacing (`createAt`) with `--replay-timing`. The report
+(stdout, or `--out`) has throughput, latency percentiles, error rates and, with
+`--fake-stats`, what the stand-in received.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# what a group chat sends: mostly ordinary messages, some commands
+_MESSAGES = [
+    "今天天气怎么样？", "提醒我明天早上九点开会", "我最近在学吉他", "周末有什么推荐的电影吗", "我喜欢喝咖啡",
+    "帮我总结一下刚才的讨论", "晚上吃什么好", "我下周要去上海出差", "这个bug怎么修", "谢谢！",
+]
+_COMMANDS = ["/ping", "/time", "/memories", "/help", "/remember 3600 喝水"]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def _latency_summary(samples: List[float]) -> Dict[str, float]:
+    s = sorted(samples)
+    out = {f"p{int(q * 100)}_ms": round(percentile(s, q) * 1000, 2) for q in (0.5, 0.9, 0.99)}
+    out["max_ms"] = round((s[-1] if s else 0.0) * 1000, 2)
+    out["mean_ms"] = round(sum(s) / len(s) * 1000, 2) if s else 0.0
+    return out
+
+
+def make_fake_dingtalk(port: int = 9100, host: str = "127.0.0.1", latency: float = 0.0,
+                       rate_per_minute: float = 0.0):
+    """Build a stand-in for the robot send API that records what it receives.
+
+    With `rate_per_minute` it answers errcode 130101 like DingTalk when a robot (access
+    token) sends faster than that. Stats are served on GET /stats.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    from .ratelimit import TokenBucket
+
+    lock = threading.Lock()
+    state: Dict[str, Any] = {"received": 0, "throttled": 0, "by_robot": {}, "by_msgtype": {}, "first": None, "last": None}
+    buckets: Dict[str, TokenBucket] = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int, data: dict):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/stats":
+                return self._reply(404, {"errcode": 404})
+            self._reply(200, stats())
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length)
+            if url.path != "/robot/send":
+                return self._reply(404, {"errcode": 404})
+            token = (parse_qs(url.query).get("access_token") or [""])[0]
+            try:
+                msgtype = json.loads(raw or b"{}").get("msgtype")
+            except ValueError:
+                return self._reply(400, {"errcode": 40035, "errmsg": "invalid json"})
+            if latency:
+                time.sleep(latency)
+            now = time.time()
+            with lock:
+                if rate_per_minute > 0:
+                    bucket = buckets.setdefault(token, TokenBucket(rate_per_minute / 60.0, max(1, rate_per_minute / 3)))
+                    if not bucket.try_take(1):
+                        state["throttled"] += 1
+                        throttled = True
+                    else:
+                        throttled = False
+                else:
+                    throttled = False
+                if not throttled:
+                    state["received"] += 1
+                    state["by_robot"][token] = state["by_robot"].get(token, 0) + 1
+                    state["by_msgtype"][msgtype] = state["by_msgtype"].get(msgtype, 0) + 1
+                    state["first"] = state["first"] or now
+                    state["last"] = now
+            if throttled:
+                return self._reply(200, {"errcode": 130101, "errmsg": "send too fast"})
+            self._reply(200, {"errcode": 0, "errmsg": "ok"})
+
+        def log_message(self, *args):
+            pass
+
+    def stats() -> dict:
+        with lock:
+            data = dict(state, by_robot=dict(state["by_robot"]), by_msgtype=dict(state["by_msgtype"]))
+        if data["first"] is not None and data["last"] > data["first"]:
+            data["per_second"] = round(data["received"] / (data["last"] - data["first"]), 2)
+        return data
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.stats = stats
+    return server
+
+
+def generate_payloads(users: int = 100, groups: int = 10, command_ratio: float = 0.1,
+                      seed: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Endless stream of webhook payloads shaped like DingTalk's outgoing callbacks."""
+    rnd = random.Random(seed)
+    user_group = {u: rnd.randrange(max(1, groups)) for u in range(max(1, users))}
+    while True:
+        u = rnd.randrange(max(1, users))
+        content = rnd.choice(_COMMANDS) if rnd.random() < command_ratio else rnd.choice(_MESSAGES)
+        yield {
+            "msgtype": "text",
+            "msgId": f"load-{uuid.uuid4().hex}",
+            "createAt": int(time.time() * 1000),
+            "conversationType": "2",
+            "conversationId": f"cid-load-{user_group[u]}",
+            "senderId": f"load-user-{u}",
+            "senderStaffId": f"load-user-{u}",
+            "senderNick": f"用户{u}",
+            "text": {"content": f" {content}"},
+        }
+
+
+def read_replay(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def plan_arrivals(rate: float, duration: float, burst_size: int = 0, burst_every: float = 0.0,
+                  seed: Optional[int] = None) -> List[float]:
+    """Send offsets (seconds from start): Poisson arrivals at `rate`/s plus periodic bursts."""
+    rnd = random.Random(seed)
+    times: List[float] = []
+    t = 0.0
+    while rate > 0:
+        t += rnd.expovariate(rate)
+        if t >= duration:
+            break
+        times.append(t)
+    if burst_size > 0 and burst_every > 0:
+        b = burst_every
+        while b < duration:
+            times.extend([b] * burst_size)
+            b += burst_every
+    return sorted(times)
+
+
+def _replay_arrivals(payloads: List[Dict[str, Any]], speed: float) -> List[float]:
+    stamps = [p.get("createAt") or 0 for p in payloads]
+    base = stamps[0] if stamps else 0
+    return [max(0.0, (s - base) / 1000.0 / max(speed, 1e-9)) for s in stamps]
+
+
+def run_load(target: str, arrivals: List[float], payloads, concurrency: int = 32,
+             timeout: float = 30.0, unique_ids: bool = False) -> Dict[str, Any]:
+    """Post `payloads` to `target` at the planned `arrivals` and return the report."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=concurrency))
+    session.mount("https://", HTTPAdapter(pool_maxsize=concurrency))
+    lock = threading.Lock()
+    latencies: List[float] = []
+    lags: List[float] = []
+    statuses: Dict[str, int] = {}
+    errcodes: Dict[str, int] = {}
+    rejected: Dict[str, int] = {}
+    ok = [0]
+
+    def post(planned: float, payload: Dict[str, Any]):
+        lag = time.perf_counter() - planned
+        start = time.perf_counter()
+        try:
+            r = session.post(target, json=payload, timeout=timeout)
+            status = str(r.status_code)
+            degraded = r.headers.get("X-DingBot-Degraded")
+            errcode = None
+            if r.headers.get("Content-Type", "").startswith("application/json"):
+                # commands answer JSON; ordinary replies and busy answers are plain text
+                try:
+                    errcode = str(r.json().get("errcode"))
+                except ValueError:
+                    errcode = "invalid-json"
+        except requests.RequestException as exc:
+            status, errcode, degraded = type(exc).__name__, None, None
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            lags.append(lag)
+            statuses[status] = statuses.get(status, 0) + 1
+            if errcode is not None:
+                errcodes[errcode] = errcodes.get(errcode, 0) + 1
+            if degraded:
+                # admission control answered with the busy reply
+                rejected[degraded] = rejected.get(degraded, 0) + 1
+            elif status == "200" and errcode in (None, "0"):
+                ok[0] += 1
+
+    source = iter(payloads)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="loadgen") as pool:
+        for offset in arrivals:
+            try:
+                payload = next(source)
+            except StopIteration:
+                break
+            if unique_ids:
+                # replaying the same file twice must not hit the webhook's duplicate-delivery cache
+                payload = dict(payload, msgId=f"{payload.get('msgId', 'replay')}-{uuid.uuid4().hex[:8]}")
+            planned = start + offset
+            delay = planned - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(post, planned, payload)
+    elapsed = time.perf_counter() - start
+    sent = len(latencies)
+    n_ok = ok[0]
+    return {
+        "target": target,
+        "sent": sent,
+        "seconds": round(elapsed, 3),
+        "offered_per_second": round(len(arrivals) / max(arrivals[-1], 1e-9), 2) if arrivals else 0.0,
+        "throughput_per_second": round(sent / max(elapsed, 1e-9), 2),
+        "ok": n_ok,
+        # anything but a normal answer, including busy replies from admission control
+        "error_rate": round(1 - n_ok / sent, 4) if sent else 0.0,
+        "status": statuses,
+        "errcode": errcodes,
+        "rejected": rejected,
+        "latency": _latency_summary(latencies),
+        "lag": _latency_summary(lags),
+    }
+
+
+def _fetch_fake_stats(base: str) -> Optional[dict]:
+    import requests
+
+    try:
+        return requests.get(base.rstrip("/") + "/stats", timeout=5).json()
+    except Exception as exc:
+        logger.warning("Loadgen: could not read stand-in stats from %s: %s", base, exc)
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="DingBot load generator")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    fake = sub.add_parser("fake-dingtalk", help="run the local stand-in for oapi.dingtalk.com")
+    fake.add_argument("--host", default="127.0.0.1")
+    fake.add_argument("--port", type=int, default=9100)
+    fake.add_argument("--latency", type=float, default=0.0, help="seconds added to every send")
+    fake.add_argument("--rate-per-minute", type=float, default=0.0,
+                      help="answer errcode 130101 above this many sends per robot (0 = never)")
+
+    run = sub.add_parser("run", help="post webhook traffic and report")
+    run.add_argument("--target", default="http://127.0.0.1:8080/webhook")
+    run.add_argument("--rate", type=float, default=10.0, help="mean arrivals per second")
+    run.add_argument("--duration", type=float, default=30.0, help="seconds of traffic")
+    run.add_argument("--burst-size", type=int, default=0, help="extra messages sent at once every --burst-every")
+    run.add_argument("--burst-every", type=float, default=0.0)
+    run.add_argument("--users", type=int, default=100)
+    run.add_argument("--groups", type=int, default=10)
+    run.add_argument("--command-ratio", type=float, default=0.1, help="share of /commands")
+    run.add_argument("--replay", help="JSONL file of recorded webhook payloads")
+    run.add_argument("--replay-timing", action="store_true", help="keep the recorded spacing (createAt)")
+    run.add_argument("--speed", type=float, default=1.0, help="replay time compression factor")
+    run.add_argument("--concurrency", type=int, default=32)
+    run.add_argument("--timeout", type=float, default=30.0)
+    run.add_argument("--seed", type=int)
+    run.add_argument("--fake-stats", help="base URL of the stand-in, to include what it received")
+    run.add_argument("--out", help="write the JSON report here instead of stdout")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.cmd == "fake-dingtalk":
+        server = make_fake_dingtalk(args.port, args.host, args.latency, args.rate_per_minute)
+        logger.info("Loadgen: DingTalk stand-in listening on http://%s:%s (stats on /stats)", args.host, args.port)
+        server.serve_forever()
+        return 0
+
+    before = _fetch_fake_stats(args.fake_stats) if args.fake_stats else None
+    if args.replay:
+        payloads = read_replay(args.replay)
+        if args.replay_timing:
+            arrivals = _replay_arrivals(payloads, args.speed)
+        else:
+            arrivals = [i / args.rate for i in range(len(payloads))] if args.rate > 0 else [0.0] * len(payloads)
+        report = run_load(args.target, arrivals, payloads, args.concurrency, args.timeout, unique_ids=True)
+    else:
+        arrivals = plan_arrivals(args.rate, args.duration, args.burst_size, args.burst_every, args.seed)
+        payloads = generate_payloads(args.users, args.groups, args.command_ratio, args.seed)
+        report = run_load(args.target, arrivals, payloads, args.concurrency, args.timeout)
+    if args.fake_stats:
+        # sends may still be draining from the bot's outbound queue
+        after = _fetch_fake_stats(args.fake_stats)
+        if before is not None and after is not None:
+            report["dingtalk"] = {"received": after["received"] - before["received"],
+                                  "throttled": after["throttled"] - before["throttled"]}
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,191 @@
+"""Logging setup for the server processes.
+
+`configure()` replaces the plain `logging.basicConfig` call:
+
+- `LOG_FORMAT=json` writes one JSON object per record (time, level, logger, message,
+  request id of the current trace and any `extra=` fields); `text` keeps the classic format.
+- `LOG_SAMPLE="dingbot.server=0.1,werkzeug=0.05"` keeps only that fraction of
+  INFO/DEBUG records from those loggers (and their children); warnings always pass.
+- `LOG_ASYNC=1` puts a bounded queue in front of the real handler, so request threads
+  only enqueue records; formatting and writing happen on a listener thread, and records
+  are dropped (and counted) instead of blocking when the queue is full.
+
+`Payload(data)` wraps a webhook payload for logging: it is only serialized if the record
+is actually emitted, with secret-looking keys (`LOG_REDACT_KEYS`) masked and the output
+truncated to `LOG_PAYLOAD_MAX_CHARS`.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Any, Dict, Optional
+
+from . import config, tracing
+
+REDACTED = "***"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_configured = False
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in (spec or "").split(","):
+        name, sep, rate = part.strip().partition("=")
+        if not sep or not name:
+            continue
+        try:
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+def _redact(obj: Any, keys) -> Any:
+    if isinstance(obj, dict):
+        return {k: REDACTED if any(f in str(k).lower() for f in keys) else _redact(v, keys) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_redact(v, keys) for v in obj]
+    return obj
+
+
+class Payload:
+    """Lazily serialized, redacted and truncated view of a payload for log messages."""
+
+    __slots__ = ("data", "max_chars")
+
+    def __init__(self, data: Any, max_chars: Optional[int] = None):
+        self.data = data
+        self.max_chars = config.LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self) -> str:
+        keys = [k.strip().lower() for k in config.LOG_REDACT_KEYS.split(",") if k.strip()]
+        try:
+            text = json.dumps(_redact(self.data, keys), ensure_ascii=False, default=str)
+        except Exception:
+            text = repr(self.data)
+        if self.max_chars and len(text) > self.max_chars:
+            text = f"{text[:self.max_chars]}...(+{len(text) - self.max_chars} chars)"
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of sub-WARNING records from the configured loggers."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        # longest prefix first so "dingbot.server" beats "dingbot"
+        self.rates = sorted(rates.items(), key=lambda kv: -len(kv[0]))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        for prefix, rate in self.rates:
+            if name == prefix or name.startswith(prefix + "."):
+                return rate >= 1 or (rate > 0 and random.random() < rate)
+        return True
+
+
+class ContextFilter(logging.Filter):
+    """Attach the current request id while still on the calling thread."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = tracing.current_request_id()
+        return True
+
+
+_STD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            out["request_id"] = record.request_id
+        for k, v in record.__dict__.items():
+            if k not in _STD_ATTRS and not k.startswith("_"):
+                out[k] = v
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks: records are dropped when the queue is full.
+
+    Unlike the stdlib handler it does not format in the caller's thread; the listener
+    thread formats (and serializes lazy payloads) instead.
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(force: bool = False) -> logging.Handler:
+    """Install the root handler from LOG_* settings (once per process unless `force`)."""
+    global _listener, _configured
+    root = logging.getLogger()
+    if _configured and not force:
+        return root.handlers[0] if root.handlers else None
+    if root.handlers and not force:
+        # somebody (a test runner, gunicorn config) already set up logging
+        _configured = True
+        return root.handlers[0]
+    shutdown()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+
+    target = logging.StreamHandler(sys.stderr)
+    if config.LOG_FORMAT == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    if config.LOG_ASYNC:
+        handler: logging.Handler = DroppingQueueHandler(queue.Queue(maxsize=max(1, config.LOG_QUEUE_MAX)))
+        _listener = logging.handlers.QueueListener(handler.queue, target, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+    else:
+        handler = target
+    handler.addFilter(SamplingFilter(_parse_rates(config.LOG_SAMPLE)))
+    handler.addFilter(ContextFilter())
+    root.addHandler(handler)
+    root.setLevel(config.LOG_LEVEL)
+    _configured = True
+    return handler
+
+
+def shutdown() -> None:
+    """Flush and stop the async listener, if any."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats() -> dict:
+    handlers = logging.getLogger().handlers
+    dropped = sum(getattr(h, "dropped", 0) for h in handlers)
+    return {"format": config.LOG_FORMAT, "async": _listener is not None, "dropped": dropped}
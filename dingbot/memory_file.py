@@ -1,12 +1,31 @@
 import json
+import logging
 import os
-import threading
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional
+
+from .filelock import FileLock
+from . import tracing
 
 MEMORY_FILE = os.environ.get("MEMORY_FILE", "dingbot_memory.jsonl")
-_lock = threading.Lock()
+# shared with other worker processes through MEMORY_FILE + ".lock"
+_lock = FileLock(lambda: MEMORY_FILE)
+_listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+logger = logging.getLogger(__name__)
+
+
+def subscribe(callback: Callable[[Dict[str, Any]], None]) -> None:
+    """Register `callback(entry)` to be called after each appended message (in this process)."""
+    if callback not in _listeners:
+        _listeners.append(callback)
+
 
-def append_user_message(user_id: str, content: str, timestamp: int = None):
+def unsubscribe(callback: Callable[[Dict[str, Any]], None]) -> None:
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def append_user_message(user_id: str, content: str, timestamp: int = None, sender_name: str = None):
     """Append a user message to the memory file."""
     import time
     entry = {
@@ -14,16 +33,23 @@ def append_user_message(user_id: str, content: str, timestamp: int = None):
         "content": content,
         "timestamp": timestamp or int(time.time())
     }
-    with _lock:
+    if sender_name:
+        entry["sender_name"] = sender_name
+    with tracing.span("memory_file.append"), _lock.exclusive():
         with open(MEMORY_FILE, "a", encoding="utf-8") as f:
             f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    for cb in list(_listeners):
+        try:
+            cb(entry)
+        except Exception:
+            logger.exception("memory_file: append listener %r failed", cb)
 
 def get_user_memories(user_id: str, limit: int = 20) -> List[Dict[str, Any]]:
     """Get recent messages for a user from the memory file."""
     if not os.path.exists(MEMORY_FILE):
         return []
     result = []
-    with _lock:
+    with tracing.span("memory_file.scan", op="get_user_memories"), _lock.shared():
         with open(MEMORY_FILE, "r", encoding="utf-8") as f:
             lines = [l for l in f if l.strip()]
             for line in reversed(lines):
@@ -43,7 +69,7 @@ def list_users() -> List[str]:
     if not os.path.exists(MEMORY_FILE):
         return []
     users = set()
-    with _lock:
+    with tracing.span("memory_file.scan", op="list_users"), _lock.shared():
         with open(MEMORY_FILE, "r", encoding="utf-8") as f:
             for line in f:
                 try:
@@ -54,3 +80,27 @@ def list_users() -> List[str]:
                 except Exception:
                     continue
     return sorted(users)
+
+
+def get_user_messages(user_id: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Get a user's messages in chronological order, skipping the first `offset`."""
+    if not os.path.exists(MEMORY_FILE):
+        return []
+    result = []
+    seen = 0
+    with tracing.span("memory_file.scan", op="get_user_messages"), _lock.shared():
+        with open(MEMORY_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except Exception:
+                    continue
+                if entry.get("user_id") != user_id:
+                    continue
+                seen += 1
+                if seen <= offset:
+                    continue
+                result.append(entry)
+                if limit is not None and len(result) >= limit:
+                    break
+    return result
@@ -0,0 +1,292 @@
+"""In-process metrics with Prometheus text exposition (no client library needed).
+
+Usage:
+    REQUESTS = metrics.counter("dingbot_x_total", "help text")
+    REQUESTS.inc(kind="command")
+    with STAGE_SECONDS.time(stage="prompt_build"):
+        ...
+    metrics.render()  # -> text for the /metrics endpoint
+
+Each metric keeps one small dict of label-values -> numbers guarded by a lock, so
+recording on the hot path is a dict update. Values are per process.
+
+With several processes (gunicorn workers, the scheduler) a scrape only reaches one of
+them. Processes that share a directory can call `start_snapshots(directory)`: each then
+writes its values to `metrics-<host>-<pid>.json` there every few seconds, and
+`render(directory)` returns the series of every live process, labelled `process`.
+"""
+
+import bisect
+import contextlib
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: Dict[str, "_Metric"] = {}
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels: Dict[str, object]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(key: Tuple[Tuple[str, str], ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        return [f"{name}{_fmt_labels(key)} {_fmt_value(v)}" for name, key, v in self._rows()]
+
+    def _rows(self) -> List[Tuple[str, tuple, float]]:
+        """(sample name, label key, value) for every sample."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def _rows(self) -> List[Tuple[str, tuple, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, k, v) for k, v in items]
+
+
+class Gauge(_Metric):
+    """A gauge read from a callback at scrape time (e.g. a queue depth)."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def _rows(self) -> List[Tuple[str, tuple, float]]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [(self.name, (), value)]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [bucket counts..., count, sum]
+        self._values: Dict[tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            row = self._values.get(_label_key(labels))
+            return int(row[-2]) if row else 0
+
+    def _rows(self) -> List[Tuple[str, tuple, float]]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        rows = []
+        for key, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                rows.append((f"{self.name}_bucket", key + (("le", _fmt_value(bound)),), int(cumulative)))
+            rows.append((f"{self.name}_bucket", key + (("le", "+Inf"),), int(row[-2])))
+            rows.append((f"{self.name}_count", key, int(row[-2])))
+            rows.append((f"{self.name}_sum", key, float(row[-1])))
+        return rows
+
+
+def _register(metric: _Metric) -> _Metric:
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None and type(existing) is type(metric) and not isinstance(metric, Gauge):
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name: str, help: str) -> Counter:
+    return _register(Counter(name, help))
+
+
+def histogram(name: str, help: str, buckets: Optional[Sequence[float]] = None) -> Histogram:
+    return _register(Histogram(name, help, buckets or DEFAULT_BUCKETS))
+
+
+def gauge(name: str, help: str, fn: Callable[[], float]) -> Gauge:
+    """Register (or replace) a callback gauge."""
+    return _register(Gauge(name, help, fn))
+
+
+def render(directory: Optional[str] = None) -> str:
+    """Prometheus text for this process, or for every process snapshotting to `directory`."""
+    if directory:
+        return _render_snapshots(directory)
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines: List[str] = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+_process = f"{socket.gethostname()}:{os.getpid()}"
+_snapshot_every = 5.0
+_snapshot_pid: Optional[int] = None
+
+
+def _process_id() -> str:
+    global _process
+    # the pid part must follow a fork
+    if not _process.endswith(f":{os.getpid()}"):
+        _process = f"{socket.gethostname()}:{os.getpid()}"
+    return _process
+
+
+def write_snapshot(directory: str) -> str:
+    """Write this process's current values to `directory`; returns the file path."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    data: Dict[str, Any] = {
+        "process": _process_id(),
+        "time": time.time(),
+        "metrics": [{"name": m.name, "type": m.type, "help": m.help,
+                     "rows": [[n, list(k), v] for n, k, v in m._rows()]} for m in metrics],
+    }
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "metrics-%s.json" % data["process"].replace(":", "-"))
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+    return path
+
+
+def _render_snapshots(directory: str) -> str:
+    write_snapshot(directory)
+    # a process that stopped writing (exited or was replaced) drops out
+    stale = time.time() - max(60.0, 3 * _snapshot_every)
+    families: Dict[str, Dict[str, Any]] = {}
+    for path in sorted(glob.glob(os.path.join(directory, "metrics-*.json"))):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if data.get("time", 0) < stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        process = [("process", str(data.get("process")))]
+        for m in data.get("metrics", []):
+            family = families.setdefault(m["name"], {"type": m["type"], "help": m["help"], "lines": []})
+            for name, key, value in m["rows"]:
+                family["lines"].append(f"{name}{_fmt_labels(tuple(map(tuple, key)), process)} {_fmt_value(value)}")
+    lines: List[str] = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        lines.extend(family["lines"])
+    return "\n".join(lines) + "\n"
+
+
+def start_snapshots(directory: str, every: float = 5.0) -> None:
+    """Write this process's snapshot to `directory` now and every `every` seconds."""
+    global _snapshot_every, _snapshot_pid
+    if _snapshot_pid == os.getpid():
+        return
+    _snapshot_every = max(0.5, float(every))
+    _snapshot_pid = os.getpid()
+
+    def loop():
+        while True:
+            try:
+                write_snapshot(directory)
+            except Exception:
+                logger.exception("Metrics: failed to write snapshot to %s", directory)
+            time.sleep(_snapshot_every)
+
+    threading.Thread(target=loop, name="dingbot-metrics-snapshot", daemon=True).start()
+
+
+# Shared pipeline metrics
+STAGE_SECONDS = histogram(
+    "dingbot_stage_duration_seconds",
+    "Duration of pipeline stages (webhook_parse, history_load, prompt_build, json_parse, dingtalk_send).",
+)
+MODEL_CALL_SECONDS = histogram(
+    "dingbot_model_call_duration_seconds",
+    "Duration of model calls by call site and configured model.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 6.0, 8.0, 10.0, 15.0, 30.0),
+)
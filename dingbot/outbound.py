@@ -0,0 +1,258 @@
+"""Rate-limited, prioritized outbound message queue.
+
+A DingTalk custom robot accepts only about 20 messages per minute and rejects faster
+senders (errcode 130101). `OutboundQueue` keeps one token bucket per robot and a
+priority heap per robot, so interactive replies (`PRIORITY_REPLY`) go out before
+scheduled pushes (`PRIORITY_PUSH`) and no robot is sent to faster than its bucket
+allows. A dispatcher thread hands ready messages to a pool of `concurrency` sender
+threads, so several robots are sent to in parallel while each robot gets one message
+at a time (in order). Throttled sends are put back with a backoff. `submit` returns a
+`concurrent.futures.Future` for the send result.
+
+The buckets are per queue unless `bucket_factory` returns shared ones (see
+`ratelimit.SharedTokenBucket`), which is how several worker processes sending to the
+same robot stay under its limit together.
+"""
+
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from . import metrics
+from .ratelimit import TokenBucket
+from .workqueue import QueueFull
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_REPLY = 0
+PRIORITY_PUSH = 1
+PRIORITY_NAMES = {PRIORITY_REPLY: "reply", PRIORITY_PUSH: "push"}
+
+WAIT_SECONDS = metrics.histogram(
+    "dingbot_outbound_wait_seconds",
+    "Time messages spent in the outbound queue before their first send attempt, by priority.",
+    buckets=(0.01, 0.1, 0.5, 1.0, 3.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+
+
+class _Item:
+    __slots__ = ("priority", "seq", "robot", "payload", "future", "enqueued", "not_before", "attempts", "ctx")
+
+    def __init__(self, priority: int, seq: int, robot: str, payload: Any):
+        self.priority = priority
+        self.seq = seq
+        self.robot = robot
+        self.payload = payload
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+        self.not_before = 0.0
+        self.attempts = 0
+        self.ctx = contextvars.copy_context()
+
+    def __lt__(self, other: "_Item") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundQueue:
+    def __init__(
+        self,
+        send: Callable[[str, Any], dict],
+        rate_per_minute: float = 18,
+        burst: float = 2,
+        max_depth: int = 1000,
+        is_throttled: Optional[Callable[[dict], bool]] = None,
+        throttle_retries: int = 3,
+        throttle_backoff: float = 10.0,
+        concurrency: int = 4,
+        name: str = "outbound",
+        bucket_factory: Optional[Callable[[str, float, float], TokenBucket]] = None,
+    ):
+        self.send = send
+        self.rate = float(rate_per_minute) / 60.0
+        self.burst = burst
+        self.max_depth = max(1, int(max_depth))
+        self.is_throttled = is_throttled or (lambda result: False)
+        self.throttle_retries = max(0, int(throttle_retries))
+        self.throttle_backoff = float(throttle_backoff)
+        self.name = name
+        # (robot, rate per second, burst) -> bucket; a shared one limits several processes together
+        self.bucket_factory = bucket_factory or (lambda robot, rate, burst: TokenBucket(rate, burst))
+        self._heaps: Dict[str, List[_Item]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._depth = 0
+        self.concurrency = max(1, int(concurrency))
+        self._sending: set = set()  # robots with a send in progress
+        self._changes = 0  # bumped on every submit and finished send, under _cond
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self.sent = 0
+        self.throttled = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self) -> "OutboundQueue":
+        if self._thread is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"{self.name}-send")
+            self._thread = threading.Thread(target=self._loop, name=f"{self.name}-dispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def _bucket(self, robot: str) -> TokenBucket:
+        b = self._buckets.get(robot)
+        if b is None:
+            b = self._buckets[robot] = self.bucket_factory(robot, self.rate, self.burst)
+        return b
+
+    def submit(self, robot: str, payload: Any, priority: int = PRIORITY_REPLY) -> Future:
+        """Queue `payload` for `robot`; raise QueueFull if the queue is saturated."""
+        item = _Item(priority, next(self._seq), robot, payload)
+        with self._cond:
+            if self._depth >= self.max_depth:
+                self.rejected += 1
+                raise QueueFull(f"{self.name} queue is full ({self.max_depth})")
+            self._depth += 1
+            heapq.heappush(self._heaps.setdefault(robot, []), item)
+            self._changes += 1
+            self._cond.notify_all()
+        return item.future
+
+    def _next_ready(self, heads: List[_Item], now: float):
+        """Take a token for the best sendable head; return (robot, None) or (None, seconds to wait).
+
+        Called without `_cond` held: with shared buckets these are SQLite calls, and
+        submitters and send threads should not queue up behind them.
+        """
+        best, wait = None, None
+        for head in heads:
+            ready_in = max(head.not_before - now, self._bucket(head.robot).time_until(1, now))
+            if ready_in <= 0:
+                if best is None or head < best:
+                    best = head
+            elif wait is None or ready_in < wait:
+                wait = ready_in
+        if best is not None:
+            bucket = self._bucket(best.robot)
+            if bucket.try_take(1, now):
+                return best.robot, None
+            # another process sharing the bucket took the token first
+            retry = max(bucket.time_until(1, now), 0.01)
+            wait = retry if wait is None else min(wait, retry)
+        return None, wait
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    if len(self._sending) < self.concurrency:
+                        heads = [heap[0] for robot, heap in self._heaps.items()
+                                 if heap and robot not in self._sending]
+                        if heads:
+                            break
+                    self._cond.wait()
+                changes = self._changes
+            robot, wait = self._next_ready(heads, time.monotonic())
+            with self._cond:
+                if self._stopped:
+                    return
+                if robot is None:
+                    # don't sleep through a submit or finished send we missed while unlocked
+                    if self._changes == changes:
+                        self._cond.wait(wait)
+                    continue
+                # only this thread pops, so the robot's heap still has a head; a reply
+                # submitted in the meantime may have taken its place, which is fine
+                item = heapq.heappop(self._heaps[robot])
+                self._sending.add(robot)
+            self._pool.submit(self._run, item)
+
+    def _run(self, item: _Item) -> None:
+        try:
+            self._dispatch(item)
+        finally:
+            with self._cond:
+                self._sending.discard(item.robot)
+                self._changes += 1
+                self._cond.notify_all()
+
+    def _dispatch(self, item: _Item) -> None:
+        now = time.monotonic()
+        if item.attempts == 0:
+            WAIT_SECONDS.observe(now - item.enqueued, priority=PRIORITY_NAMES.get(item.priority, item.priority))
+        item.attempts += 1
+        try:
+            result = item.ctx.run(self.send, item.robot, item.payload)
+        except Exception as exc:
+            logger.warning("Outbound: send to robot failed: %s", exc)
+            with self._cond:
+                self.failed += 1
+                self._depth -= 1
+            item.future.set_exception(exc)
+            return
+        if self.is_throttled(result) and item.attempts <= self.throttle_retries:
+            # the robot is over its limit: wait out the backoff and keep our place in line
+            self._bucket(item.robot).drain()
+            item.not_before = time.monotonic() + self.throttle_backoff * item.attempts
+            logger.warning("Outbound: robot throttled us; retrying in %.0fs", self.throttle_backoff * item.attempts)
+            with self._cond:
+                self.throttled += 1
+                heapq.heappush(self._heaps[item.robot], item)
+            return
+        with self._cond:
+            if self.is_throttled(result):
+                self.failed += 1
+            else:
+                self.sent += 1
+            self._depth -= 1
+        item.future.set_result(result)
+
+    def depth(self) -> int:
+        with self._cond:
+            return self._depth
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued message has been sent (or given up on)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._depth == 0 and not self._sending, timeout=timeout)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            by_priority: Dict[str, int] = {}
+            oldest = 0.0
+            for heap in self._heaps.values():
+                for item in heap:
+                    name = PRIORITY_NAMES.get(item.priority, str(item.priority))
+                    by_priority[name] = by_priority.get(name, 0) + 1
+                    oldest = max(oldest, now - item.enqueued)
+            return {
+                "depth": self._depth,
+                "depth_by_priority": by_priority,
+                "oldest_wait_seconds": round(oldest, 3),
+                "robots": len(self._heaps),
+                "sending": len(self._sending),
+                "sent": self.sent,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
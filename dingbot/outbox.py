@@ -0,0 +1,369 @@
+"""Durable SQLite outbox for outgoing DingTalk messages.
+
+Every queued message is first written to the `outbox` table, so the request path only
+pays a local write. An `OutboxDrainer` hands pending rows to the rate-limited outbound
+queue, marks them delivered, and reschedules failed sends with exponential backoff.
+Rows left pending by a crash or restart are replayed when the drainer starts.
+
+Several processes may share one outbox file: each row is leased by the process that
+is sending it (`owner`, `lease_until`), leases are renewed while the message waits in
+the outbound queue, and a row whose owner died becomes claimable once the lease expires.
+A starting drainer does not wait for that: rows leased by a process on this host that
+is no longer running (or by an earlier process with our own pid, as after a container
+restart) are released right away. Owners on other hosts still wait out the lease.
+
+Table `outbox`:
+- id INTEGER PRIMARY KEY
+- robot TEXT (robot access token)
+- body TEXT (JSON message body)
+- priority INTEGER
+- status TEXT (pending, delivered, failed)
+- attempts INTEGER
+- next_attempt REAL (unix timestamp)
+- owner TEXT, lease_until REAL
+- last_error TEXT
+- created_at REAL, delivered_at REAL
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_create_sql = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    robot TEXT NOT NULL,
+    body TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    delivered_at REAL
+)
+"""
+_index_sql = "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)"
+
+
+class Outbox:
+    def __init__(self, path: str, lease_seconds: float = 300, owner: Optional[str] = None):
+        self.path = path
+        self.lease_seconds = float(lease_seconds)
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(_create_sql)
+        conn.execute(_index_sql)
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, robot: str, body: Dict[str, Any], priority: int = 0) -> int:
+        """Persist a message, leased to this process for its first attempt."""
+        now = time.time()
+        conn = self._conn()
+        cur = conn.execute(
+            "INSERT INTO outbox (robot, body, priority, next_attempt, owner, lease_until, created_at)"
+            " VALUES (?,?,?,?,?,?,?)",
+            (robot, json.dumps(body, ensure_ascii=False), priority, now, self.owner, now + self.lease_seconds, now),
+        )
+        conn.commit()
+        return cur.lastrowid
+
+    def claim_due(self, limit: int = 100, exclude=()) -> List[Dict[str, Any]]:
+        """Lease pending rows that are due and not leased by a live sender (including this one)."""
+        now = time.time()
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT * FROM outbox WHERE status='pending' AND next_attempt<=?"
+            " AND (owner IS NULL OR lease_until<?) ORDER BY priority, id LIMIT ?",
+            (now, now, limit + len(exclude)),
+        ).fetchall()
+        claimed = []
+        for r in rows:
+            if r["id"] in exclude:
+                continue
+            cur = conn.execute(
+                "UPDATE outbox SET owner=?, lease_until=? WHERE id=? AND status='pending'"
+                " AND (owner IS NULL OR lease_until<?)",
+                (self.owner, now + self.lease_seconds, r["id"], now),
+            )
+            if cur.rowcount:
+                row = dict(r)
+                row["body"] = json.loads(row["body"])
+                claimed.append(row)
+            if len(claimed) >= limit:
+                break
+        conn.commit()
+        return claimed
+
+    def release_dead_owners(self) -> int:
+        """Release pending rows leased by processes on this host that are no longer running."""
+        host, pid = socket.gethostname(), os.getpid()
+        conn = self._conn()
+        owners = [r[0] for r in conn.execute(
+            "SELECT DISTINCT owner FROM outbox WHERE status='pending' AND owner LIKE ?", (host + ":%",)
+        ).fetchall()]
+        released = 0
+        for owner in owners:
+            if owner == self.owner:
+                continue
+            try:
+                owner_pid = int(owner[len(host) + 1:].split(":", 1)[0])
+            except ValueError:
+                continue
+            if owner_pid != pid and _pid_alive(owner_pid):
+                continue
+            cur = conn.execute(
+                "UPDATE outbox SET owner=NULL, lease_until=NULL WHERE status='pending' AND owner=?", (owner,)
+            )
+            released += cur.rowcount
+        conn.commit()
+        return released
+
+    def renew(self, ids) -> None:
+        ids = list(ids)
+        if not ids:
+            return
+        conn = self._conn()
+        conn.executemany(
+            "UPDATE outbox SET lease_until=? WHERE id=? AND owner=?",
+            [(time.time() + self.lease_seconds, i, self.owner) for i in ids],
+        )
+        conn.commit()
+
+    def mark_delivered(self, msg_id: int) -> None:
+        conn = self._conn()
+        conn.execute(
+            "UPDATE outbox SET status='delivered', attempts=attempts+1, delivered_at=?, owner=NULL WHERE id=?",
+            (time.time(), msg_id),
+        )
+        conn.commit()
+
+    def mark_retry(self, msg_id: int, error: str, delay: float) -> None:
+        conn = self._conn()
+        conn.execute(
+            "UPDATE outbox SET attempts=attempts+1, next_attempt=?, last_error=?, owner=NULL WHERE id=?",
+            (time.time() + delay, error, msg_id),
+        )
+        conn.commit()
+
+    def mark_failed(self, msg_id: int, error: str) -> None:
+        conn = self._conn()
+        conn.execute(
+            "UPDATE outbox SET status='failed', attempts=attempts+1, last_error=?, owner=NULL WHERE id=?",
+            (error, msg_id),
+        )
+        conn.commit()
+
+    def get(self, msg_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM outbox WHERE id=?", (msg_id,)).fetchone()
+        return dict(row) if row else None
+
+    def purge(self, older_than_seconds: float) -> int:
+        """Delete delivered rows older than the retention window."""
+        conn = self._conn()
+        cur = conn.execute(
+            "DELETE FROM outbox WHERE status='delivered' AND delivered_at<?", (time.time() - older_than_seconds,)
+        )
+        conn.commit()
+        return cur.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {r[0]: r[1] for r in rows}
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # exists but belongs to another user
+    return True
+
+
+class OutboxDrainer:
+    """Background thread that feeds due outbox rows to `submit(robot, body, priority) -> Future`.
+
+    `classify(result)` returns None for a delivered message, "retry" for a transient
+    failure or "fail" for a permanent one; `classify_error(exc)` gives the verdict for a
+    send that raised. Only retry failures where the message surely was not posted: a
+    retried send that DingTalk did receive shows up twice in the group.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        submit: Callable[[str, Dict[str, Any], int], Future],
+        classify: Callable[[Any], Optional[str]],
+        classify_error: Callable[[BaseException], str] = lambda exc: "fail",
+        max_attempts: int = 8,
+        retry_base: float = 5.0,
+        poll_seconds: float = 5.0,
+        retention_seconds: float = 86400,
+    ):
+        self.outbox = outbox
+        self.submit = submit
+        self.classify = classify
+        self.classify_error = classify_error
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_base = float(retry_base)
+        self.poll_seconds = float(poll_seconds)
+        self.retention_seconds = float(retention_seconds)
+        self._inflight: Dict[int, int] = {}  # id -> attempts before this one
+        self._waiters: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_purge = 0.0
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self) -> "OutboxDrainer":
+        if self._thread is None:
+            try:
+                n = self.outbox.release_dead_owners()
+                if n:
+                    logger.info("Outbox: released %d message(s) leased by exited processes", n)
+            except Exception:
+                logger.exception("Outbox: could not release leases of exited processes")
+            self._thread = threading.Thread(target=self._loop, name="outbox-drainer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def enqueue(self, robot: str, body: Dict[str, Any], priority: int = 0) -> Future:
+        """Persist a message and start its first send; the Future resolves on delivery
+        (or final failure), possibly after retries."""
+        msg_id = self.outbox.add(robot, body, priority)
+        waiter: Future = Future()
+        with self._lock:
+            self._waiters[msg_id] = waiter
+        self._send({"id": msg_id, "robot": robot, "body": body, "priority": priority, "attempts": 0})
+        return waiter
+
+    def _send(self, row: Dict[str, Any]) -> None:
+        msg_id = row["id"]
+        with self._lock:
+            self._inflight[msg_id] = row["attempts"]
+        try:
+            fut = self.submit(row["robot"], row["body"], row["priority"])
+        except Exception as exc:
+            # e.g. the outbound queue is full: leave the row for a later drain pass
+            self._finish(msg_id, "retry", repr(exc))
+            return
+        fut.add_done_callback(lambda f, i=msg_id: self._on_done(i, f))
+
+    def _on_done(self, msg_id: int, fut: Future) -> None:
+        exc = fut.exception()
+        if exc is not None:
+            verdict, error, result = self.classify_error(exc), repr(exc), None
+        else:
+            result = fut.result()
+            verdict = self.classify(result)
+            error = None if verdict is None else json.dumps(result, ensure_ascii=False, default=str)[:500]
+        self._finish(msg_id, verdict, error, result)
+
+    def _finish(self, msg_id: int, verdict: Optional[str], error: Optional[str], result: Any = None) -> None:
+        with self._lock:
+            attempts = self._inflight.pop(msg_id, 0) + 1
+        waiter = None
+        try:
+            if verdict is None:
+                self.outbox.mark_delivered(msg_id)
+                with self._lock:
+                    self.delivered += 1
+                    waiter = self._waiters.pop(msg_id, None)
+                if waiter is not None:
+                    waiter.set_result(result)
+                return
+            if verdict == "retry" and attempts < self.max_attempts:
+                delay = self.retry_base * (2 ** (attempts - 1))
+                self.outbox.mark_retry(msg_id, error or "", delay)
+                with self._lock:
+                    self.retried += 1
+                logger.warning("Outbox: message %s failed (attempt %d), retrying in %.0fs: %s",
+                               msg_id, attempts, delay, error)
+                return
+            self.outbox.mark_failed(msg_id, error or "")
+            logger.error("Outbox: giving up on message %s after %d attempts: %s", msg_id, attempts, error)
+            with self._lock:
+                self.failed += 1
+                waiter = self._waiters.pop(msg_id, None)
+            if waiter is not None:
+                waiter.set_exception(RuntimeError(f"message {msg_id} not delivered: {error}"))
+        except Exception:
+            logger.exception("Outbox: failed to record the outcome of message %s", msg_id)
+
+    def drain_once(self) -> int:
+        """Renew leases of in-flight rows and dispatch due ones; returns how many were sent."""
+        with self._lock:
+            inflight = set(self._inflight)
+        self.outbox.renew(inflight)
+        rows = self.outbox.claim_due(exclude=inflight)
+        for row in rows:
+            self._send(row)
+        now = time.time()
+        if now - self._last_purge > 3600:
+            self._last_purge = now
+            self.outbox.purge(self.retention_seconds)
+        return len(rows)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                n = self.drain_once()
+                if n:
+                    logger.info("Outbox: dispatched %d pending message(s)", n)
+            except Exception:
+                logger.exception("Outbox: drain pass failed")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            inflight = len(self._inflight)
+            delivered, retried, failed = self.delivered, self.retried, self.failed
+        try:
+            counts = self.outbox.counts()
+        except Exception:
+            counts = {}
+        return {
+            "path": self.outbox.path,
+            "inflight": inflight,
+            "pending": counts.get("pending", 0),
+            "failed_total": counts.get("failed", 0),
+            "delivered": delivered,
+            "retried": retried,
+            "failed": failed,
+        }
@@ -0,0 +1,206 @@
+"""Sampled on-demand profiling for the webhook and scheduler.
+
+A `PROFILE_SAMPLE_RATE` fraction of webhook requests and every `PROFILE_SCHEDULER_EVERY`-th
+scheduler cycle run under `cProfile`; each profile is written to `PROFILE_DIR` as a
+`.prof` file (load it with `python -m pstats <file>` or snakeviz). Only one profile is
+taken at a time per process - a sampled request that overlaps a running profile is
+simply not profiled. The oldest files are pruned beyond `PROFILE_MAX_FILES`.
+
+cProfile only sees the thread that enabled it, so work handed to other threads runs
+inside `job()`: the scheduler's per-user jobs and the webhook's work-queue turns. A job
+whose context belongs to a sampled profile that is still open is profiled in its own
+thread and merged into that file; a job that starts after the profile was written (an
+async webhook reply) is written as a profile of its own.
+
+Sampling can be changed at runtime with `set_sampling` (exposed as `/admin/profiling`
+by the server), so hot spots can be captured in production without a redeploy.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import glob
+import itertools
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from typing import List, Optional
+
+from . import config, metrics
+
+logger = logging.getLogger(__name__)
+
+PROFILES = metrics.counter("dingbot_profiles_total", "Profiles written by kind (webhook, scheduler).")
+
+_lock = threading.Lock()
+# runtime sampling settings; start from config and can be changed by set_sampling
+_settings = {
+    "sample_rate": config.PROFILE_SAMPLE_RATE,
+    "scheduler_every": config.PROFILE_SCHEDULER_EVERY,
+}
+_cycles = itertools.count(1)
+_seq = itertools.count(1)
+# cProfile can't nest (and on newer Pythons only one profiler may be active per process)
+_active = threading.Lock()
+_last_file: Optional[str] = None
+# the profile the current context was sampled into
+_session: contextvars.ContextVar = contextvars.ContextVar("dingbot_profile_session", default=None)
+
+
+def set_sampling(sample_rate: Optional[float] = None, scheduler_every: Optional[int] = None) -> dict:
+    """Change the sampling settings of this process; returns the new settings."""
+    with _lock:
+        if sample_rate is not None:
+            _settings["sample_rate"] = min(1.0, max(0.0, float(sample_rate)))
+        if scheduler_every is not None:
+            _settings["scheduler_every"] = max(0, int(scheduler_every))
+        logger.info("Profiling: sampling set to %s", _settings)
+        return dict(_settings)
+
+
+def _sampled(kind: str) -> bool:
+    with _lock:
+        if kind == "scheduler":
+            every = _settings["scheduler_every"]
+            return every > 0 and next(_cycles) % every == 0
+        rate = _settings["sample_rate"]
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def _prune(directory: str) -> None:
+    limit = config.PROFILE_MAX_FILES
+    if limit <= 0:
+        return
+    files = sorted(glob.glob(os.path.join(directory, "*.prof")), key=os.path.getmtime)
+    for path in files[:-limit]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _write(profilers: List[cProfile.Profile], kind: str, elapsed: float) -> Optional[str]:
+    global _last_file
+    directory = config.PROFILE_DIR
+    try:
+        os.makedirs(directory, exist_ok=True)
+        name = "%s-%s-%d-%d.prof" % (kind, time.strftime("%Y%m%d-%H%M%S"), os.getpid(), next(_seq))
+        path = os.path.join(directory, name)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        _prune(directory)
+    except Exception:
+        logger.exception("Profiling: failed to write %s profile", kind)
+        return None
+    PROFILES.inc(kind=kind)
+    _last_file = path
+    logger.info("Profiling: wrote %s profile (%.1f ms) to %s", kind, elapsed * 1000, path)
+    return path
+
+
+def _start() -> Optional[cProfile.Profile]:
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Pythons that allow one active profiler per process
+        return None
+    return profiler
+
+
+class _Session:
+    """One sampled profile: the thread that started it plus the jobs that joined it.
+    Written (and `_active` released) when the last of them leaves."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.start = time.perf_counter()
+        self.profilers: List[cProfile.Profile] = []
+        self.threads = {threading.get_ident()}
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def join(self) -> Optional[bool]:
+        """True if this thread joined; False if the profile is already written; None if
+        this thread is already profiled by it."""
+        ident = threading.get_ident()
+        with self._lock:
+            if self.closed:
+                return False
+            if ident in self.threads:
+                return None
+            self.threads.add(ident)
+            return True
+
+    def leave(self, profiler: Optional[cProfile.Profile]) -> None:
+        with self._lock:
+            if profiler is not None:
+                profiler.disable()
+                self.profilers.append(profiler)
+            self.threads.discard(threading.get_ident())
+            self.closed = not self.threads
+            if not self.closed:
+                return
+        try:
+            if self.profilers:
+                _write(self.profilers, self.kind, time.perf_counter() - self.start)
+        finally:
+            _active.release()
+
+
+@contextlib.contextmanager
+def _profiled(kind: str):
+    if not _active.acquire(blocking=False):
+        yield
+        return
+    session = _Session(kind)
+    token = _session.set(session)
+    profiler = _start()
+    try:
+        yield
+    finally:
+        _session.reset(token)
+        session.leave(profiler)
+
+
+@contextlib.contextmanager
+def maybe_profile(kind: str):
+    """Run the block under cProfile if this `kind` ("webhook" or "scheduler") is sampled."""
+    if not _sampled(kind):
+        yield
+        return
+    with _profiled(kind):
+        yield
+
+
+@contextlib.contextmanager
+def job():
+    """Run a job taken over from another thread as part of the profile its context was
+    sampled into (no-op when it was not sampled)."""
+    session = _session.get()
+    joined = session.join() if session is not None else None
+    if joined is None:
+        yield
+    elif joined:
+        profiler = _start()
+        try:
+            yield
+        finally:
+            session.leave(profiler)
+    else:
+        with _profiled(session.kind):
+            yield
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(_settings)
+    out["dir"] = config.PROFILE_DIR
+    out["written"] = {k: int(PROFILES.value(kind=k)) for k in ("webhook", "scheduler")}
+    out["last_file"] = _last_file
+    return out
@@ -0,0 +1,159 @@
+"""Token-bucket rate limiting helpers."""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_take(self, n: float = 1, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def drain(self, now: Optional[float] = None) -> None:
+        """Empty the bucket, e.g. after the remote side reported we are too fast."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            self._tokens = 0.0
+
+    def time_until(self, n: float = 1, now: Optional[float] = None) -> float:
+        """Seconds until `n` tokens are available (0 if they are now)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            missing = n - self._tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate if self.rate > 0 else float("inf")
+
+
+class SharedTokenBucket:
+    """Token bucket kept in a SQLite file, so every process using the file shares one limit.
+
+    Same interface as `TokenBucket`. The `now` arguments are ignored: the shared state
+    is kept in wall-clock time, which all the processes agree on. If the file cannot be
+    used, the bucket answers "not yet" and logs, rather than sending past the limit.
+    """
+
+    _create_sql = "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+
+    def __init__(self, path: str, key: str, rate: float, capacity: float):
+        self.path = path
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(self._create_sql)
+
+    def _tokens(self, now: float) -> float:
+        row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE key=?", (self.key,)).fetchone()
+        if row is None:
+            return self.capacity
+        return min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+
+    def _take(self, n: float, drain: bool = False) -> bool:
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    tokens = self._tokens(now)
+                    taken = not drain and tokens >= n
+                    if drain:
+                        tokens = 0.0
+                    elif taken:
+                        tokens -= n
+                    self._conn.execute(
+                        "INSERT INTO buckets (key, tokens, updated) VALUES (?,?,?)"
+                        " ON CONFLICT(key) DO UPDATE SET tokens=excluded.tokens, updated=excluded.updated",
+                        (self.key, tokens, now),
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error:
+                logger.warning("Rate limit store %s unavailable", self.path, exc_info=True)
+                return False
+        return taken
+
+    def try_take(self, n: float = 1, now: Optional[float] = None) -> bool:
+        return self._take(n)
+
+    def drain(self, now: Optional[float] = None) -> None:
+        self._take(0, drain=True)
+
+    def time_until(self, n: float = 1, now: Optional[float] = None) -> float:
+        with self._lock:
+            try:
+                missing = n - self._tokens(time.time())
+            except sqlite3.Error:
+                logger.warning("Rate limit store %s unavailable", self.path, exc_info=True)
+                return 1.0
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+
+class KeyedRateLimiter:
+    """One token bucket per key (user, group, robot...), keeping at most `max_keys` buckets.
+
+    A `rate_per_minute` of 0 or less disables the limiter (every call is allowed).
+    """
+
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int = 10000):
+        self.rate = float(rate_per_minute) / 60.0
+        self.burst = max(1.0, float(burst))
+        self.max_keys = max(1, int(max_keys))
+        self._buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def bucket(self, key: Any) -> TokenBucket:
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                b = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_keys:
+                    # least recently used key starts over with a full bucket next time
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return b
+
+    def allow(self, key: Any, n: float = 1) -> bool:
+        if not self.enabled or key is None:
+            return True
+        return self.bucket(key).try_take(n)
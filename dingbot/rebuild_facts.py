@@ -0,0 +1,167 @@
+"""Offline rebuild of every user's facts, e.g. after changing the extraction prompt or model.
+
+    python -m dingbot.rebuild_facts --workers 8
+
+Reads the memory log in one streaming pass (keeping each user's last `--max-messages`
+messages), runs the extraction for each user on a pool of `--workers` processes (or
+threads with `--threads`) against the configured model, and writes the results to the
+facts store every `--batch` users. No pushes are sent. Users already written are listed
+in the checkpoint file, so an interrupted run picks up where it stopped; the checkpoint
+is removed when a run completes (`--fresh` ignores an existing one). An empty extraction
+result keeps the user's previous facts; a failed model call counts the user as failed and
+leaves them out of the checkpoint, so the next run retries them.
+"""
+
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from . import agent, facts_file, memory_file
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = "dingbot_rebuild_checkpoint.json"
+
+
+def read_messages(path: str, max_messages: int) -> Tuple[Dict[str, Deque[Dict[str, Any]]], int]:
+    """One pass over the log: each user's last `max_messages` messages, and the line count."""
+    by_user: Dict[str, Deque[Dict[str, Any]]] = defaultdict(lambda: deque(maxlen=max_messages))
+    lines = 0
+    if not os.path.exists(path):
+        return by_user, 0
+    with memory_file._lock.shared(), open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            lines += 1
+            try:
+                entry = json.loads(line)
+            except Exception:
+                continue
+            uid = entry.get("user_id")
+            if uid:
+                by_user[uid].append(entry)
+    return by_user, lines
+
+
+def _load_checkpoint(path: str, log_path: str) -> Set[str]:
+    if not os.path.exists(path):
+        return set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return set()
+    if data.get("log_path") != log_path:
+        return set()
+    return set(data.get("done") or [])
+
+
+def _save_checkpoint(path: str, log_path: str, done: Set[str]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"log_path": log_path, "done": sorted(done), "updated_at": int(time.time())}, f)
+    os.replace(tmp, path)
+
+
+def _extract(uid: str, messages: List[Dict[str, Any]], max_messages: int) -> Tuple[str, Optional[List[Dict[str, Any]]]]:
+    return uid, agent.extract_facts_for_user(uid, max_messages=max_messages, messages=messages, strict=True)
+
+
+def rebuild(
+    workers: int = 4,
+    max_messages: int = 50,
+    batch: int = 50,
+    checkpoint: str = CHECKPOINT_FILE,
+    fresh: bool = False,
+    threads: bool = False,
+    users: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """Re-extract facts for all users (or `users`); returns the run's counters."""
+    started = time.perf_counter()
+    log_path = os.path.abspath(memory_file.MEMORY_FILE)
+    by_user, lines = read_messages(memory_file.MEMORY_FILE, max_messages)
+    read_seconds = time.perf_counter() - started
+    done = set() if fresh else _load_checkpoint(checkpoint, log_path)
+    todo = [u for u in (users if users is not None else sorted(by_user)) if u in by_user and u not in done]
+    logger.info("Rebuild: %d messages from %d users read in %.1fs; %d to extract (%d done earlier)",
+                lines, len(by_user), read_seconds, len(todo), len(done))
+
+    stats = {"users": len(todo), "skipped": len(done), "written": 0, "empty": 0, "failed": 0, "messages": lines}
+    pending_writes: Dict[str, List[Dict[str, Any]]] = {}
+    finished: Set[str] = set()
+
+    def flush():
+        if pending_writes:
+            facts_file.set_many_facts(pending_writes)
+            stats["written"] += len(pending_writes)
+            pending_writes.clear()
+        done.update(finished)
+        finished.clear()
+        _save_checkpoint(checkpoint, log_path, done)
+
+    workers = max(1, workers)
+    pool_cls = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    extract_started = time.perf_counter()
+    with pool_cls(max_workers=workers) as pool:
+        queue = iter(todo)
+        inflight = set()
+        while True:
+            # keep at most two tasks per worker queued so memory stays bounded
+            for uid in queue:
+                inflight.add(pool.submit(_extract, uid, list(by_user[uid]), max_messages))
+                if len(inflight) >= 2 * workers:
+                    break
+            if not inflight:
+                break
+            completed, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in completed:
+                try:
+                    uid, facts = fut.result()
+                except Exception:
+                    logger.exception("Rebuild: extraction failed")
+                    stats["failed"] += 1
+                    continue
+                if facts is None:
+                    logger.warning("Rebuild: model call failed for %s; it will be retried next run", uid)
+                    stats["failed"] += 1
+                    continue
+                if facts:
+                    pending_writes[uid] = facts
+                else:
+                    stats["empty"] += 1
+                finished.add(uid)
+            if len(finished) >= max(1, batch):
+                flush()
+                n = len(done) - stats["skipped"]
+                elapsed = time.perf_counter() - extract_started
+                logger.info("Rebuild: %d/%d users (%.1f users/s)", n, len(todo), n / max(elapsed, 1e-9))
+    flush()
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = round(elapsed, 3)
+    stats["users_per_second"] = round(len(todo) / max(time.perf_counter() - extract_started, 1e-9), 2)
+    stats["messages_per_second_read"] = round(lines / max(read_seconds, 1e-9), 1)
+    if not stats["failed"] and os.path.exists(checkpoint):
+        # complete: the next run starts over
+        os.remove(checkpoint)
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Re-extract every user's facts without sending pushes")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent extractions")
+    parser.add_argument("--threads", action="store_true", help="use threads instead of processes")
+    parser.add_argument("--max-messages", type=int, default=50, help="recent messages per user")
+    parser.add_argument("--batch", type=int, default=50, help="users per facts write and checkpoint")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE)
+    parser.add_argument("--fresh", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--user", action="append", dest="users", help="only these users (repeatable)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    result = rebuild(args.workers, args.max_messages, args.batch, args.checkpoint, args.fresh, args.threads, args.users)
+    print(json.dumps(result, ensure_ascii=False))
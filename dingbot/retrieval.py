@@ -0,0 +1,333 @@
+"""Per-user retrieval index over the message log and extracted facts.
+
+Messages are ranked with Okapi BM25, which runs fully offline and needs no extra
+dependencies. Text is tokenized into lowercase latin words/digits and CJK character
+unigrams + bigrams, so Chinese messages without whitespace still match on shared words.
+
+The index follows `memory_file.MEMORY_FILE` by byte offset: every query first reads
+only the lines appended since the previous query (from this or any other process)
+and adds them to the indexes that are already built. A user's index is built lazily
+with one scan of the log the first time that user is queried; the scan runs without
+holding the module lock, so queries for users with built indexes are not held up.
+
+Facts are indexed per user as well and rebuilt whenever the facts file changes. Both
+kinds of index are kept for at most RETRIEVAL_MAX_INDEXES users, least recently
+queried dropped first.
+"""
+
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import config, tracing
+from . import memory_file, facts_file
+
+_K1 = 1.5
+_B = 0.75
+
+_WORD_RE = re.compile(r"[a-z0-9_]+|[\u3400-\u9fff\uf900-\ufaff]+")
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+
+_lock = threading.Lock()
+_indexes: "OrderedDict[str, _Index]" = OrderedDict()
+_facts_indexes: "OrderedDict[str, _Index]" = OrderedDict()
+_facts_mtime: Optional[int] = None
+_log_path: Optional[str] = None
+_offset = 0
+# bumped whenever the indexes are dropped, so a scan started before that is discarded
+_generation = 0
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into latin word tokens and CJK character unigrams + bigrams."""
+    tokens = []
+    for word in _WORD_RE.findall((text or "").lower()):
+        if _CJK_RE.match(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough model token estimate: one per CJK character, one per ~4 other characters."""
+    text = text or ""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class _Index:
+    """Incremental BM25 index over a list of documents."""
+
+    def __init__(self):
+        self.docs: List[Dict[str, Any]] = []
+        self.tfs: List[Counter] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[int]] = {}
+        self.total_len = 0
+
+    def add(self, doc: Dict[str, Any], text: str) -> None:
+        tf = Counter(tokenize(text))
+        idx = len(self.docs)
+        self.docs.append(doc)
+        self.tfs.append(tf)
+        length = sum(tf.values())
+        self.lengths.append(length)
+        self.total_len += length
+        for term in tf:
+            self.postings.setdefault(term, []).append(idx)
+
+    def search(self, query: str, k: int, exclude=()) -> List[Tuple[float, int]]:
+        n = len(self.docs)
+        if not n or k <= 0:
+            return []
+        avg_len = self.total_len / n or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for idx in posting:
+                tf = self.tfs[idx][term]
+                norm = tf + _K1 * (1 - _B + _B * self.lengths[idx] / avg_len)
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (_K1 + 1) / norm
+        ranked = sorted(
+            ((s, i) for i, s in scores.items() if i not in exclude),
+            key=lambda x: (-x[0], -x[1]),
+        )
+        return ranked[:k]
+
+
+def _iter_lines(path: str, start: int, end: Optional[int] = None, parse: bool = True):
+    """Yield (entry, end_offset) for each complete JSONL line in [start, end); entry is
+    None for unparsable lines, or for every line when not `parse`."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for raw in f:
+            if end is not None and pos >= end:
+                break
+            if not raw.endswith(b"\n"):
+                # partially written line; pick it up on the next catch-up
+                break
+            pos += len(raw)
+            if not parse:
+                yield None, pos
+                continue
+            try:
+                yield json.loads(raw), pos
+            except Exception:
+                yield None, pos
+
+
+def _scan(path: str, start: int, end: int, indexes: Dict[str, "_Index"]) -> None:
+    """Add the messages of the users in `indexes` found in [start, end) of the log."""
+    for entry, _ in _iter_lines(path, start, end):
+        idx = indexes.get(entry.get("user_id")) if entry else None
+        if idx is not None:
+            idx.add(entry, entry.get("content") or "")
+
+
+def _remember(cache: "OrderedDict[str, _Index]", user_id: str, idx: "_Index") -> None:
+    cache[user_id] = idx
+    cache.move_to_end(user_id)
+    while len(cache) > max(1, config.RETRIEVAL_MAX_INDEXES):
+        cache.popitem(last=False)
+
+
+def _catch_up() -> None:
+    """Feed lines appended since the last call into the already-built indexes."""
+    global _log_path, _offset, _generation
+    path = memory_file.MEMORY_FILE
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if path != _log_path or size < _offset:
+        # log moved or was truncated: start over
+        _indexes.clear()
+        _log_path = path
+        _offset = 0
+        _generation += 1
+    if size == _offset:
+        return
+    # nothing to feed yet: only find where the complete lines end
+    parse = bool(_indexes)
+    for entry, pos in _iter_lines(path, _offset, parse=parse):
+        _offset = pos
+        if not entry:
+            continue
+        idx = _indexes.get(entry.get("user_id"))
+        if idx is not None:
+            idx.add(entry, entry.get("content") or "")
+
+
+def _user_index(user_id: str) -> "_Index":
+    """The user's message index, caught up with the log. Takes `_lock` itself; the first
+    query of a user scans the log without holding it."""
+    with _lock:
+        _catch_up()
+        idx = _indexes.get(user_id)
+        if idx is not None:
+            _indexes.move_to_end(user_id)
+            return idx
+        path, end, generation = _log_path, _offset, _generation
+    idx = _Index()
+    if end:
+        _scan(path, 0, end, {user_id: idx})
+    with _lock:
+        _catch_up()
+        built = _indexes.get(user_id)
+        if built is not None:
+            # a concurrent query built it first
+            return built
+        if generation != _generation:
+            # the log was replaced meanwhile; rare enough to rebuild under the lock
+            idx = _Index()
+            _scan(_log_path, 0, _offset, {user_id: idx})
+        elif _offset > end:
+            # lines appended while scanning went only to the registered indexes
+            _scan(path, end, _offset, {user_id: idx})
+        _remember(_indexes, user_id, idx)
+        return idx
+
+
+def _facts_index(user_id: str) -> "_Index":
+    global _facts_mtime
+    path = facts_file.FACTS_FILE
+    mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+    if mtime != _facts_mtime:
+        _facts_indexes.clear()
+        _facts_mtime = mtime
+    idx = _facts_indexes.get(user_id)
+    if idx is None:
+        idx = _Index()
+        for f in facts_file.get_user_facts(user_id):
+            text = f.get("fact") if isinstance(f, dict) else str(f)
+            if text:
+                idx.add({"fact": text}, text)
+        _remember(_facts_indexes, user_id, idx)
+    else:
+        _facts_indexes.move_to_end(user_id)
+    return idx
+
+
+def build_context(
+    user_id: str,
+    query: str,
+    top_k: Optional[int] = None,
+    recent: Optional[int] = None,
+    token_budget: Optional[int] = None,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Select prompt context for `query`.
+
+    Returns {"messages": [...], "facts": [...]}. Messages are the `recent` latest
+    entries plus the `top_k` best-matching older ones, in chronological order;
+    facts are the `top_k` best-matching facts. Recent messages are taken first,
+    then facts and relevant messages by score, until `token_budget` is spent.
+    """
+    top_k = config.RETRIEVAL_TOP_K if top_k is None else top_k
+    recent = config.RETRIEVAL_RECENT if recent is None else recent
+    budget = config.PROMPT_TOKEN_BUDGET if token_budget is None else token_budget
+
+    with tracing.span("retrieval.build_context"):
+        idx = _user_index(user_id)
+        with _lock:
+            n = len(idx.docs)
+            recent_ids = list(range(max(0, n - recent), n))
+            hits = idx.search(query, top_k, exclude=set(recent_ids))
+            fidx = _facts_index(user_id)
+            fact_hits = fidx.search(query, top_k)
+            fact_docs = [fidx.docs[i] for _, i in fact_hits]
+
+    chosen: List[int] = []
+    seen = set()
+    facts: List[Dict[str, Any]] = []
+    spent = 0
+
+    def _take(i: int) -> bool:
+        nonlocal spent
+        doc = idx.docs[i]
+        key = (doc.get("timestamp"), doc.get("content"))
+        if key in seen:
+            return True
+        cost = estimate_tokens(doc.get("content") or "")
+        if spent + cost > budget:
+            return False
+        seen.add(key)
+        chosen.append(i)
+        spent += cost
+        return True
+
+    for i in reversed(recent_ids):
+        if not _take(i):
+            break
+    # interleave facts and relevant messages by rank so neither starves the other
+    for rank in range(max(len(hits), len(fact_docs))):
+        if rank < len(fact_docs):
+            cost = estimate_tokens(fact_docs[rank]["fact"])
+            if spent + cost <= budget:
+                facts.append(fact_docs[rank])
+                spent += cost
+        if rank < len(hits):
+            _take(hits[rank][1])
+
+    return {"messages": [idx.docs[i] for i in sorted(chosen)], "facts": facts}
+
+
+def preload(max_users: int) -> int:
+    """Build the indexes of the `max_users` most recently active users ahead of their first query.
+
+    Two passes over the log instead of one scan per user, both without holding the
+    module lock; the built indexes are swapped in under it. Returns how many were built.
+    """
+    if max_users <= 0:
+        return 0
+    with tracing.span("retrieval.preload"):
+        with _lock:
+            _catch_up()
+            path, end, generation = _log_path, _offset, _generation
+        if not end:
+            return 0
+        # users ordered by their latest message
+        recent: Dict[str, None] = {}
+        for entry, _ in _iter_lines(path, 0, end):
+            uid = entry.get("user_id") if entry else None
+            if uid:
+                recent.pop(uid, None)
+                recent[uid] = None
+        with _lock:
+            wanted = [u for u in list(recent)[-max_users:] if u not in _indexes]
+        if not wanted:
+            return 0
+        built = {u: _Index() for u in wanted}
+        _scan(path, 0, end, built)
+        with _lock:
+            _catch_up()
+            if generation != _generation:
+                # the log was replaced meanwhile; queries build what they need
+                return 0
+            # lines appended while scanning went only to the registered indexes
+            built = {u: idx for u, idx in built.items() if u not in _indexes}
+            if _offset > end:
+                _scan(path, end, _offset, built)
+            for uid, idx in built.items():
+                _remember(_indexes, uid, idx)
+            for uid in built:
+                _facts_index(uid)
+        return len(built)
+
+
+def reset() -> None:
+    """Drop all in-memory indexes (they are rebuilt lazily on the next query)."""
+    global _log_path, _offset, _facts_mtime, _generation
+    with _lock:
+        _generation += 1
+        _indexes.clear()
+        _facts_indexes.clear()
+        _log_path = None
+        _offset = 0
+        _facts_mtime = None
@@ -0,0 +1,185 @@
+"""Registry of DingTalk robot credentials, routing and per-robot health.
+
+`DINGTALK_ROBOTS` holds a JSON list of robots:
+
+    [{"name": "ops", "access_token": "...", "secret": "...", "conversation_ids": ["cid..."]},
+     {"name": "push-2", "access_token": "...", "secret": "...", "shard": true}]
+
+Without it the single `ACCESS_TOKEN`/`SECRET` pair is the robot "default". Replies go
+to the robot whose `conversation_ids` contain the message's conversation (else the
+first robot); scheduled pushes are sharded over the `shard` robots (default: all) by a
+rendezvous hash of the user id, so a user always lands on the same robot while it is
+healthy. Digests go to `PUSH_DIGEST_ROBOT`, or the first healthy `shard` robot.
+
+A robot with `ROBOT_UNHEALTHY_AFTER` consecutive failed sends (throttling does not
+count) is skipped by the sharding. Every `ROBOT_RETRY_AFTER_SECONDS` one push of a
+user it owns is let through as a trial; a successful send makes it healthy again and
+its users move back.
+"""
+
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from . import config, metrics
+from .hashing import rendezvous
+
+logger = logging.getLogger(__name__)
+
+SEND_SECONDS = metrics.histogram(
+    "dingbot_robot_send_duration_seconds",
+    "DingTalk send latency by robot.",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0),
+)
+
+
+class Robot:
+    def __init__(self, name: str, access_token: str, secret: str,
+                 conversation_ids: Optional[List[str]] = None, shard: bool = True):
+        self.name = name
+        self.access_token = access_token
+        self.secret = secret
+        self.conversation_ids = set(conversation_ids or [])
+        self.shard = bool(shard)
+        self._lock = threading.Lock()
+        self.ok = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.throttled = 0
+        self.latency_ewma: Optional[float] = None
+        self.last_error: Optional[str] = None
+        # monotonic times of the latest failed send and the latest trial send
+        self._failed_at = 0.0
+        self._trial_at = 0.0
+
+    def __repr__(self) -> str:
+        return f"Robot({self.name!r})"
+
+    def __str__(self) -> str:
+        return self.name
+
+    @property
+    def healthy(self) -> bool:
+        return self.consecutive_failures < max(1, config.ROBOT_UNHEALTHY_AFTER)
+
+    def try_trial(self, now: Optional[float] = None) -> bool:
+        """Claim the trial send of an unhealthy robot, at most one per ROBOT_RETRY_AFTER_SECONDS."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now - max(self._failed_at, self._trial_at) < config.ROBOT_RETRY_AFTER_SECONDS:
+                return False
+            self._trial_at = now
+        logger.info("Robots: sending a trial message through unhealthy robot %s", self.name)
+        return True
+
+    def record(self, seconds: float, ok: bool, error: Optional[str] = None, throttled: bool = False) -> None:
+        """Record a send. A throttled send ("too fast") says nothing about the robot's health."""
+        SEND_SECONDS.observe(seconds, robot=self.name)
+        with self._lock:
+            self.latency_ewma = seconds if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * seconds
+            if ok:
+                self.ok += 1
+                self.consecutive_failures = 0
+            elif throttled:
+                self.throttled += 1
+                self.last_error = error
+            else:
+                self.errors += 1
+                self.consecutive_failures += 1
+                self.last_error = error
+                self._failed_at = time.monotonic()
+        if ok or throttled:
+            return
+        if self.consecutive_failures == config.ROBOT_UNHEALTHY_AFTER:
+            logger.warning("Robots: %s marked unhealthy after %d failed sends (%s)",
+                           self.name, self.consecutive_failures, error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "healthy": self.healthy,
+                "ok": self.ok,
+                "errors": self.errors,
+                "consecutive_failures": self.consecutive_failures,
+                "throttled": self.throttled,
+                "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+                "last_error": self.last_error,
+            }
+
+
+_robots: Optional[List[Robot]] = None
+_by_token: Dict[str, Robot] = {}
+_spec = None
+_lock = threading.Lock()
+
+
+def _load() -> List[Robot]:
+    robots = []
+    if config.DINGTALK_ROBOTS:
+        try:
+            entries = json.loads(config.DINGTALK_ROBOTS)
+        except ValueError as exc:
+            raise RuntimeError(f"DINGTALK_ROBOTS is not valid JSON: {exc}")
+        for i, e in enumerate(entries):
+            robots.append(Robot(e.get("name") or f"robot-{i}", e["access_token"], e["secret"],
+                                e.get("conversation_ids"), e.get("shard", True)))
+    elif config.ACCESS_TOKEN and config.SECRET:
+        robots.append(Robot("default", config.ACCESS_TOKEN, config.SECRET))
+    return robots
+
+
+def all_robots() -> List[Robot]:
+    """Configured robots (reloaded when the robot settings change)."""
+    global _robots, _by_token, _spec
+    spec = (config.DINGTALK_ROBOTS, config.ACCESS_TOKEN, config.SECRET)
+    if _robots is None or spec != _spec:
+        with _lock:
+            if _robots is None or spec != _spec:
+                _robots = _load()
+                _by_token = {r.access_token: r for r in _robots}
+                _spec = spec
+    return _robots
+
+
+def by_token(access_token: str) -> Optional[Robot]:
+    all_robots()
+    return _by_token.get(access_token)
+
+
+def for_conversation(conversation_id: Optional[str]) -> Optional[Robot]:
+    robots = all_robots()
+    if conversation_id:
+        for r in robots:
+            if conversation_id in r.conversation_ids:
+                return r
+    return robots[0] if robots else None
+
+
+def for_user(user_id: str) -> Optional[Robot]:
+    candidates = [r for r in all_robots() if r.shard]
+    owner = rendezvous(user_id, candidates)
+    if owner is None or owner.healthy or owner.try_trial():
+        return owner
+    healthy = [r for r in candidates if r.healthy]
+    return rendezvous(user_id, healthy) or owner
+
+
+def for_digest() -> Optional[Robot]:
+    """The robot for scheduled digests: PUSH_DIGEST_ROBOT by name, else the first healthy
+    `shard` robot (digests are pushes, so they stay off robots excluded from sharding)."""
+    robots = all_robots()
+    if config.PUSH_DIGEST_ROBOT:
+        for r in robots:
+            if r.name == config.PUSH_DIGEST_ROBOT:
+                return r
+        logger.warning("PUSH_DIGEST_ROBOT %r is not configured; using a push robot", config.PUSH_DIGEST_ROBOT)
+    candidates = [r for r in robots if r.shard]
+    healthy = [r for r in candidates if r.healthy]
+    pool = healthy or candidates or robots
+    return pool[0] if pool else None
+
+
+def stats() -> dict:
+    return {r.name: r.stats() for r in all_robots()}
@@ -2,69 +2,388 @@
 
 Behavior:
 - Every `CHECK_INTERVAL_SECONDS` (default 60s) the scheduler will:
-  1) For each user in the memory file, call the agent to extract facts and write them to `facts_file`.
+  1) For each user with new messages since the last cycle (see `activity`), call the agent
+     to extract facts and write them to `facts_file`.
   2) Generate a short push message for the user from those facts and send it (no @).
+  3) Users without news for `REENGAGE_INTERVAL_SECONDS` get a re-engagement push from
+     their stored facts (no re-extraction).
+
+Users are processed on a pool of `SCHEDULER_WORKERS` threads. A cycle stops starting
+new users once its time budget (`SCHEDULER_CYCLE_BUDGET_SECONDS`, default 90% of the
+interval) is spent; the users it didn't reach are carried over and go first next cycle.
+
+With `SCHEDULER_MODE=spread` there are no cycles: each user hashes to a stable slot
+within `CHECK_INTERVAL_SECONDS`, and a tick every `SCHEDULER_TICK_SECONDS` (with up to
+`SCHEDULER_TICK_JITTER_SECONDS` of random jitter) handles the users whose slot came up
+since the previous tick, so model calls and pushes are spread evenly over the interval.
+Digest push modes always run in cycles.
+
+With `SCHEDULER_CLUSTER_DB` set, several scheduler nodes share the users: each node
+holds a lease in that database (see `cluster`) and only handles the users that hash to
+it among the live nodes; a dead node's users move over once its lease expires. Each
+node tracks activity in its own `ACTIVITY_FILE` and records the users it processed in
+the shared database, so a user's new owner does not handle the same messages again.
+`SCHEDULER_LOCK_FILE` still allows one scheduler per host.
 """
 
 import time
+import atexit
+import importlib.util
 import logging
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
 
-# Import APScheduler lazily and handle missing dependency gracefully
+# APScheduler is imported by start(); processes that never schedule don't pay for it
 try:
-    from apscheduler.schedulers.background import BackgroundScheduler
-    APSCHEDULER_AVAILABLE = True
+    APSCHEDULER_AVAILABLE = importlib.util.find_spec("apscheduler") is not None
 except Exception:
-    BackgroundScheduler = None  # type: ignore
     APSCHEDULER_AVAILABLE = False
 
-from . import agent, sender, config
-from . import memory_file, facts_file
+from . import agent, sender, config, metrics, tracing, profiling
+from . import facts_file, activity, cluster
+from .filelock import try_lock_exclusive
+from .hashing import stable_hash
 
 logger = logging.getLogger(__name__)
 
 sched = None
 
+CYCLE_SECONDS = metrics.histogram(
+    "dingbot_scheduler_cycle_duration_seconds", "Duration of scheduler cycles.",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+USERS_PROCESSED = metrics.counter("dingbot_scheduler_users_processed_total", "Users processed by the scheduler, by result.")
+FACTS_WRITTEN = metrics.counter("dingbot_scheduler_facts_written_total", "Facts written by the scheduler.")
+# host-wide singleton lock, held for the lifetime of the process running the scheduler
+_singleton = None
+# users a previous cycle ran out of time for; they go first next cycle
+_carry_over: List[str] = []
+# clock the cycle budget is measured on
+_clock = time.monotonic
+_last_cycle = {"seconds": 0.0, "interval_ratio": 0.0, "processed": 0, "carried_over": 0, "active": 0, "idle": 0}
+# cluster mode: this node's lease and view of the live nodes
+_membership: Optional[cluster.Membership] = None
+# spread mode: wall-clock time covered by the previous tick
+_last_tick: Optional[float] = None
+
+metrics.gauge("dingbot_scheduler_cycle_interval_ratio",
+              "Last scheduler cycle duration divided by CHECK_INTERVAL_SECONDS (>= 1 means cycles overrun).",
+              lambda: _last_cycle["interval_ratio"])
+metrics.gauge("dingbot_scheduler_carried_over_users", "Users left for the next cycle when the last one ran out of budget.",
+              lambda: len(_carry_over))
+metrics.gauge("dingbot_scheduler_active_users", "Users with new messages in the last scheduler cycle.",
+              lambda: _last_cycle["active"])
+
 
 def run_cycle():
-    """One cycle: extract facts for all users and push messages."""
-    now = int(time.time())
-    users = memory_file.list_users()
-    if not users:
-        logger.debug("Scheduler: no users found in memory file")
-        return
-    for uid in users:
+    """One cycle: extract facts for users with new messages and push messages."""
+    start = time.perf_counter()
+    with tracing.start_trace("scheduler.cycle"), CYCLE_SECONDS.time(), profiling.maybe_profile("scheduler"):
+        # pushes queue behind interactive replies in the outbound queue
+        with sender.priority_class(sender.PRIORITY_PUSH):
+            _run_cycle()
+    elapsed = time.perf_counter() - start
+    _last_cycle["seconds"] = round(elapsed, 3)
+    _last_cycle["interval_ratio"] = round(elapsed / max(1, config.CHECK_INTERVAL_SECONDS), 3)
+
+
+def run_tick(now: Optional[float] = None):
+    """Spread mode: process the users whose slot fell between the previous tick and now."""
+    global _last_tick
+    now = time.time() if now is None else now
+    start_ts = _last_tick if _last_tick is not None else now - config.SCHEDULER_TICK_SECONDS
+    _last_tick = now
+    start = time.perf_counter()
+    with tracing.start_trace("scheduler.tick"), profiling.maybe_profile("scheduler"):
+        with sender.priority_class(sender.PRIORITY_PUSH):
+            _run_cycle(window=(start_ts, now), budget=max(1.0, config.SCHEDULER_TICK_SECONDS * 0.9))
+    elapsed = time.perf_counter() - start
+    _last_cycle["seconds"] = round(elapsed, 3)
+    _last_cycle["interval_ratio"] = round(elapsed / max(1, config.SCHEDULER_TICK_SECONDS), 3)
+
+
+def spread_mode() -> bool:
+    return config.SCHEDULER_MODE == "spread" and config.PUSH_MODE not in ("digest", "digest_batch")
+
+
+def _slot(uid: str, interval: float) -> float:
+    """Stable offset of the user's turn within each interval."""
+    return (stable_hash(uid) % max(1, int(interval * 1000))) / 1000.0
+
+
+def _slot_due(uid: str, window: Tuple[float, float]) -> bool:
+    # due if a time n * interval + slot falls in (start, end]
+    interval = max(1, config.CHECK_INTERVAL_SECONDS)
+    slot = _slot(uid, interval)
+    start, end = window
+    return (end - slot) // interval > (start - slot) // interval
+
+
+def get_membership() -> Optional[cluster.Membership]:
+    """This node's cluster membership, or None when running as the only scheduler."""
+    global _membership
+    if config.SCHEDULER_CLUSTER_DB and (_membership is None or _membership.path != config.SCHEDULER_CLUSTER_DB):
+        _membership = cluster.Membership(config.SCHEDULER_CLUSTER_DB, config.SCHEDULER_NODE_ID or None,
+                                         config.SCHEDULER_LEASE_SECONDS)
+    return _membership if config.SCHEDULER_CLUSTER_DB else None
+
+
+def _heartbeat():
+    try:
+        get_membership().heartbeat()
+    except Exception:
+        logger.exception("Scheduler: cluster heartbeat failed")
+
+
+def _cycle_budget() -> float:
+    if config.SCHEDULER_CYCLE_BUDGET_SECONDS > 0:
+        return config.SCHEDULER_CYCLE_BUDGET_SECONDS
+    return config.CHECK_INTERVAL_SECONDS * 0.9
+
+
+def _user_job(uid: str, digest: bool, idle: bool = False):
+    try:
+        # per-user pushes are sharded over the configured robots
+        with profiling.job(), tracing.span("scheduler.user", user_id=uid, idle=idle), sender.route(user_id=uid):
+            if idle:
+                result = _reengage_user(uid, digest)
+            else:
+                result = _refresh_facts(uid) if digest else _process_user(uid)
+        # a push counts once it is delivered; in digest mode it goes out with the digest
+        _mark_processed(uid, pushed=False)
+        if not digest and isinstance(result, Future):
+            _mark_pushed_when_sent([uid], [result])
+            result = None
+        USERS_PROCESSED.inc(result="ok")
+        return result
+    except Exception:
+        USERS_PROCESSED.inc(result="error")
+        logger.exception("Scheduler: failed to process user %s", uid)
+        return None
+
+
+def _mark_processed(uid: str, pushed: bool) -> None:
+    activity.mark_processed(uid, pushed=pushed)
+    membership = get_membership()
+    if membership is not None:
+        # lets the next owner of this user skip what is covered here
         try:
-            facts = agent.extract_facts_for_user(uid)
-            facts_file.set_user_facts(uid, facts)
-            text = agent.generate_push_from_facts(uid, facts)
-            # push to the group (no @)
-            sender.send_text_from_env(text)
-            logger.info("Scheduler: pushed message for user %s (facts=%d)", uid, len(facts))
+            membership.record_processed(uid, *activity.position(uid), pushed=pushed)
         except Exception:
-            logger.exception("Scheduler: failed to process user %s", uid)
+            logger.exception("Scheduler: failed to record user %s in the cluster database", uid)
+
+
+def _sync_from_cluster(membership: cluster.Membership, users: List[str]) -> None:
+    """Users that moved to this node may have been handled by their previous owner."""
+    for uid, rec in membership.processed(users).items():
+        activity.merge(uid, rec["log_path"], rec["log_offset"], rec["processed_at"], rec["pushed_at"])
+
+
+def _run_cycle(window: Optional[Tuple[float, float]] = None, budget: Optional[float] = None):
+    global _carry_over
+    activity.refresh()
+    active = activity.dirty_users()
+    # longest-unpushed idle users first, so a capped cycle rotates through them
+    idle_users = activity.idle_users(config.REENGAGE_INTERVAL_SECONDS)
+    membership = get_membership()
+    if membership is not None:
+        # only this node's share of the users, minus what other nodes already handled
+        membership.heartbeat()
+        _sync_from_cluster(membership, [u for u in set(active) | set(idle_users) if membership.owns(u)])
+        active = [u for u in activity.dirty_users() if membership.owns(u)]
+        idle_users = [u for u in activity.idle_users(config.REENGAGE_INTERVAL_SECONDS) if membership.owns(u)]
+    if window is not None:
+        # carried-over users were due in an earlier tick and still go first
+        carried_set = set(_carry_over)
+        active = [u for u in active if u in carried_set or _slot_due(u, window)]
+        idle_users = [u for u in idle_users if u in carried_set or _slot_due(u, window)]
+    if config.REENGAGE_MAX_PER_CYCLE > 0:
+        idle_users = idle_users[:config.REENGAGE_MAX_PER_CYCLE]
+    idle = set(idle_users)
+    _last_cycle["active"], _last_cycle["idle"] = len(active), len(idle)
+    users = active + idle_users
+    if not users:
+        logger.debug("Scheduler: no users with new activity")
+        activity.save()
+        return
+    known = set(users)
+    carried = [u for u in _carry_over if u in known]
+    carried_set = set(carried)
+    ordered = carried + [u for u in users if u not in carried_set]
+    digest = config.PUSH_MODE in ("digest", "digest_batch")
+    workers = max(1, config.SCHEDULER_WORKERS)
+    budget = _cycle_budget() if budget is None else budget
+    deadline = _clock() + budget
+
+    futures = {}
+    pending = set()
+    started = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scheduler") as pool:
+        for uid in ordered:
+            while len(pending) >= workers and _clock() < deadline:
+                _, pending = wait(pending, timeout=deadline - _clock(), return_when=FIRST_COMPLETED)
+            if _clock() >= deadline:
+                break
+            # each job runs in a copy of this context so the trace, priority and route follow it
+            fut = pool.submit(contextvars.copy_context().run, _user_job, uid, digest, uid in idle)
+            futures[uid] = fut
+            pending.add(fut)
+            started += 1
+        # users already started finish; the rest wait for the next cycle
+    activity.save()
+    _carry_over = ordered[started:]
+    _last_cycle["processed"] = started
+    _last_cycle["carried_over"] = len(_carry_over)
+    if _carry_over:
+        logger.warning("Scheduler: cycle budget of %.0fs spent; %d of %d users carried over to the next cycle",
+                       budget, len(_carry_over), len(ordered))
+    if digest:
+        collected = {uid: f.result() for uid, f in futures.items() if f.result() is not None}
+        _send_digest(collected)
+
+
+def _refresh_facts(uid: str):
+    facts = agent.extract_facts_for_user(uid)
+    facts_file.set_user_facts(uid, facts)
+    FACTS_WRITTEN.inc(len(facts))
+    return facts
+
+
+def _process_user(uid: str):
+    facts = _refresh_facts(uid)
+    text = agent.generate_push_from_facts(uid, facts)
+    # push to the group (no @)
+    fut = sender.send_text_from_env(text)
+    logger.info("Scheduler: queued push for user %s (facts=%d)", uid, len(facts))
+    return fut
+
+
+def _reengage_user(uid: str, digest: bool):
+    """Push to a user without news from the facts stored last time: the facts in digest
+    mode, else the send Future (None when there is nothing to push)."""
+    facts = facts_file.get_user_facts(uid)
+    if not facts:
+        return None
+    if digest:
+        return facts
+    fut = sender.send_text_from_env(agent.generate_push_from_facts(uid, facts))
+    logger.info("Scheduler: queued re-engagement push for idle user %s", uid)
+    return fut
+
+
+def _send_digest(user_facts):
+    """Digest mode: one markdown message (split at the size limit) for the whole cycle."""
+    user_facts = {uid: facts for uid, facts in user_facts.items() if facts}
+    if not user_facts:
+        return
+    pushes = {}
+    with tracing.span("scheduler.digest", users=len(user_facts)):
+        if config.PUSH_MODE == "digest_batch":
+            uids = list(user_facts)
+            size = max(1, config.PUSH_BATCH_SIZE)
+            for i in range(0, len(uids), size):
+                pushes.update(agent.generate_pushes_for_users({uid: user_facts[uid] for uid in uids[i:i + size]}))
+        else:
+            for uid, facts in user_facts.items():
+                pushes[uid] = agent.generate_push_from_facts(uid, facts)
+        # headed by the user's nick; staff ids are not shown in the group
+        sections = []
+        for uid, text in pushes.items():
+            name = activity.display_name(uid)
+            sections.append(f"#### {name}\n\n{text}" if name else text)
+        with sender.route(digest=True):
+            parts = sender.send_markdown_from_env(config.PUSH_DIGEST_TITLE, "\n\n".join(sections))
+    logger.info("Scheduler: queued digest for %d users in %d message(s)", len(pushes), len(parts))
+    _mark_pushed_when_sent(list(pushes), parts)
+
+
+def _mark_pushed_when_sent(uids: List[str], futures) -> None:
+    """Record `uids` as pushed once every part of their push (a digest or a single
+    user's message) has been delivered."""
+    remaining = [len(futures)]
+    failed = []
+    lock = threading.Lock()
+
+    def done(fut):
+        exc = fut.exception()
+        result = None if exc is not None else fut.result()
+        with lock:
+            remaining[0] -= 1
+            if exc is not None or not (isinstance(result, dict) and result.get("errcode") == 0):
+                failed.append(exc or result)
+            last = remaining[0] == 0
+        if not last:
+            return
+        if failed:
+            logger.error("Scheduler: push for %d user(s) was not delivered: %s", len(uids), failed[0])
+        else:
+            # saved with the next cycle's activity state
+            activity.mark_pushed(uids)
+            membership = get_membership()
+            if membership is not None:
+                try:
+                    membership.record_pushed(uids)
+                except Exception:
+                    logger.exception("Scheduler: failed to record the push in the cluster database")
+
+    for fut in futures:
+        fut.add_done_callback(done)
+
+
+def stats() -> dict:
+    return {"running": sched is not None, "mode": "spread" if spread_mode() else "cycle",
+            "workers": config.SCHEDULER_WORKERS,
+            "budget_seconds": _cycle_budget(), "last_cycle": dict(_last_cycle), "activity": activity.stats(),
+            "cluster": _membership.stats() if _membership is not None else None}
 
 
 def _job_wrapper():
     try:
-        run_cycle()
+        run_tick() if spread_mode() else run_cycle()
     except Exception:
         logger.exception("Scheduler: unexpected error during run_cycle")
 
 
 def start():
-    global sched
+    global sched, _singleton
     if sched:
         return
     if not APSCHEDULER_AVAILABLE:
         logger.warning("APScheduler not available; scheduler will not start. Install 'APScheduler' to enable scheduled tasks.")
         return
+    membership = get_membership()
+    # one scheduler per host even in cluster mode: with DINGBOT_ROLE=all every web worker
+    # would otherwise join as a node and they would overwrite each other's ACTIVITY_FILE
+    if _singleton is None:
+        _singleton = try_lock_exclusive(config.SCHEDULER_LOCK_FILE)
+        if _singleton is None:
+            logger.info("Scheduler already running in another process (%s is locked); not starting here",
+                        config.SCHEDULER_LOCK_FILE)
+            return
+    from apscheduler.schedulers.background import BackgroundScheduler
+
     sched = BackgroundScheduler()
-    sched.add_job(_job_wrapper, "interval", seconds=config.CHECK_INTERVAL_SECONDS, max_instances=1)
+    if membership is not None:
+        membership.heartbeat()
+        atexit.register(membership.leave)
+        sched.add_job(_heartbeat, "interval", seconds=max(1.0, membership.lease_seconds / 3), max_instances=1)
+    if spread_mode():
+        sched.add_job(_job_wrapper, "interval", seconds=config.SCHEDULER_TICK_SECONDS,
+                      jitter=config.SCHEDULER_TICK_JITTER_SECONDS or None, max_instances=1)
+    else:
+        sched.add_job(_job_wrapper, "interval", seconds=config.CHECK_INTERVAL_SECONDS, max_instances=1)
     sched.start()
-    logger.info("Scheduler started (check interval %s seconds)", config.CHECK_INTERVAL_SECONDS)
+    logger.info("Scheduler started (check interval %s seconds, %s mode)", config.CHECK_INTERVAL_SECONDS,
+                "spread" if spread_mode() else "cycle")
 
 
 if __name__ == "__main__":
+    if config.METRICS_DIR:
+        # served by the web workers' /metrics
+        metrics.start_snapshots(config.METRICS_DIR, config.METRICS_SNAPSHOT_SECONDS)
+    sender.start()
     start()
     try:
         # keep running
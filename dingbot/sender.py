@@ -1,33 +1,185 @@
-"""Small wrapper to send messages to DingTalk custom robot"""
+"""Small wrapper to send messages to DingTalk custom robot
+
+All sends (webhook replies and scheduler pushes) share one keep-alive `requests.Session`
+per process with a sized connection pool, so consecutive messages reuse the TLS
+connection to oapi.dingtalk.com. Signed URLs are reused for `SENDER_SIGN_REUSE_SECONDS`
+(DingTalk accepts a timestamp up to an hour old).
+
+`send_text_from_env` goes through a rate-limited outbound queue (see `outbound`), so a
+robot is never sent to faster than `SENDER_RATE_PER_MINUTE` (across all processes that
+share `SENDER_RATE_DB`) and interactive replies go ahead of scheduled pushes; it
+returns a `Future` for the send result. Code that sends pushes wraps itself in
+`with sender.priority_class(sender.PRIORITY_PUSH):`.
+
+With `OUTBOX_ENABLED` every queued message is first persisted to a SQLite outbox
+(see `outbox`) and only then sent, with retries; `start()` replays messages a previous
+process left undelivered.
+
+Several robots can be configured (`DINGTALK_ROBOTS`, see `robots`). Inside
+`with sender.route(conversation_id=...)` replies go to that conversation's robot,
+inside `with sender.route(user_id=...)` pushes are sharded over the robots by user,
+and `with sender.route(digest=True)` sends to the digest robot; the outbound queue
+sends to different robots concurrently (`SENDER_CONCURRENCY`).
+`broadcast_text` sends one message to every robot (group) at once.
+"""
 
 import time
 import hmac
 import hashlib
 import base64
+import contextlib
+import contextvars
+import threading
 import urllib.parse
-import requests
 import logging
 import os
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from . import config
+from concurrent.futures import Future
+
+from . import config, metrics, tracing, robots
+from .hashing import stable_hash
+from .outbound import OutboundQueue, PRIORITY_PUSH, PRIORITY_REPLY
+from .outbox import Outbox, OutboxDrainer
+from .ratelimit import SharedTokenBucket, TokenBucket
+
+if TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger(__name__)
+SENDS = metrics.counter("dingbot_dingtalk_sends_total", "DingTalk robot sends by result (ok, error, failed, simulated).")
 # If set, do not perform network requests and instead log/send success
 DISABLE_NETWORK = os.environ.get("DINGBOT_DISABLE_NETWORK")
 
+_session: Optional["requests.Session"] = None
+_session_pid = None
+_session_lock = threading.Lock()
+# (access_token, secret) -> (signed at, url)
+_signed_cache = {}
+_sign_stats = {"signed": 0, "reused": 0}
 
-def _signed_url(access_token: str, secret: str) -> str:
-    timestamp = str(round(time.time() * 1000))
+
+def _new_session() -> "requests.Session":
+    # imported on the first real send; processes with the network disabled never pay for it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Robot sends are not idempotent: retry only when the request surely wasn't
+    # processed (connection failures, 429/503), never after a read timeout.
+    retry = Retry(
+        total=config.SENDER_RETRIES,
+        connect=config.SENDER_RETRIES,
+        read=0,
+        status=config.SENDER_RETRIES,
+        status_forcelist=(429, 503),
+        allowed_methods=frozenset(["POST"]),
+        backoff_factor=config.SENDER_RETRY_BACKOFF,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=config.SENDER_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+def get_session() -> "requests.Session":
+    """The process-wide sender session (recreated after a fork)."""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _new_session()
+                _session_pid = pid
+    return _session
+
+
+def _sign(timestamp: str, secret: str) -> str:
     string_to_sign = f"{timestamp}\n{secret}"
     hmac_code = hmac.new(
         secret.encode("utf-8"), string_to_sign.encode("utf-8"), digestmod=hashlib.sha256
     ).digest()
-    sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
-    url = f"https://oapi.dingtalk.com/robot/send?access_token={access_token}&timestamp={timestamp}&sign={sign}"
+    return urllib.parse.quote_plus(base64.b64encode(hmac_code))
+
+
+def _signed_url(access_token: str, secret: str) -> str:
+    now = time.time()
+    key = (config.DINGTALK_API_BASE, access_token, secret)
+    cached = _signed_cache.get(key)
+    if cached is not None and now - cached[0] < config.SENDER_SIGN_REUSE_SECONDS:
+        _sign_stats["reused"] += 1
+        return cached[1]
+    timestamp = str(round(now * 1000))
+    url = f"{config.DINGTALK_API_BASE.rstrip('/')}/robot/send?access_token={access_token}&timestamp={timestamp}&sign={_sign(timestamp, secret)}"
+    _signed_cache[key] = (now, url)
+    _sign_stats["signed"] += 1
     return url
 
 
+def warmup(timeout: float = 5) -> dict:
+    """Sign every robot's URL and open a pooled connection to the DingTalk API ahead of the first send."""
+    bots = robots.all_robots()
+    for r in bots:
+        _signed_url(r.access_token, r.secret)
+    if DISABLE_NETWORK or not bots:
+        return {"robots": len(bots), "connected": False}
+    try:
+        # any answer will do: the point is the DNS lookup and TLS handshake, and the
+        # connection stays in the session's pool for the first real send
+        get_session().head(config.DINGTALK_API_BASE, timeout=timeout)
+    except Exception as exc:
+        logger.warning("Sender: warmup connection to %s failed: %s", config.DINGTALK_API_BASE, exc)
+        return {"robots": len(bots), "connected": False}
+    return {"robots": len(bots), "connected": True}
+
+
+def _at(at_user_ids: Optional[List[str]], at_mobiles: Optional[List[str]], is_at_all: bool) -> dict:
+    return {
+        "isAtAll": bool(is_at_all),
+        "atUserIds": at_user_ids or [],
+        "atMobiles": at_mobiles or [],
+    }
+
+
+def post_message(access_token: str, secret: str, body: dict) -> dict:
+    """POST a ready-made robot message body (text, markdown, ...) and return DingTalk's answer."""
+    url = _signed_url(access_token, secret)
+    if DISABLE_NETWORK:
+        # Simulate success response when network disabled for local testing
+        data = {"errcode": 0, "errmsg": "network disabled (local test)", "simulated": True}
+        logger.info("send_%s (simulated): %s", body.get("msgtype"), data)
+        SENDS.inc(result="simulated")
+        return data
+
+    robot = robots.by_token(access_token)
+    start = time.perf_counter()
+    try:
+        with tracing.span("sender.post", robot=str(robot)), metrics.STAGE_SECONDS.time(stage="dingtalk_send"):
+            resp = get_session().post(
+                url, json=body, timeout=(config.SENDER_CONNECT_TIMEOUT, config.SENDER_READ_TIMEOUT)
+            )
+    except Exception as exc:
+        SENDS.inc(result="failed")
+        if robot is not None:
+            robot.record(time.perf_counter() - start, False, repr(exc))
+        raise
+    try:
+        data = resp.json()
+    except Exception:
+        data = {"status_code": resp.status_code, "text": resp.text}
+    ok = data.get("errcode") == 0
+    SENDS.inc(result="ok" if ok else "error")
+    if robot is not None:
+        throttled = data.get("errcode") == THROTTLED_ERRCODE or data.get("status_code") == 429
+        robot.record(time.perf_counter() - start, ok, None if ok else str(data)[:200], throttled=throttled)
+    logger.info("send_%s response: %s", body.get("msgtype"), data)
+    return data
+
+
 def send_text(
     access_token: str,
     secret: str,
@@ -37,34 +189,320 @@ def send_text(
     is_at_all: bool = False,
 ) -> dict:
     """Send a simple text message to the DingTalk robot."""
-    url = _signed_url(access_token, secret)
-
     body = {
-        "at": {
-            "isAtAll": bool(is_at_all),
-            "atUserIds": at_user_ids or [],
-            "atMobiles": at_mobiles or [],
-        },
+        "at": _at(at_user_ids, at_mobiles, is_at_all),
         "text": {"content": msg},
         "msgtype": "text",
     }
-    headers = {"Content-Type": "application/json"}
-    if DISABLE_NETWORK:
-        # Simulate success response when network disabled for local testing
-        data = {"errcode": 0, "errmsg": "network disabled (local test)", "simulated": True}
-        logger.info("send_text (simulated): %s", data)
-        return data
+    return post_message(access_token, secret, body)
+
+
+def send_markdown(
+    access_token: str,
+    secret: str,
+    title: str,
+    text: str,
+    at_user_ids: Optional[List[str]] = None,
+    is_at_all: bool = False,
+) -> dict:
+    """Send a markdown message (`title` is what the chat list preview shows)."""
+    body = {
+        "at": _at(at_user_ids, None, is_at_all),
+        "markdown": {"title": title, "text": text},
+        "msgtype": "markdown",
+    }
+    return post_message(access_token, secret, body)
+
+
+def split_markdown(text: str, max_bytes: int) -> List[str]:
+    """Split markdown into chunks of at most `max_bytes` UTF-8 bytes, preferring section
+    boundaries (a heading and everything up to the next heading), then blank lines,
+    then line boundaries."""
+    if len(text.encode("utf-8")) <= max_bytes:
+        return [text]
+    chunks: List[str] = []
+    current = ""
+
+    def size(s: str) -> int:
+        return len(s.encode("utf-8"))
 
-    resp = requests.post(url, json=body, headers=headers, timeout=10)
+    def flush():
+        nonlocal current
+        if current.strip():
+            chunks.append(current.strip("\n"))
+        current = ""
+
+    def add(piece: str, sep: str) -> bool:
+        """Append `piece` to the current chunk if it fits, else start a new chunk with it
+        if that fits; False if `piece` alone is too big."""
+        nonlocal current
+        candidate = f"{current}{sep}{piece}" if current else piece
+        if size(candidate) <= max_bytes:
+            current = candidate
+            return True
+        flush()
+        if size(piece) <= max_bytes:
+            current = piece
+            return True
+        return False
+
+    sections: List[str] = []
+    for block in text.split("\n\n"):
+        if sections and not block.lstrip().startswith("#"):
+            sections[-1] += "\n\n" + block
+        else:
+            sections.append(block)
+
+    for section in sections:
+        if add(section, "\n\n"):
+            continue
+        # an oversized section: fall back to blocks, then lines, and hard-split oversized lines
+        for block in section.split("\n\n"):
+            if add(block, "\n\n"):
+                continue
+            for line in block.split("\n"):
+                while size(line) > max_bytes:
+                    cut = max_bytes
+                    while size(line[:cut]) > max_bytes:
+                        cut -= 1
+                    flush()
+                    chunks.append(line[:cut])
+                    line = line[cut:]
+                add(line, "\n")
+    flush()
+    return chunks
+
+
+# DingTalk's "send too fast" error
+THROTTLED_ERRCODE = 130101
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("dingbot_send_priority", default=PRIORITY_REPLY)
+# (conversation_id, user_id) the current sends belong to, for picking a robot
+_route: contextvars.ContextVar = contextvars.ContextVar("dingbot_send_route", default=(None, None, False))
+_outbound: Optional[OutboundQueue] = None
+_outbound_pid = None
+
+
+@contextlib.contextmanager
+def priority_class(value: int):
+    """Send everything inside the block with this priority class (e.g. PRIORITY_PUSH)."""
+    token = _priority.set(value)
     try:
-        data = resp.json()
-    except Exception:
-        data = {"status_code": resp.status_code, "text": resp.text}
-    logger.info("send_text response: %s", data)
-    return data
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextlib.contextmanager
+def route(conversation_id: Optional[str] = None, user_id: Optional[str] = None, digest: bool = False):
+    """Route sends inside the block to the conversation's robot, shard them by user, or
+    send them to the digest robot."""
+    token = _route.set((conversation_id, user_id, digest))
+    try:
+        yield
+    finally:
+        _route.reset(token)
+
+
+def _pick_robot() -> robots.Robot:
+    conversation_id, user_id, digest = _route.get()
+    if digest:
+        robot = robots.for_digest()
+    elif user_id:
+        robot = robots.for_user(user_id)
+    else:
+        robot = robots.for_conversation(conversation_id)
+    if robot is None:
+        raise RuntimeError("ACCESS_TOKEN and SECRET (or DINGTALK_ROBOTS) must be set in environment or config")
+    return robot
+
+
+def _send_queued(access_token: str, payload: dict) -> dict:
+    return post_message(access_token, payload["secret"], payload["body"])
+
+
+def _rate_bucket(access_token: str, rate: float, burst: float):
+    if not config.SENDER_RATE_DB:
+        return TokenBucket(rate, burst)
+    # keyed by a hash: the access token is a credential
+    return SharedTokenBucket(config.SENDER_RATE_DB, f"robot:{stable_hash(access_token):016x}", rate, burst)
+
+
+def get_outbound() -> OutboundQueue:
+    """The process-wide outbound queue (recreated after a fork)."""
+    global _outbound, _outbound_pid
+    pid = os.getpid()
+    if _outbound is None or _outbound_pid != pid:
+        with _session_lock:
+            if _outbound is None or _outbound_pid != pid:
+                _outbound = OutboundQueue(
+                    _send_queued,
+                    rate_per_minute=config.SENDER_RATE_PER_MINUTE,
+                    burst=config.SENDER_BURST,
+                    max_depth=config.SENDER_QUEUE_MAX,
+                    is_throttled=lambda r: isinstance(r, dict) and r.get("errcode") == THROTTLED_ERRCODE,
+                    throttle_retries=config.SENDER_THROTTLE_RETRIES,
+                    throttle_backoff=config.SENDER_THROTTLE_BACKOFF_SECONDS,
+                    concurrency=config.SENDER_CONCURRENCY,
+                    name="dingtalk-outbound",
+                    bucket_factory=_rate_bucket,
+                ).start()
+                _outbound_pid = pid
+    return _outbound
+
+
+_drainer: Optional[OutboxDrainer] = None
+_drainer_pid = None
+
+
+def _secret_for(access_token: str) -> str:
+    robot = robots.by_token(access_token)
+    if robot is None:
+        raise RuntimeError("no secret configured for this robot")
+    return robot.secret
+
+
+def _submit_outbound(access_token: str, body: dict, priority: int) -> Future:
+    return get_outbound().submit(access_token, {"secret": _secret_for(access_token), "body": body}, priority)
+
+
+def _classify(result) -> Optional[str]:
+    """Outbox verdict for a send result: None = delivered, "retry" or "fail".
+
+    Only throttling is retried: DingTalk rejected the message outright. An HTTP error
+    page (5xx from a gateway) may come after the message was already posted, so it is
+    marked failed rather than risk a duplicate.
+    """
+    if not isinstance(result, dict):
+        return "fail"
+    if result.get("errcode") == 0:
+        return None
+    if result.get("errcode") == THROTTLED_ERRCODE or result.get("status_code") == 429:
+        return "retry"
+    return "fail"
+
+
+def _classify_error(exc: BaseException) -> str:
+    """Outbox verdict for a send that raised: retry only DNS and connect failures.
+
+    Read timeouts and dropped connections are marked failed: the request may have
+    reached DingTalk, and the robot API has no idempotency key to make a retry safe.
+    """
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return "retry"
+    if not isinstance(exc, requests.exceptions.ConnectionError):
+        return "fail"
+    # requests wraps urllib3's MaxRetryError, whose `reason` is the underlying error
+    cause = exc.args[0] if exc.args else None
+    for _ in range(3):
+        if isinstance(cause, NewConnectionError):  # includes NameResolutionError
+            return "retry"
+        cause = getattr(cause, "reason", None)
+    return "fail"
+
+
+def get_drainer() -> OutboxDrainer:
+    """The process-wide outbox drainer (recreated after a fork); starting it replays
+    pending messages."""
+    global _drainer, _drainer_pid
+    pid = os.getpid()
+    if _drainer is None or _drainer_pid != pid:
+        with _session_lock:
+            if _drainer is None or _drainer_pid != pid:
+                _drainer = OutboxDrainer(
+                    Outbox(config.OUTBOX_PATH, lease_seconds=config.OUTBOX_LEASE_SECONDS),
+                    _submit_outbound,
+                    _classify,
+                    _classify_error,
+                    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+                    retry_base=config.OUTBOX_RETRY_BASE_SECONDS,
+                    poll_seconds=config.OUTBOX_POLL_SECONDS,
+                    retention_seconds=config.OUTBOX_RETENTION_SECONDS,
+                ).start()
+                _drainer_pid = pid
+    return _drainer
+
+
+def start() -> None:
+    """Start background sending (and replay the outbox) if it is enabled."""
+    if config.OUTBOX_ENABLED and not DISABLE_NETWORK and config.SENDER_RATE_PER_MINUTE > 0:
+        get_drainer()
+
+
+def _submit_to(robot: robots.Robot, body: dict, priority: Optional[int]) -> Future:
+    if DISABLE_NETWORK or config.SENDER_RATE_PER_MINUTE <= 0:
+        # nothing reaches DingTalk (or limiting is off): send inline
+        future: Future = Future()
+        try:
+            future.set_result(post_message(robot.access_token, robot.secret, body))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+    priority = _priority.get() if priority is None else priority
+    if config.OUTBOX_ENABLED:
+        # only a local write on the request path; delivery and retries happen in the background
+        return get_drainer().enqueue(robot.access_token, body, priority)
+    return _submit_outbound(robot.access_token, body, priority)
+
+
+def _submit_from_env(body: dict, priority: Optional[int]) -> Future:
+    return _submit_to(_pick_robot(), body, priority)
+
+
+def send_text_from_env(msg: str, at_user_ids: Optional[List[str]] = None, priority: Optional[int] = None) -> Future:
+    """Queue a text message to the configured robot; returns a Future of the send result.
+
+    Raises `workqueue.QueueFull` if the outbound queue is saturated.
+    """
+    body = {"at": _at(at_user_ids, None, False), "text": {"content": msg}, "msgtype": "text"}
+    return _submit_from_env(body, priority)
+
+
+def send_markdown_from_env(title: str, text: str, priority: Optional[int] = None) -> List[Future]:
+    """Queue a markdown message, split into several messages at `SENDER_MARKDOWN_MAX_BYTES`."""
+    chunks = split_markdown(text, config.SENDER_MARKDOWN_MAX_BYTES)
+    futures = []
+    for i, chunk in enumerate(chunks):
+        part_title = title if len(chunks) == 1 else f"{title} ({i + 1}/{len(chunks)})"
+        body = {"at": _at(None, None, False), "markdown": {"title": part_title, "text": chunk}, "msgtype": "markdown"}
+        futures.append(_submit_from_env(body, priority))
+    return futures
+
+
+def broadcast_text(msg: str, robot_names: Optional[List[str]] = None,
+                   priority: Optional[int] = None) -> Dict[str, Future]:
+    """Send `msg` to every configured robot (or the named ones); they are sent concurrently."""
+    body = {"at": _at(None, None, False), "text": {"content": msg}, "msgtype": "text"}
+    targets = [r for r in robots.all_robots() if robot_names is None or r.name in robot_names]
+    return {r.name: _submit_to(r, body, priority) for r in targets}
+
+
+def stats() -> dict:
+    """Connection pool, signing, queue and per-robot counters of this process."""
+    pools = []
+    session = _session if _session_pid == os.getpid() else None
+    if session is not None:
+        adapter = session.get_adapter("https://")
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                "host": pool.host,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": pool.pool.qsize() if pool.pool is not None else 0,
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+            })
+    outbound = _outbound.stats() if _outbound is not None and _outbound_pid == os.getpid() else None
+    outbox = _drainer.stats() if _drainer is not None and _drainer_pid == os.getpid() else None
+    return {"pools": pools, **_sign_stats, "outbound": outbound, "outbox": outbox, "robots": robots.stats()}
 
 
-def send_text_from_env(msg: str, at_user_ids: Optional[List[str]] = None):
-    if not config.ACCESS_TOKEN or not config.SECRET:
-        raise RuntimeError("ACCESS_TOKEN and SECRET must be set in environment or config")
-    return send_text(config.ACCESS_TOKEN, config.SECRET, msg, at_user_ids=at_user_ids)
+metrics.gauge("dingbot_dingtalk_connections_opened", "HTTP connections opened to DingTalk by this process.",
+              lambda: sum(p["connections_opened"] for p in stats()["pools"]))
+metrics.gauge("dingbot_outbound_queue_depth", "Messages waiting in the DingTalk outbound queue.",
+              lambda: _outbound.depth() if _outbound is not None else 0)
@@ -9,169 +9,431 @@ Supports mini-commands:
 On ordinary messages, the server forwards the message + recent memories to the `agent` which returns
 a JSON-style response {"reply": <text>, optional "save_memory": {...}}.
 Replies to incoming messages will @ the sender when sender id is available.
+
+With `WEBHOOK_ASYNC=1` ordinary messages are only logged and queued; the webhook returns
+immediately and a pool of background workers (one ordered lane per user) runs the agent
+and delivers the reply through `sender`. With `COALESCE_WINDOW_SECONDS>0` a user's
+messages arriving within that window are merged and answered with a single reply.
 """
 
 import time
-import json
+
+# start of the import-time measurement reported by init_app and /stats
+_import_started = time.perf_counter()
+
+import hmac
 import logging
-from flask import Flask, request, jsonify
+import contextvars
+import threading
+from concurrent.futures import Future
+from flask import Flask, Response, request, jsonify
 
-from . import sender, agent, memory, config, scheduler
+from . import sender, agent, memory, config, retrieval, scheduler, summarizer, dedup, admission, metrics, tracing, profiling, logutil
+from .workqueue import KeyedWorkQueue, QueueFull
+from .coalesce import Coalescer
 
-logging.basicConfig(level=logging.INFO)
+logutil.configure()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# background reply workers, created by init_app when WEBHOOK_ASYNC is enabled
+work_queue = None
+# per-user debounce window in front of the work queue (COALESCE_WINDOW_SECONDS > 0)
+coalescer = None
+# recently seen webhook deliveries (DingTalk retries slow callbacks)
+dedup_cache = dedup.from_config()
+# in-flight / per-user / per-group limits for model turns
+admission_control = admission.AdmissionController.from_config()
+
+WEBHOOK_REQUESTS = metrics.counter(
+    "dingbot_webhook_requests_total",
+    "Webhook deliveries by kind (command, message, duplicate, ignored, error); rejected counts messages turned away.",
+)
+metrics.gauge("dingbot_webhook_queue_depth", "Messages waiting in the async reply queue.",
+              lambda: work_queue.depth() if work_queue is not None else 0)
+metrics.gauge("dingbot_model_inflight", "Messages currently inside a synchronous model turn.",
+              lambda: admission_control.stats()["inflight"])
+metrics.gauge("dingbot_dedup_hit_ratio", "Share of webhook deliveries answered from the dedup cache.",
+              lambda: dedup_cache.stats()["hit_rate"])
+
+startup = {"import_seconds": round(time.perf_counter() - _import_started, 4), "init_seconds": None, "warmup": None}
+# cleared while the startup warmup runs; `/` reports not ready until it is set again
+ready = threading.Event()
+ready.set()
+_warmup_started = None
+
+
+def _warmup() -> None:
+    """Pay the first chat's setup costs up front: model client, model name, connections, indexes."""
+    started = time.perf_counter()
+    steps = (
+        ("model", agent.warmup),
+        ("dingtalk", lambda: sender.warmup(timeout=min(5, config.WARMUP_TIMEOUT_SECONDS))),
+        ("history", lambda: {"users": retrieval.preload(config.WARMUP_RECENT_USERS)}),
+    )
+    results = {}
+    try:
+        for name, step in steps:
+            step_started = time.perf_counter()
+            try:
+                result = step()
+            except Exception:
+                logger.exception("Warmup: %s step failed", name)
+                result = {"error": True}
+            results[name] = dict(result, seconds=round(time.perf_counter() - step_started, 4))
+    finally:
+        startup["warmup"] = dict(results, seconds=round(time.perf_counter() - started, 4))
+        ready.set()
+    logger.info("Startup: warmup took %.0f ms (%s)", startup["warmup"]["seconds"] * 1000,
+                ", ".join(f"{k} {v['seconds'] * 1000:.0f} ms" for k, v in results.items()))
+
+
+def is_ready() -> bool:
+    """Warmup finished (or is off), or has run past WARMUP_TIMEOUT_SECONDS."""
+    if ready.is_set():
+        return True
+    return _warmup_started is not None and time.monotonic() - _warmup_started > config.WARMUP_TIMEOUT_SECONDS
+
+
+def init_app(start_scheduler: bool = True, start_summarizer: bool = True):
+    """Initialize DB and the outbox sender, optionally start the background scheduler and summarizer.
 
-def init_app(start_scheduler: bool = True):
-    """Initialize DB and optionally start the background scheduler."""
+    With WARMUP_ENABLED the warmup runs in a background thread and `/` reports not ready until it is done.
+    """
+    global work_queue, coalescer, _warmup_started
+    init_started = time.perf_counter()
     memory.init_db()
+    if config.METRICS_DIR:
+        metrics.start_snapshots(config.METRICS_DIR, config.METRICS_SNAPSHOT_SECONDS)
+    # replays messages a previous process left in the outbox
+    sender.start()
+    coalescing = config.COALESCE_WINDOW_SECONDS > 0
+    if (config.WEBHOOK_ASYNC or coalescing) and work_queue is None:
+        work_queue = KeyedWorkQueue(config.WEBHOOK_WORKERS, config.WEBHOOK_QUEUE_MAX, name="webhook").start()
+    if coalescing and coalescer is None:
+        coalescer = Coalescer(config.COALESCE_WINDOW_SECONDS, config.COALESCE_MAX_WAIT_SECONDS, _flush_coalesced).start()
+    if start_summarizer:
+        summarizer.start()
     if start_scheduler:
         scheduler.start()
+    if config.WARMUP_ENABLED and _warmup_started is None:
+        ready.clear()
+        _warmup_started = time.monotonic()
+        threading.Thread(target=_warmup, name="dingbot-warmup", daemon=True).start()
+    startup["init_seconds"] = round(time.perf_counter() - init_started, 4)
+    logger.info("Startup: dingbot.server imported in %.0f ms, init_app took %.0f ms",
+                startup["import_seconds"] * 1000, startup["init_seconds"] * 1000)
+
+
+def _process_message(content: str, sender_name: str, sender_id: str = None) -> str:
+    """Run the agent for an ordinary message and deliver the reply; returns the reply text."""
+    # in async mode this runs on a work-queue thread, outside the request's profile
+    with profiling.job():
+        return _reply(content, sender_name, sender_id)
+
+
+def _reply(content: str, sender_name: str, sender_id: str = None) -> str:
+    with tracing.span("agent.analyze_and_reply"):
+        result = agent.analyze_and_reply(content, sender_name, user_id=sender_id or sender_name)
+    reply = result.get("reply") or "抱歉，未能生成回复。"
+    # 发送给钉钉会话（@ sender when available)；错误不应阻断对调用方的响应
+    try:
+        if sender_id:
+            future = sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        else:
+            future = sender.send_text_from_env(reply)
+    except Exception:
+        # e.g. the outbound queue is full
+        logger.exception("Failed to queue reply via sender; will still return reply to webhook caller")
+    else:
+        if isinstance(future, Future):
+            future.add_done_callback(_log_failed_send)
+    return reply
+
+
+def _log_failed_send(future) -> None:
+    """Done-callback for a queued reply: the send itself happens after the request returned."""
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Reply was not delivered: %s", exc)
+        return
+    result = future.result()
+    if isinstance(result, dict) and result.get("errcode") != 0:
+        logger.error("Reply was rejected by DingTalk: %s", result)
+
+
+def _flush_coalesced(uid: str, items) -> None:
+    """Coalescer callback: queue one model turn for a burst of messages from `uid`."""
+    content = "\n".join(i[0] for i in items)
+    sender_name, sender_id, ctx = items[-1][1], items[-1][2], items[-1][3]
+    if len(items) > 1:
+        logger.info("Webhook: coalesced %d messages from %s into one turn", len(items), uid)
+    try:
+        # run under the last message's context so the turn joins that request's trace
+        ctx.run(work_queue.submit, uid, _process_message, content, sender_name, sender_id)
+        admission_control.admit(len(items))
+    except QueueFull:
+        # the webhook already answered "queued": tell the user here instead of going silent
+        admission_control.reject("queue_full")
+        WEBHOOK_REQUESTS.inc(kind="rejected")
+        logger.warning("Webhook queue full; answering coalesced turn from %s with the busy reply", uid)
+        try:
+            ctx.run(sender.send_text_from_env, admission.BUSY_REPLY, at_user_ids=[sender_id] if sender_id else None)
+        except Exception:
+            logger.exception("Failed to send the busy reply to %s", uid)
 
 
+def _busy(uid: str, reason: str):
+    """Fast degraded answer used when admission control rejects a message."""
+    logger.warning("Webhook: rejected message from %s (%s)", uid, reason)
+    WEBHOOK_REQUESTS.inc(kind="rejected")
+    resp = Response(admission.BUSY_REPLY, mimetype='text/plain')
+    resp.headers["X-DingBot-Degraded"] = reason
+    return resp
+
 
 @app.before_request
 def log_request():
-    logger.info("Received request: %s %s from %s", request.method, request.path, request.remote_addr)
+    # gunicorn's access log already records every request; keep this at DEBUG
+    logger.debug("Received request: %s %s from %s", request.method, request.path, request.remote_addr)
 
 
 @app.route("/", methods=["GET"])
 def health_check():
+    if not is_ready():
+        return jsonify({"status": "warming_up", "message": "DingBot Server is warming up"}), 503
     return jsonify({"status": "ok", "message": "DingBot Server is running"})
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Runtime counters for the webhook pipeline (dedup, queue depth, coalescing, admission)."""
+    return jsonify({
+        "dedup": dedup_cache.stats(),
+        "webhook_queue": work_queue.stats() if work_queue is not None else None,
+        "coalescer": coalescer.stats() if coalescer is not None else None,
+        "admission": admission_control.stats(),
+        "profiling": profiling.stats(),
+        "logging": logutil.stats(),
+        "sender": sender.stats(),
+        "scheduler": scheduler.stats(),
+        "startup": startup,
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text exposition of this process's counters and histograms."""
+    return Response(metrics.render(config.METRICS_DIR), mimetype="text/plain; version=0.0.4")
+
+
+def _admin_authorized() -> bool:
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(config.ADMIN_TOKEN) and hmac.compare_digest(token, config.ADMIN_TOKEN)
+
+
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    """Show or change profiling sampling: POST {"sample_rate": 0.05, "scheduler_every": 10}."""
+    if not _admin_authorized():
+        return jsonify({"errcode": 1, "errmsg": "forbidden"}), 403
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        try:
+            profiling.set_sampling(body.get("sample_rate"), body.get("scheduler_every"))
+        except (TypeError, ValueError) as exc:
+            return jsonify({"errcode": 1, "errmsg": f"bad value: {exc}"}), 400
+    return jsonify(profiling.stats())
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    # the trace id doubles as the request id propagated to agent/storage/sender spans
+    with tracing.start_trace("webhook", path=request.path) as root, profiling.maybe_profile("webhook"):
+        resp = app.make_response(_webhook())
+        root.set("http.status_code", resp.status_code)
+    resp.headers["X-Request-Id"] = root.trace_id
+    return resp
+
+
+def _webhook():
     try:
-        data = request.json or {}
-        logger.info("Webhook payload: %s", json.dumps(data, ensure_ascii=False))
+        with metrics.STAGE_SECONDS.time(stage="webhook_parse"):
+            data = request.json or {}
+        logger.info("Webhook payload: %s", logutil.Payload(data))
 
         msg_type = data.get("msgtype")
         if msg_type != "text":
+            WEBHOOK_REQUESTS.inc(kind="ignored")
             return jsonify({"errcode": 0, "errmsg": "ignored non-text"})
 
-        content = data.get("text", {}).get("content", "").strip()
-        sender_name = data.get("senderNick") or data.get("senderName") or "Unknown"
-        # attempt to find an ID to @
-        sender_id = data.get("senderId") or data.get("senderStaffId") or data.get("userid")
-
-        # commands
-        if content.startswith("/help"):
-            reply = "可用命令:\n/remember <interval_seconds> <text> - 保存记忆并按周期推送\n/forget <id> - 删除记忆\n/memories - 列出你的记忆\n/ping - 测试机器人\n/time - 获取当前时间"
-            if sender_id:
-                sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        # 钉钉会重投递慢回调：同一消息只处理一次，重复投递直接返回首次结果或快速确认
+        key = dedup.message_key(data, first_seen=dedup_cache.first_seen_at)
+        if key:
+            is_new, cached = dedup_cache.begin(key)
+            if not is_new:
+                logger.info("Webhook: duplicate delivery %s", key)
+                WEBHOOK_REQUESTS.inc(kind="duplicate")
+                if cached is dedup.PENDING:
+                    return jsonify({"errcode": 0, "errmsg": "duplicate"})
+                body, status, mimetype = cached
+                return Response(body, status=status, mimetype=mimetype)
+        try:
+            # replies go back through the robot of the conversation the message came from
+            with sender.route(conversation_id=data.get("conversationId")):
+                resp = app.make_response(_handle_text(data))
+        except Exception:
+            if key:
+                dedup_cache.forget(key)
+            raise
+        if key:
+            if resp.status_code >= 500:
+                dedup_cache.forget(key)
             else:
-                sender.send_text_from_env(reply)
-            return jsonify({"errcode": 0, "errmsg": "ok"})
+                dedup_cache.complete(key, (resp.get_data(), resp.status_code, resp.mimetype))
+        return resp
 
-        if content.startswith("/ping"):
-            reply = "pong! 机器人运行正常 ✅"
-            if sender_id:
-                sender.send_text_from_env(reply, at_user_ids=[sender_id])
-            else:
-                sender.send_text_from_env(reply)
-            return jsonify({"errcode": 0, "errmsg": "ok"})
+    except Exception as exc:
+        WEBHOOK_REQUESTS.inc(kind="error")
+        logger.exception("Failed to process webhook: %s", exc)
+        return jsonify({"errcode": 1, "errmsg": str(exc)}), 500
 
-        if content.startswith("/time"):
-            from datetime import datetime
 
-            reply = f"当前时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            if sender_id:
-                sender.send_text_from_env(reply, at_user_ids=[sender_id])
-            else:
-                sender.send_text_from_env(reply)
-            return jsonify({"errcode": 0, "errmsg": "ok"})
-
-        if content.startswith("/remember"):
-            parts = content.split(maxsplit=2)
-            if len(parts) < 3:
-                err = "用法: /remember <interval_seconds> <text>"
-                if sender_id:
-                    sender.send_text_from_env(err, at_user_ids=[sender_id])
-                else:
-                    sender.send_text_from_env(err)
-                return jsonify({"errcode": 1, "errmsg": "bad request"}), 400
-            try:
-                interval = int(parts[1])
-            except ValueError:
-                err = "interval_seconds 必须为整数（秒）"
-                if sender_id:
-                    sender.send_text_from_env(err, at_user_ids=[sender_id])
-                else:
-                    sender.send_text_from_env(err)
-                return jsonify({"errcode": 1, "errmsg": "bad interval"}), 400
-            text_to_remember = parts[2]
-            uid = sender_id or sender_name
-            mem_id = memory.add_memory(uid, text_to_remember, interval)
-            reply = f"已记录记忆 id={mem_id}, 每 {interval} 秒推送一次。"
-            if sender_id:
-                sender.send_text_from_env(reply, at_user_ids=[sender_id])
-            else:
-                sender.send_text_from_env(reply)
-            return jsonify({"errcode": 0, "errmsg": "ok"})
-
-        if content.startswith("/forget"):
-            parts = content.split(maxsplit=1)
-            if len(parts) < 2:
-                err = "用法: /forget <id>"
-                if sender_id:
-                    sender.send_text_from_env(err, at_user_ids=[sender_id])
-                else:
-                    sender.send_text_from_env(err)
-                return jsonify({"errcode": 1, "errmsg": "bad request"}), 400
-            try:
-                mid = int(parts[1])
-                memory.delete_memory(mid)
-                reply = f"已删除记忆 id={mid}"
-            except Exception:
-                reply = "指定 id 无效或不存在"
+def _handle_text(data):
+    """Handle a text message payload (commands or an ordinary message)."""
+    content = data.get("text", {}).get("content", "").strip()
+    sender_name = data.get("senderNick") or data.get("senderName") or "Unknown"
+    # attempt to find an ID to @
+    sender_id = data.get("senderId") or data.get("senderStaffId") or data.get("userid")
+
+    if content.startswith("/"):
+        WEBHOOK_REQUESTS.inc(kind="command")
+    # commands
+    if content.startswith("/help"):
+        reply = "可用命令:\n/remember <interval_seconds> <text> - 保存记忆并按周期推送\n/forget <id> - 删除记忆\n/memories - 列出你的记忆\n/ping - 测试机器人\n/time - 获取当前时间"
+        if sender_id:
+            sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        else:
+            sender.send_text_from_env(reply)
+        return jsonify({"errcode": 0, "errmsg": "ok"})
+
+    if content.startswith("/ping"):
+        reply = "pong! 机器人运行正常 ✅"
+        if sender_id:
+            sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        else:
+            sender.send_text_from_env(reply)
+        return jsonify({"errcode": 0, "errmsg": "ok"})
+
+    if content.startswith("/time"):
+        from datetime import datetime
+
+        reply = f"当前时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        if sender_id:
+            sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        else:
+            sender.send_text_from_env(reply)
+        return jsonify({"errcode": 0, "errmsg": "ok"})
+
+    if content.startswith("/remember"):
+        parts = content.split(maxsplit=2)
+        if len(parts) < 3:
+            err = "用法: /remember <interval_seconds> <text>"
             if sender_id:
-                sender.send_text_from_env(reply, at_user_ids=[sender_id])
-            else:
-                sender.send_text_from_env(reply)
-            return jsonify({"errcode": 0, "errmsg": "ok"})
-
-        if content.startswith("/memories"):
-            uid = sender_id or sender_name
-            mems = memory.list_user_memories(uid)
-            if not mems:
-                txt = "你没有记忆。使用 /remember 添加一个。"
+                sender.send_text_from_env(err, at_user_ids=[sender_id])
             else:
-                lines = [f"id={m['id']} interval={m['interval']}s: {m['content']}" for m in mems]
-                txt = "\n".join(lines)
+                sender.send_text_from_env(err)
+            return jsonify({"errcode": 1, "errmsg": "bad request"}), 400
+        try:
+            interval = int(parts[1])
+        except ValueError:
+            err = "interval_seconds 必须为整数（秒）"
             if sender_id:
-                sender.send_text_from_env(txt, at_user_ids=[sender_id])
+                sender.send_text_from_env(err, at_user_ids=[sender_id])
             else:
-                sender.send_text_from_env(txt)
-            return jsonify({"errcode": 0, "errmsg": "ok"})
+                sender.send_text_from_env(err)
+            return jsonify({"errcode": 1, "errmsg": "bad interval"}), 400
+        text_to_remember = parts[2]
+        uid = sender_id or sender_name
+        mem_id = memory.add_memory(uid, text_to_remember, interval)
+        reply = f"已记录记忆 id={mem_id}, 每 {interval} 秒推送一次。"
+        if sender_id:
+            sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        else:
+            sender.send_text_from_env(reply)
+        return jsonify({"errcode": 0, "errmsg": "ok"})
 
-        # 普通消息：记录到本地文件并转发给 agent
-        from .memory_file import append_user_message
-        from flask import Response
-        append_user_message(sender_id or sender_name, content)
-        result = agent.analyze_and_reply(content, sender_name, user_id=sender_id or sender_name)
-        reply = result.get("reply") or "抱歉，未能生成回复。"
-        # 发送给钉钉会话（@ sender when available)；错误不应阻断对调用方的响应
-        try:
+    if content.startswith("/forget"):
+        parts = content.split(maxsplit=1)
+        if len(parts) < 2:
+            err = "用法: /forget <id>"
             if sender_id:
-                sender.send_text_from_env(reply, at_user_ids=[sender_id])
+                sender.send_text_from_env(err, at_user_ids=[sender_id])
             else:
-                sender.send_text_from_env(reply)
+                sender.send_text_from_env(err)
+            return jsonify({"errcode": 1, "errmsg": "bad request"}), 400
+        try:
+            mid = int(parts[1])
+            memory.delete_memory(mid)
+            reply = f"已删除记忆 id={mid}"
         except Exception:
-            logger.exception("Failed to send message via sender; will still return reply to webhook caller")
-        # 返回纯文本回复给 webhook 调用方（不要返回 JSON）
-        return Response(reply, mimetype='text/plain')
+            reply = "指定 id 无效或不存在"
+        if sender_id:
+            sender.send_text_from_env(reply, at_user_ids=[sender_id])
+        else:
+            sender.send_text_from_env(reply)
+        return jsonify({"errcode": 0, "errmsg": "ok"})
 
-    except Exception as exc:
-        logger.exception("Failed to process webhook: %s", exc)
-        return jsonify({"errcode": 1, "errmsg": str(exc)}), 500
+    if content.startswith("/memories"):
+        uid = sender_id or sender_name
+        mems = memory.list_user_memories(uid)
+        if not mems:
+            txt = "你没有记忆。使用 /remember 添加一个。"
+        else:
+            lines = [f"id={m['id']} interval={m['interval']}s: {m['content']}" for m in mems]
+            txt = "\n".join(lines)
+        if sender_id:
+            sender.send_text_from_env(txt, at_user_ids=[sender_id])
+        else:
+            sender.send_text_from_env(txt)
+        return jsonify({"errcode": 0, "errmsg": "ok"})
+
+    # 普通消息：记录到本地文件并转发给 agent
+    from .memory_file import append_user_message
+    uid = sender_id or sender_name
+    WEBHOOK_REQUESTS.inc(kind="message")
+    append_user_message(uid, content, sender_name=data.get("senderNick") or data.get("senderName"))
+    # 准入控制：超过用户/群速率或并发上限时立即返回忙碌提示，而不是拖慢所有人
+    reason = admission_control.check_rate(uid, data.get("conversationId"))
+    if reason:
+        return _busy(uid, reason)
+    if coalescer is not None:
+        # 合并窗口：同一用户的连续短消息合并为一次模型调用、一次回复
+        coalescer.add(uid, (content, sender_name, sender_id, contextvars.copy_context()))
+        return jsonify({"errcode": 0, "errmsg": "queued"})
+    if work_queue is not None:
+        # 异步模式：入队后立即确认，回复由后台 worker 通过 sender 发送（同一用户保持顺序）
+        try:
+            work_queue.submit(uid, _process_message, content, sender_name, sender_id)
+        except QueueFull:
+            return _busy(uid, admission_control.reject("queue_full"))
+        admission_control.admit()
+        return jsonify({"errcode": 0, "errmsg": "queued"})
+    if not admission_control.try_enter():
+        return _busy(uid, "inflight")
+    try:
+        reply = _process_message(content, sender_name, sender_id)
+    finally:
+        admission_control.leave()
+    # 返回纯文本回复给 webhook 调用方（不要返回 JSON）
+    return Response(reply, mimetype='text/plain')
 
 
 if __name__ == "__main__":
-    # initialize DB and start scheduler
-    init_app(start_scheduler=True)
+    # initialize DB and start scheduler (unless this process only serves webhooks).
+    # For production use the multi-process entry point: gunicorn -c dingbot/gunicorn.conf.py dingbot.wsgi:app
+    init_app(start_scheduler=config.DINGBOT_ROLE != "web")
 
     port = int(__import__("os").environ.get("PORT", 8080))
     logger.info("Starting DingBot server on port %s", port)
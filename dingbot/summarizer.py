@@ -0,0 +1,114 @@
+"""Background rolling conversation summaries.
+
+Every `SUMMARY_EVERY_N` new messages from a user, the user's unsummarized messages
+are folded into their previous summary by the model and persisted to `summary_file`.
+Prompts then use the summary plus a short window of recent messages, so prompt size
+stays bounded no matter how long the history grows.
+
+Updates run on a single background thread fed by a `memory_file` append listener,
+never on the webhook request path. Worker processes count their own messages and may
+fold the same user concurrently; `summary_file` only accepts a fold that starts from
+the stored summary, so none is applied twice.
+"""
+
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from . import agent, config
+from . import memory_file, summary_file
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_new_counts: Dict[str, int] = {}
+_pending = set()
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def update_user_summary(user_id: str) -> Optional[Dict[str, Any]]:
+    """Fold all not-yet-summarized messages of a user into their summary.
+
+    Messages are folded in chunks of `SUMMARY_MAX_FOLD` so a long backlog never
+    produces an oversized prompt. Returns the stored summary record, or None if
+    nothing could be folded.
+
+    A chunk whose stored count moved during the model call is dropped, and the fold
+    continues from what the other process stored.
+    """
+    updated = None
+    while True:
+        record = summary_file.get_user_summary(user_id)
+        summary = record.get("summary") or ""
+        count = int(record.get("count") or 0)
+        msgs = memory_file.get_user_messages(user_id, offset=count, limit=config.SUMMARY_MAX_FOLD)
+        if not msgs:
+            break
+        folded = agent.summarize_conversation(summary, msgs)
+        if folded is None:
+            logger.warning("Summarizer: model produced no summary for %s; will retry later", user_id)
+            break
+        if not summary_file.set_user_summary(user_id, folded, count + len(msgs),
+                                             last_timestamp=msgs[-1].get("timestamp"), expected_count=count):
+            logger.info("Summarizer: %s was folded by another process meanwhile; continuing from its summary",
+                        user_id)
+            continue
+        updated = summary_file.get_user_summary(user_id)
+        if len(msgs) < config.SUMMARY_MAX_FOLD:
+            break
+    return updated
+
+
+def _run(user_id: str) -> None:
+    try:
+        rec = update_user_summary(user_id)
+        if rec:
+            logger.info("Summarizer: updated summary for %s (covers %d messages)", user_id, rec.get("count", 0))
+    except Exception:
+        logger.exception("Summarizer: failed to update summary for %s", user_id)
+    finally:
+        with _lock:
+            _pending.discard(user_id)
+
+
+def _submit(user_id: str) -> None:
+    global _executor
+    with _lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+    _executor.submit(_run, user_id)
+
+
+def note_message(entry: Dict[str, Any]) -> None:
+    """`memory_file` listener: count new messages and schedule a fold every N."""
+    every = config.SUMMARY_EVERY_N
+    uid = entry.get("user_id")
+    if every <= 0 or not uid:
+        return
+    with _lock:
+        n = _new_counts.get(uid, 0) + 1
+        _new_counts[uid] = 0 if n >= every else n
+    if n >= every:
+        _submit(uid)
+
+
+def start() -> None:
+    """Start tracking appended messages; summaries are folded in the background."""
+    if config.SUMMARY_EVERY_N <= 0:
+        logger.info("Summarizer disabled (SUMMARY_EVERY_N=%s)", config.SUMMARY_EVERY_N)
+        return
+    memory_file.subscribe(note_message)
+    logger.info("Summarizer started (fold every %s messages)", config.SUMMARY_EVERY_N)
+
+
+def stop(wait: bool = True) -> None:
+    global _executor
+    memory_file.unsubscribe(note_message)
+    with _lock:
+        ex, _executor = _executor, None
+    if ex:
+        ex.shutdown(wait=wait)
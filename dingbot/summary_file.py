@@ -0,0 +1,54 @@
+import json
+import os
+from typing import Dict, Any
+
+from .filelock import FileLock
+
+SUMMARY_FILE = os.environ.get("SUMMARY_FILE", "dingbot_summary.json")
+# shared with other worker processes through SUMMARY_FILE + ".lock"
+_lock = FileLock(lambda: SUMMARY_FILE)
+
+
+def _load_unlocked() -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(SUMMARY_FILE):
+        return {}
+    with open(SUMMARY_FILE, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except Exception:
+            return {}
+
+
+def load_all_summaries() -> Dict[str, Dict[str, Any]]:
+    with _lock.shared():
+        return _load_unlocked()
+
+
+def set_user_summary(user_id: str, summary: str, count: int, last_timestamp: int = None,
+                     expected_count: int = None) -> bool:
+    """Persist a user's rolling summary covering their first `count` messages.
+
+    With `expected_count`, only if the stored summary still covers that many messages
+    (checked under the lock, so a fold from another process is not overwritten);
+    returns whether it was written.
+    """
+    import time
+    with _lock.exclusive():
+        data = _load_unlocked()
+        if expected_count is not None and int((data.get(user_id) or {}).get("count") or 0) != expected_count:
+            return False
+        data[user_id] = {
+            "summary": summary,
+            "count": count,
+            "last_timestamp": last_timestamp,
+            "updated_at": int(time.time()),
+        }
+        tmp = SUMMARY_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, SUMMARY_FILE)
+    return True
+
+
+def get_user_summary(user_id: str) -> Dict[str, Any]:
+    return load_all_summaries().get(user_id) or {}
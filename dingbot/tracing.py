@@ -0,0 +1,283 @@
+"""Lightweight request tracing.
+
+`server.webhook` opens a root span per request with `start_trace`; its trace id is the
+request id (returned as the `X-Request-Id` header). Code further down (`agent`,
+`memory_file`, `retrieval`, `sender`) opens child spans with `span(...)`. The current
+span lives in a `contextvars` variable, so it follows the request through the work
+queue and the model worker thread when the context is copied there.
+
+Only a `TRACE_SAMPLE_RATE` fraction of traces is recorded; for the rest `span()` is a
+shared no-op, so tracing can stay enabled in production. Finished spans are written as
+one JSON object per line to the `dingbot.trace` logger and, if `TRACE_OTLP_ENDPOINT`
+is set, batched to an OTLP/HTTP JSON collector (e.g. http://127.0.0.1:4318/v1/traces).
+
+`python -m dingbot.tracing --port 4318` runs a minimal local collector stand-in that
+accepts OTLP/HTTP JSON and prints one line per received span.
+"""
+
+import contextvars
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from . import config
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("dingbot.trace")
+
+_current: contextvars.ContextVar = contextvars.ContextVar("dingbot_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "sampled", "attrs", "start_ns", "end_ns", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attrs: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attrs = attrs
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_unix_ns": self.start_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    sampled = False
+    trace_id = None
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _SpanContext:
+    __slots__ = ("span", "_token")
+
+    def __init__(self, span: Span):
+        self.span = span
+        self._token = None
+
+    def __enter__(self) -> Span:
+        self._token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        s = self.span
+        s.end_ns = time.time_ns()
+        if exc is not None:
+            s.error = f"{exc_type.__name__}: {exc}"
+        _current.reset(self._token)
+        if s.sampled:
+            _emit(s)
+        return False
+
+
+def start_trace(name: str, **attrs) -> _SpanContext:
+    """Open a root span (a new trace); sampling is decided here for the whole trace."""
+    rate = config.TRACE_SAMPLE_RATE
+    sampled = rate > 0 and (rate >= 1 or random.random() < rate)
+    return _SpanContext(Span(name, "%032x" % random.getrandbits(128), None, sampled, attrs))
+
+
+def span(name: str, **attrs):
+    """Open a child span of the current one; a no-op outside sampled traces."""
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        return _NOOP
+    return _SpanContext(Span(name, parent.trace_id, parent.span_id, True, attrs))
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def current_request_id() -> Optional[str]:
+    s = _current.get()
+    return s.trace_id if s is not None else None
+
+
+def _emit(s: Span) -> None:
+    if config.TRACE_LOG:
+        trace_logger.info("%s", json.dumps(s.to_dict(), ensure_ascii=False, default=str))
+    if config.TRACE_OTLP_ENDPOINT:
+        _get_exporter().enqueue(s)
+
+
+def _otlp_value(v: Any) -> Dict[str, Any]:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def to_otlp(spans: List[Span], service_name: str) -> Dict[str, Any]:
+    """Encode spans as an OTLP/HTTP JSON `ExportTraceServiceRequest`."""
+    out = []
+    for s in spans:
+        item = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attrs.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            item["parentSpanId"] = s.parent_id
+        out.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "dingbot"}, "spans": out}],
+        }]
+    }
+
+
+class OTLPExporter:
+    """Batches finished spans and POSTs them to an OTLP/HTTP JSON endpoint in the background.
+
+    Spans are dropped (and counted) rather than blocking when the buffer is full or the
+    collector is unreachable.
+    """
+
+    def __init__(self, endpoint: str, service_name: str = "dingbot", max_queue: int = 10000,
+                 batch_size: int = 256, interval: float = 1.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.exported = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._loop, name="otlp-exporter", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, s: Span) -> None:
+        try:
+            self._queue.put_nowait(s)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self, first: Span) -> List[Span]:
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            first = self._queue.get()
+            self.export(self._drain(first))
+            time.sleep(self.interval)
+
+    def export(self, batch: List[Span]) -> bool:
+        import urllib.request
+
+        body = json.dumps(to_otlp(batch, self.service_name)).encode("utf-8")
+        req = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=2) as resp:
+                resp.read()
+            self.exported += len(batch)
+            return True
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.warning("Tracing: OTLP export of %d spans to %s failed: %s", len(batch), self.endpoint, e)
+            return False
+
+
+_exporter: Optional[OTLPExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def _get_exporter() -> OTLPExporter:
+    global _exporter
+    if _exporter is None or _exporter.endpoint != config.TRACE_OTLP_ENDPOINT:
+        with _exporter_lock:
+            if _exporter is None or _exporter.endpoint != config.TRACE_OTLP_ENDPOINT:
+                _exporter = OTLPExporter(config.TRACE_OTLP_ENDPOINT, config.TRACE_SERVICE_NAME)
+    return _exporter
+
+
+def make_collector(port: int = 4318, host: str = "127.0.0.1", out=None):
+    """Build a minimal OTLP/HTTP JSON collector stand-in that writes received spans to `out`."""
+    import sys
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    out = out or sys.stdout
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                for rs in payload.get("resourceSpans", []):
+                    for ss in rs.get("scopeSpans", []):
+                        for sp in ss.get("spans", []):
+                            out.write(json.dumps(sp, ensure_ascii=False) + "\n")
+                out.flush()
+                self.send_response(200)
+            except Exception:
+                self.send_response(400)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve_collector(port: int = 4318, host: str = "127.0.0.1", out=None):
+    server = make_collector(port, host, out)
+    logger.info("Tracing: collector stand-in listening on http://%s:%s/v1/traces", host, port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local OTLP/HTTP JSON collector stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve_collector(args.port, args.host)
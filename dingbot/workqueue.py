@@ -0,0 +1,106 @@
+"""Bounded background worker pool that preserves per-key ordering.
+
+Each key (e.g. a user id) is hashed to one worker thread, and every worker runs
+its jobs strictly in FIFO order, so jobs for the same key never run concurrently
+or out of order while different keys are processed in parallel.
+"""
+
+import contextvars
+import logging
+import queue
+import threading
+import zlib
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised by `KeyedWorkQueue.submit` when the total queue depth limit is reached."""
+
+
+class KeyedWorkQueue:
+    def __init__(self, workers: int = 4, max_depth: int = 1000, name: str = "worker"):
+        self.workers = max(1, int(workers))
+        self.max_depth = max(1, int(max_depth))
+        self.name = name
+        self._queues: List[queue.Queue] = [queue.Queue() for _ in range(self.workers)]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._depth = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self) -> "KeyedWorkQueue":
+        if self._threads:
+            return self
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._loop, args=(q,), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info("Work queue %s started (%d workers, max depth %d)", self.name, self.workers, self.max_depth)
+        return self
+
+    def _slot(self, key: Any) -> int:
+        return zlib.crc32(str(key).encode("utf-8")) % self.workers
+
+    def submit(self, key: Any, fn: Callable, *args, **kwargs) -> None:
+        """Queue `fn(*args, **kwargs)` behind earlier jobs for `key`; raise QueueFull if saturated.
+
+        The job runs in a copy of the caller's context (so e.g. the trace follows it).
+        """
+        with self._lock:
+            if self._depth >= self.max_depth:
+                self.rejected += 1
+                raise QueueFull(f"{self.name} queue is full ({self.max_depth})")
+            self._depth += 1
+            self.submitted += 1
+        self._queues[self._slot(key)].put((contextvars.copy_context(), fn, args, kwargs))
+
+    def _loop(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            ctx, fn, args, kwargs = item
+            try:
+                ctx.run(fn, *args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                logger.exception("Work queue %s: job failed", self.name)
+            finally:
+                with self._lock:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._idle.notify_all()
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._depth
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued job has finished. Returns False on timeout."""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._depth == 0, timeout=timeout)
+
+    def stop(self, wait: bool = True) -> None:
+        for q in self._queues:
+            q.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "depth": self._depth,
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "failed": self.failed,
+            }
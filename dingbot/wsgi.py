@@ -0,0 +1,19 @@
+"""Production WSGI entry point.
+
+Run several worker processes with gunicorn:
+
+    gunicorn -c dingbot/gunicorn.conf.py dingbot.wsgi:app
+
+Every worker initializes the app on import. The scheduler only starts when
+`DINGBOT_ROLE=all`, and then in at most one process per host (the first worker to
+take `SCHEDULER_LOCK_FILE`). The recommended layout is `DINGBOT_ROLE=web` for the
+gunicorn workers plus one `DINGBOT_ROLE=scheduler` process (`python -m dingbot.scheduler`).
+File-backed stores use cross-process file locks, so all workers can share them.
+"""
+
+from . import config
+from .server import app, init_app
+
+init_app(start_scheduler=config.DINGBOT_ROLE == "all")
+
+__all__ = ["app"]
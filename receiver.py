@@ -5,17 +5,21 @@
 """
 
 import os
-import sys
+import logging
 import time
 import hmac
 import hashlib
 import base64
 import urllib.parse
 import requests
-import json
 from flask import Flask, request, jsonify
 from typing import Dict, Any
 
+from dingbot import logutil
+
+logutil.configure()
+logger = logging.getLogger("receiver")
+
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 SECRET = os.getenv("SECRET")
 BASE_URL = "https://oapi.dingtalk.com/robot/send"
@@ -23,19 +27,13 @@ BASE_URL = "https://oapi.dingtalk.com/robot/send"
 app = Flask(__name__)
 
 
-# 添加请求日志中间件
+# 请求日志：只在 DEBUG 级别输出，headers/body 与主服务一样脱敏并截断
 @app.before_request
 def log_request():
-    print(f"=== 收到请求 ===")
-    print(f"时间: {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"方法: {request.method}")
-    print(f"路径: {request.path}")
-    print(f"来源IP: {request.remote_addr}")
-    print(f"Headers: {dict(request.headers)}")
-    if request.method == "POST":
-        print(f"Body: {request.get_data(as_text=True)}")
-    print(f"================\n")
-    sys.stdout.flush()
+    logger.debug("收到请求: %s %s from %s headers=%s", request.method, request.path, request.remote_addr,
+                 logutil.Payload(dict(request.headers)))
+    if request.method == "POST" and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Body: %s", logutil.Payload(request.get_json(silent=True) or request.get_data(as_text=True)))
 
 
 def generate_sign(secret: str) -> tuple:
@@ -68,7 +66,7 @@ def send_dingtalk(message: str, title: str = None) -> bool:
         result = resp.json()
         return result.get("errcode") == 0
     except Exception as e:
-        print(f"发送失败: {e}", file=sys.stderr)
+        logger.warning("发送失败: %s", e)
         return False
 
 
@@ -115,14 +113,14 @@ def webhook():
     try:
         # 获取请求数据
         data = request.json
-        print(f"收到钉钉回调: {json.dumps(data, indent=2, ensure_ascii=False)}")
+        logger.info("收到钉钉回调: %s", logutil.Payload(data))
 
         # 验证签名 (如果钉钉发送了签名)
         timestamp = request.headers.get("timestamp")
         sign = request.headers.get("sign")
         # if timestamp and sign:
         #     if not verify_signature(timestamp, sign):
-        #         print("签名验证失败")
+        #         logger.warning("签名验证失败")
         #         return jsonify({"errcode": 1, "errmsg": "Invalid signature"}), 403
 
         # 处理不同类型的消息
@@ -140,24 +138,21 @@ def webhook():
             if reply:
                 success = send_dingtalk(reply)
                 if success:
-                    print(f"回复成功: {reply}")
+                    logger.info("回复成功")
                 else:
-                    print(f"回复失败")
+                    logger.warning("回复失败")
 
         return jsonify({"errcode": 0, "errmsg": "ok"})
 
     except Exception as e:
-        print(f"处理回调失败: {e}")
-        import traceback
-
-        traceback.print_exc()
+        logger.exception("处理回调失败: %s", e)
         return jsonify({"errcode": 1, "errmsg": str(e)}), 500
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
-    print(f"钉钉机器人服务器启动在端口 {port}")
-    print(f"Webhook URL: http://0.0.0.0:{port}/webhook")
+    logger.info("钉钉机器人服务器启动在端口 %s", port)
+    logger.info("Webhook URL: http://0.0.0.0:%s/webhook", port)
     app.run(host="0.0.0.0", port=port, debug=True)
     # NOTE: Do NOT store real tokens or secrets in the repository.
     # Example webhook URL (redacted): https://oapi.dingtalk.com/robot/send?access_token=REDACTED
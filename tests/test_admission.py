@@ -0,0 +1,98 @@
+import threading
+
+import dingbot.server as server
+from dingbot import admission, memory_file
+from dingbot.ratelimit import TokenBucket, KeyedRateLimiter
+
+
+def test_token_bucket_refills():
+    b = TokenBucket(rate=1.0, capacity=2)
+    assert b.try_take(now=b._updated)
+    assert b.try_take(now=b._updated)
+    assert not b.try_take(now=b._updated)
+    assert b.time_until(now=b._updated) == 1.0
+    assert b.try_take(now=b._updated + 1.0)
+
+
+def test_keyed_limiter_disabled_and_per_key():
+    assert KeyedRateLimiter(0, 1).allow("u1")
+    lim = KeyedRateLimiter(60, 1)
+    assert lim.allow("u1")
+    assert not lim.allow("u1")
+    assert lim.allow("u2")
+
+
+def _setup(monkeypatch, tmp_path, controller):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(server, "admission_control", controller)
+    server.dedup_cache.clear()
+    sent = []
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: sent.append(msg))
+    return sent
+
+
+def test_user_rate_limit_returns_busy_but_commands_bypass(monkeypatch, tmp_path):
+    ctrl = admission.AdmissionController(user_rate_per_minute=1, user_burst=1)
+    sent = _setup(monkeypatch, tmp_path, ctrl)
+    monkeypatch.setattr(server.agent, "analyze_and_reply", lambda c, n, user_id=None: {"reply": "ok"})
+    client = server.app.test_client()
+
+    def post(text, i):
+        payload = {"msgtype": "text", "msgId": f"rl-{i}", "text": {"content": text}, "senderNick": "Bob", "senderId": "bobid"}
+        return client.post("/webhook", json=payload)
+
+    assert post("hello", 1).get_data(as_text=True) == "ok"
+    r = post("hello again", 2)
+    assert r.status_code == 200
+    assert r.get_data(as_text=True) == admission.BUSY_REPLY
+    assert r.headers["X-DingBot-Degraded"] == "user_rate"
+
+    sent.clear()
+    assert post("/ping", 3).status_code == 200
+    assert sent and "pong" in sent[-1]
+    assert client.get("/stats").get_json()["admission"]["rejected"]["user_rate"] == 1
+
+
+def test_inflight_limit(monkeypatch, tmp_path):
+    ctrl = admission.AdmissionController(max_inflight=1)
+    _setup(monkeypatch, tmp_path, ctrl)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow_agent(content, sender_name, user_id=None):
+        entered.set()
+        release.wait(5)
+        return {"reply": "slow ok"}
+
+    monkeypatch.setattr(server.agent, "analyze_and_reply", slow_agent)
+    client = server.app.test_client()
+    results = []
+    payload = {"msgtype": "text", "msgId": "if-1", "text": {"content": "first"}, "senderNick": "A", "senderId": "a"}
+    t = threading.Thread(target=lambda: results.append(client.post("/webhook", json=payload).get_data(as_text=True)))
+    t.start()
+    assert entered.wait(5)
+
+    payload2 = {"msgtype": "text", "msgId": "if-2", "text": {"content": "second"}, "senderNick": "B", "senderId": "b"}
+    r = server.app.test_client().post("/webhook", json=payload2)
+    assert r.headers["X-DingBot-Degraded"] == "inflight"
+
+    release.set()
+    t.join(5)
+    assert results == ["slow ok"]
+    assert ctrl.stats()["inflight"] == 0
+
+
+def test_group_rejection_keeps_the_user_token_and_admitted_counts_final_admissions(monkeypatch, tmp_path):
+    ctrl = admission.AdmissionController(max_inflight=1, user_rate_per_minute=1, user_burst=1,
+                                         group_rate_per_minute=1, group_burst=1)
+    assert ctrl.check_rate("u1", "g1") is None
+    # g1 is spent: u2 is turned away without losing its own token
+    assert ctrl.check_rate("u2", "g1") == "group_rate"
+    assert ctrl.check_rate("u2", "g2") is None
+    assert ctrl.stats()["admitted"] == 0
+
+    assert ctrl.try_enter()
+    assert not ctrl.try_enter()
+    ctrl.leave()
+    stats = ctrl.stats()
+    assert stats["admitted"] == 1 and stats["rejected"]["inflight"] == 1
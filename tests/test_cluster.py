@@ -0,0 +1,118 @@
+import os
+
+from dingbot import activity, agent, cluster, config, facts_file, memory_file, scheduler, sender
+from dingbot.hashing import rendezvous
+
+
+def test_nodes_split_users_and_fail_over(tmp_path):
+    db = str(tmp_path / "nodes.db")
+    a = cluster.Membership(db, "node-a", lease_seconds=30)
+    b = cluster.Membership(db, "node-b", lease_seconds=30)
+    a.heartbeat(now=1000)
+    assert b.heartbeat(now=1000) == ["node-a", "node-b"]
+    a.heartbeat(now=1000)
+
+    users = [f"u{i}" for i in range(50)]
+    mine_a = {u for u in users if a.owns(u)}
+    mine_b = {u for u in users if b.owns(u)}
+    assert mine_a and mine_b and not mine_a & mine_b and mine_a | mine_b == set(users)
+
+    # b stops renewing: once its lease runs out, a takes over all users
+    assert a.heartbeat(now=1020) == ["node-a", "node-b"]
+    assert a.heartbeat(now=1031) == ["node-a"]
+    assert all(a.owns(u) for u in users)
+
+    # a clean shutdown hands the users over right away
+    b.heartbeat(now=1032)
+    b.leave()
+    assert a.heartbeat(now=1033) == ["node-a"]
+
+
+def test_scheduler_only_processes_its_share(monkeypatch, tmp_path):
+    db = str(tmp_path / "nodes.db")
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(config, "SCHEDULER_CLUSTER_DB", db)
+    monkeypatch.setattr(config, "SCHEDULER_NODE_ID", "node-a")
+    monkeypatch.setattr(scheduler, "_membership", None)
+    monkeypatch.setattr(scheduler, "_carry_over", [])
+    other = cluster.Membership(db, "node-b")
+    other.heartbeat()
+    users = [f"u{i}" for i in range(20)]
+    for uid in users:
+        memory_file.append_user_message(uid, "hi")
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", lambda uid: [{"fact": uid}])
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: uid)
+    pushes = []
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: pushes.append(text))
+
+    scheduler.run_cycle()
+    share_a = {u for u in users if rendezvous(u, ["node-a", "node-b"]) == "node-a"}
+    assert pushes and sorted(pushes) == sorted(share_a)
+
+    # node-b leaves: its users (still dirty on this node) are picked up next cycle
+    other.leave()
+    pushes.clear()
+    scheduler.run_cycle()
+    assert sorted(pushes) == sorted(set(users) - share_a)
+    assert scheduler.stats()["cluster"]["nodes"] == ["node-a"]
+
+
+
+def test_moved_users_skip_messages_their_previous_owner_handled(monkeypatch, tmp_path):
+    db = str(tmp_path / "nodes.db")
+    log = str(tmp_path / "mem.jsonl")
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", log)
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.{node}.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(config, "SCHEDULER_CLUSTER_DB", db)
+    monkeypatch.setattr(config, "SCHEDULER_NODE_ID", "node-a")
+    monkeypatch.setattr(scheduler, "_membership", None)
+    monkeypatch.setattr(scheduler, "_carry_over", [])
+    other = cluster.Membership(db, "node-b")
+    other.heartbeat()
+    users = [f"u{i}" for i in range(20)]
+    for uid in users:
+        memory_file.append_user_message(uid, "hi")
+    share_b = sorted(u for u in users if rendezvous(u, ["node-a", "node-b"]) == "node-b")
+    # node-b handled its share of everything written so far
+    for uid in share_b:
+        other.record_processed(uid, log, os.path.getsize(log), pushed=True)
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", lambda uid: [{"fact": uid}])
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: uid)
+    pushes = []
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: pushes.append(text))
+    scheduler.run_cycle()
+    assert os.path.exists(str(tmp_path / "activity.node-a.json"))
+
+    # node-b leaves: its users move here, but only news since node-b handled them counts
+    other.leave()
+    memory_file.append_user_message(share_b[0], "new message")
+    pushes.clear()
+    scheduler.run_cycle()
+    assert pushes == [share_b[0]]
+    assert other.processed([share_b[0]])[share_b[0]]["log_offset"] == os.path.getsize(log)
+
+
+def test_cluster_nodes_still_take_the_host_lock(monkeypatch, tmp_path):
+    from dingbot.filelock import try_lock_exclusive
+
+    lock_file = str(tmp_path / "scheduler.lock")
+    monkeypatch.setattr(config, "SCHEDULER_CLUSTER_DB", str(tmp_path / "nodes.db"))
+    monkeypatch.setattr(config, "SCHEDULER_LOCK_FILE", lock_file)
+    monkeypatch.setattr(scheduler, "_membership", None)
+    monkeypatch.setattr(scheduler, "_singleton", None)
+    monkeypatch.setattr(scheduler, "sched", None)
+    monkeypatch.setattr(scheduler, "APSCHEDULER_AVAILABLE", True)
+    held = try_lock_exclusive(lock_file)
+    try:
+        # another process on this host already runs a node
+        scheduler.start()
+        assert scheduler.sched is None
+    finally:
+        held.close()
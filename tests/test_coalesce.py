@@ -0,0 +1,82 @@
+import contextvars
+import threading
+import time
+
+import dingbot.server as server
+from dingbot import admission, memory_file
+from dingbot.coalesce import Coalescer
+from dingbot.workqueue import KeyedWorkQueue
+
+
+def test_burst_is_flushed_once():
+    flushed = []
+    done = threading.Event()
+
+    def flush(key, items):
+        flushed.append((key, items))
+        done.set()
+
+    c = Coalescer(window=0.1, max_wait=2, flush=flush).start()
+    for i in range(4):
+        c.add("u1", i)
+        time.sleep(0.02)
+    assert done.wait(2)
+    c.stop()
+    assert flushed == [("u1", [0, 1, 2, 3])]
+
+
+def test_max_wait_bounds_latency():
+    flushed = []
+    c = Coalescer(window=0.1, max_wait=0.25, flush=lambda k, items: flushed.append((time.monotonic(), items))).start()
+    start = time.monotonic()
+    # keep the debounce window open longer than max_wait
+    while time.monotonic() - start < 0.6:
+        c.add("u1", "x")
+        time.sleep(0.03)
+    c.stop()
+    assert len(flushed) >= 2
+    assert flushed[0][0] - start < 0.5
+    assert sum(len(items) for _, items in flushed) == c.stats()["items_added"]
+
+
+def test_webhook_merges_messages_into_one_reply(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    q = KeyedWorkQueue(workers=1, max_depth=10, name="test").start()
+    c = Coalescer(window=0.1, max_wait=1, flush=server._flush_coalesced).start()
+    monkeypatch.setattr(server, "work_queue", q)
+    monkeypatch.setattr(server, "coalescer", c)
+    server.dedup_cache.clear()
+
+    calls = []
+
+    def fake_agent(content, sender_name, user_id=None):
+        calls.append(content)
+        return {"reply": "merged reply"}
+
+    sent = []
+    monkeypatch.setattr(server.agent, "analyze_and_reply", fake_agent)
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: sent.append(msg))
+
+    client = server.app.test_client()
+    for i, text in enumerate(["在吗", "问个问题", "明天会下雨吗"]):
+        payload = {"msgtype": "text", "msgId": f"burst-{i}", "text": {"content": text}, "senderNick": "Bob", "senderId": "bobid"}
+        assert client.post("/webhook", json=payload).get_json()["errmsg"] == "queued"
+
+    c.stop()
+    assert q.join(timeout=5)
+    q.stop()
+    assert calls == ["在吗\n问个问题\n明天会下雨吗"]
+    assert sent == ["merged reply"]
+    # every message is still logged individually
+    assert [m["content"] for m in memory_file.get_user_messages("bobid")] == ["在吗", "问个问题", "明天会下雨吗"]
+
+
+def test_coalesced_turn_gets_busy_reply_when_queue_is_full(monkeypatch):
+    q = KeyedWorkQueue(workers=1, max_depth=1, name="test")  # not started: stays full
+    q.submit("other", lambda: None)
+    monkeypatch.setattr(server, "work_queue", q)
+    sent = []
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: sent.append((msg, at_user_ids)))
+
+    server._flush_coalesced("bobid", [("在吗", "Bob", "bobid", contextvars.copy_context())])
+    assert sent == [(admission.BUSY_REPLY, ["bobid"])]
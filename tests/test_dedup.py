@@ -0,0 +1,105 @@
+import dingbot.server as server
+from dingbot import dedup, memory_file
+
+
+def test_message_key_prefers_msg_id():
+    a = {"msgId": "m1", "text": {"content": "hi"}, "senderId": "u1"}
+    b = {"msgId": "m1", "text": {"content": "different"}, "senderId": "u2"}
+    assert dedup.message_key(a) == dedup.message_key(b) == "id:m1"
+
+    c = {"text": {"content": "hi"}, "senderId": "u1", "createAt": 1700000000000}
+    d = dict(c, createAt=1700000000001)
+    assert dedup.message_key(c).startswith("fp:")
+    assert dedup.message_key(c) != dedup.message_key(d)
+    assert dedup.message_key({"text": {"content": "hi"}}) is None
+
+
+def test_cache_ttl_and_bound(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, "monotonic", lambda: now[0])
+    cache = dedup.DedupCache(max_entries=2, ttl_seconds=10)
+
+    assert cache.begin("a") == (True, None)
+    assert cache.begin("a") == (False, dedup.PENDING)
+    cache.complete("a", "result-a")
+    assert cache.begin("a") == (False, "result-a")
+
+    cache.begin("b")
+    cache.begin("c")  # evicts the oldest entry
+    assert cache.stats()["size"] == 2
+    assert cache.begin("a")[0] is True
+
+    now[0] += 11
+    assert cache.begin("b")[0] is True
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 5
+
+
+def test_webhook_redelivery_returns_original_reply(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    server.dedup_cache.clear()
+
+    calls = []
+
+    def fake_agent(content, sender_name, user_id=None):
+        calls.append(content)
+        return {"reply": f"Echo {len(calls)}"}
+
+    sent = []
+    monkeypatch.setattr(server.agent, "analyze_and_reply", fake_agent)
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: sent.append(msg))
+
+    client = server.app.test_client()
+    payload = {"msgtype": "text", "msgId": "msg-42", "text": {"content": "hello"}, "senderNick": "Bob", "senderId": "bobid"}
+    r1 = client.post("/webhook", json=payload)
+    r2 = client.post("/webhook", json=payload)
+    assert r1.get_data(as_text=True) == r2.get_data(as_text=True) == "Echo 1"
+    assert r2.mimetype == "text/plain"
+    assert calls == ["hello"]
+    assert sent == ["Echo 1"]
+
+    stats = client.get("/stats").get_json()["dedup"]
+    assert stats["hits"] == 1 and stats["hit_rate"] == 0.5
+
+
+def test_fallback_key_uses_a_sliding_window(monkeypatch):
+    now = [1009.5]
+    monkeypatch.setattr(dedup.time, "time", lambda: now[0])
+    monkeypatch.setattr(dedup.config, "DEDUP_FALLBACK_WINDOW_SECONDS", 10)
+    monkeypatch.setattr(dedup, "_first_seen", dedup.OrderedDict())
+    payload = {"text": {"content": "hi"}, "senderId": "u1"}
+
+    first = dedup.message_key(payload)
+    # a fixed 10s bucket would split these two across the 1010 boundary
+    now[0] = 1010.5
+    assert dedup.message_key(payload) == first
+    assert dedup.message_key(dict(payload, senderId="u2")) != first
+    # the window runs from the first sighting, not the latest one
+    now[0] = 1019.6
+    second = dedup.message_key(payload)
+    assert second != first
+    now[0] = 1025.0
+    assert dedup.message_key(payload) == second
+
+
+def test_shared_cache_is_seen_by_other_processes(monkeypatch, tmp_path):
+    path = str(tmp_path / "dedup.db")
+    monkeypatch.setattr(dedup.config, "DEDUP_FALLBACK_WINDOW_SECONDS", 10)
+    # two caches on one file stand in for two gunicorn workers
+    a = dedup.SharedDedupCache(path, max_entries=2, ttl_seconds=300)
+    b = dedup.SharedDedupCache(path, max_entries=2, ttl_seconds=300)
+
+    assert a.begin("k") == (True, None)
+    assert b.begin("k") == (False, dedup.PENDING)
+    a.complete("k", (b"Echo 1", 200, "text/plain"))
+    assert b.begin("k") == (False, (b"Echo 1", 200, "text/plain"))
+    b.forget("k")
+    assert a.begin("k")[0] is True
+
+    a.begin("x")
+    a.begin("y")  # keeps at most max_entries, dropping the oldest
+    assert b.stats()["size"] == 2
+
+    # workers agree on the fallback window too
+    payload = {"text": {"content": "hi"}, "senderId": "u1"}
+    assert dedup.message_key(payload, a.first_seen_at) == dedup.message_key(payload, b.first_seen_at)
@@ -1,9 +1,16 @@
 import os
 import json
+from concurrent.futures import Future
 from types import SimpleNamespace
 
 import dingbot.agent as agent
-from dingbot import memory_file, facts_file, scheduler
+from dingbot import memory_file, facts_file, scheduler, activity
+
+
+def _delivered():
+    f = Future()
+    f.set_result({"errcode": 0})
+    return f
 
 
 def write_memory(tmp_path, user_id, msgs):
@@ -60,3 +67,192 @@ def test_scheduler_run_cycle(monkeypatch, tmp_path):
     all_facts = facts_file.load_all_facts()
     assert 'u1' in all_facts and 'u2' in all_facts
     assert any('push for u1' in p for p in pushes)
+
+
+def test_scheduler_digest_batch_mode(monkeypatch, tmp_path):
+    from dingbot import config, sender
+
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "PUSH_MODE", "digest_batch")
+    monkeypatch.setattr(config, "PUSH_BATCH_SIZE", 2)
+    for uid in ("u1", "u2", "u3", "u4"):
+        # u3 has no nick in the log
+        memory_file.append_user_message(uid, f"hello from {uid}", sender_name=None if uid == "u3" else f"Nick-{uid}")
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", lambda uid: [] if uid == "u4" else [{"fact": f"fact-{uid}"}])
+    prompts = []
+
+    def fake_call(prompt, timeout=8):
+        prompts.append(prompt)
+        # answer only for the first user of each batch; the other falls back to a single call
+        return json.dumps({"1": "batched push"}) if "用户 1" in prompt else "single push"
+
+    monkeypatch.setattr(agent, "_call_model", fake_call)
+    sent = []
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: sent.append(("text", text)))
+    delivery = Future()
+    monkeypatch.setattr(sender, "send_markdown_from_env", lambda title, text: sent.append((title, text)) or [delivery])
+
+    scheduler.run_cycle()
+    # processed, but not pushed until the digest is delivered
+    pushed = lambda: sorted(u for u, r in activity._load()["users"].items() if r.get("last_push"))
+    assert activity.dirty_users() == [] and pushed() == []
+    delivery.set_result({"errcode": 0})
+    assert pushed() == ["u1", "u2", "u3"]
+    assert len(sent) == 1 and sent[0][0] == config.PUSH_DIGEST_TITLE
+    digest = sent[0][1]
+    assert "#### Nick-u1\n\nbatched push" in digest and "#### Nick-u2\n\nsingle push" in digest
+    # staff ids never appear; u3's push has no heading
+    assert digest.endswith("\n\nbatched push") and "u3" not in digest and "u4" not in digest
+    # two batched calls (u1+u2, u3) plus one fallback call for u2
+    assert len(prompts) == 3
+
+
+def test_parallel_cycle_budget_and_carry_over(monkeypatch, tmp_path):
+    import threading
+    from dingbot import config, sender
+
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "SCHEDULER_WORKERS", 3)
+    monkeypatch.setattr(config, "SCHEDULER_CYCLE_BUDGET_SECONDS", 1.0)
+    monkeypatch.setattr(scheduler, "_carry_over", [])
+    # each round of three parallel jobs takes 0.5s on the scheduler's clock
+    now = [0.0]
+    monkeypatch.setattr(scheduler, "_clock", lambda: now[0])
+    round_done = threading.Barrier(3, action=lambda: now.__setitem__(0, now[0] + 0.5), timeout=5)
+    users = [f"u{i}" for i in range(9)]
+    for uid in users:
+        memory_file.append_user_message(uid, "hi")
+
+    def extract_in_rounds(uid):
+        # returns only once three jobs run at the same time
+        round_done.wait()
+        return [{"fact": f"fact-{uid}"}]
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", extract_in_rounds)
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: f"push {uid}")
+    pushes = []
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: pushes.append(text))
+
+    scheduler.run_cycle()
+    # two rounds of three fit in the budget; the last three carry over
+    assert len(pushes) == 6 and scheduler._carry_over == users[6:]
+    assert set(facts_file.load_all_facts()) == set(users[:6])
+    assert scheduler.stats()["last_cycle"]["carried_over"] == 3
+
+    pushes.clear()
+    scheduler.run_cycle()
+    assert set(pushes[:3]) == {f"push {u}" for u in users[6:]}
+
+
+def test_scheduler_only_processes_users_with_new_messages(monkeypatch, tmp_path):
+    from dingbot import config, sender
+
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(config, "REENGAGE_INTERVAL_SECONDS", 3600)
+    monkeypatch.setattr(scheduler, "_carry_over", [])
+    memory_file.append_user_message("u1", "hello from u1", timestamp=1000)
+    for uid in ("u2", "u3"):
+        memory_file.append_user_message(uid, f"hello from {uid}")
+
+    extracted, pushes = [], []
+    monkeypatch.setattr(agent, "extract_facts_for_user", lambda uid: extracted.append(uid) or [{"fact": f"fact-{uid}"}])
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: f"push {uid}: {facts[0]['fact']}")
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: pushes.append(text) or _delivered())
+
+    scheduler.run_cycle()
+    assert sorted(extracted) == ["u1", "u2", "u3"] and len(pushes) == 3
+
+    # nothing new: no model calls, no pushes
+    extracted.clear(), pushes.clear()
+    scheduler.run_cycle()
+    assert extracted == [] and pushes == []
+
+    # only the user who wrote again is re-extracted, also after a restart (state on disk)
+    memory_file.append_user_message("u2", "again")
+    activity.reset()
+    scheduler.run_cycle()
+    assert extracted == ["u2"] and pushes == ["push u2: fact-u2"]
+
+    # u1 has been idle past the re-engagement interval: pushed from stored facts
+    extracted.clear(), pushes.clear()
+    activity.mark_processed("u1", pushed=True, now=1000)
+    scheduler.run_cycle()
+    assert extracted == [] and pushes == ["push u1: fact-u1"]
+    assert scheduler.stats()["last_cycle"]["idle"] == 1
+
+
+def test_per_user_push_counts_once_delivered(monkeypatch, tmp_path):
+    from dingbot import config, sender
+
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(config, "REENGAGE_INTERVAL_SECONDS", 3600)
+    monkeypatch.setattr(scheduler, "_carry_over", [])
+    for uid in ("u1", "u2"):
+        memory_file.append_user_message(uid, f"hello from {uid}")
+    facts_file.set_user_facts("idle", [{"fact": "old"}])
+    activity.refresh()
+    activity.mark_processed("idle", pushed=True, now=1000)
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", lambda uid: [{"fact": f"fact-{uid}"}])
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: uid)
+    sends = {}
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: sends.setdefault(text, Future()))
+
+    scheduler.run_cycle()
+    assert sorted(sends) == ["idle", "u1", "u2"]
+    pushed_at = lambda uid: activity._load()["users"][uid].get("last_push")
+    # processed, but nothing counts as pushed before the sends complete
+    assert activity.dirty_users() == [] and not pushed_at("u1") and not pushed_at("u2")
+    assert pushed_at("idle") == 1000
+    sends["u1"].set_result({"errcode": 0})
+    sends["u2"].set_result({"errcode": sender.THROTTLED_ERRCODE, "errmsg": "send too fast"})
+    sends["idle"].set_exception(RuntimeError("connect failed"))
+    assert pushed_at("u1") and not pushed_at("u2") and pushed_at("idle") == 1000
+
+
+def test_spread_mode_handles_each_user_once_per_interval(monkeypatch, tmp_path):
+    from dingbot import config, sender
+
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(config, "SCHEDULER_MODE", "spread")
+    monkeypatch.setattr(config, "CHECK_INTERVAL_SECONDS", 60)
+    monkeypatch.setattr(config, "SCHEDULER_TICK_SECONDS", 5)
+    monkeypatch.setattr(scheduler, "_carry_over", [])
+    users = [f"u{i}" for i in range(20)]
+    for uid in users:
+        memory_file.append_user_message(uid, "hi")
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", lambda uid: [{"fact": f"fact-{uid}"}])
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: uid)
+    pushes = []
+    monkeypatch.setattr(sender, "send_text_from_env", lambda text, at_user_ids=None: pushes.append(text))
+
+    assert scheduler.spread_mode()
+    t0 = 1_000_000.0
+    monkeypatch.setattr(scheduler, "_last_tick", t0)
+    per_tick = []
+    for i in range(1, 13):
+        before = len(pushes)
+        scheduler.run_tick(now=t0 + 5 * i)
+        per_tick.append(len(pushes) - before)
+        # a user is handled in the tick that covers its slot
+        for uid in pushes[before:]:
+            assert scheduler._slot_due(uid, (t0 + 5 * (i - 1), t0 + 5 * i))
+    assert sorted(pushes) == sorted(users)
+    assert max(per_tick) < len(users)
@@ -0,0 +1,56 @@
+import json
+import multiprocessing
+
+import pytest
+
+from dingbot import facts_file, memory_file, filelock
+
+pytestmark = pytest.mark.skipif(not filelock.FCNTL_AVAILABLE, reason="needs fcntl")
+
+
+def _append_many(path, worker, n):
+    memory_file.MEMORY_FILE = path
+    for i in range(n):
+        memory_file.append_user_message(f"u{worker}", "x" * 3000 + str(i))
+
+
+def _write_facts(path, worker, n):
+    facts_file.FACTS_FILE = path
+    for i in range(n):
+        facts_file.set_user_facts(f"u{worker}-{i}", [{"fact": f"fact {i}"}])
+
+
+def _run_workers(target, path, workers=4, n=25):
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=target, args=(path, w, n)) for w in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(30)
+        assert p.exitcode == 0
+
+
+def test_concurrent_process_appends_stay_whole(tmp_path):
+    path = str(tmp_path / "mem.jsonl")
+    _run_workers(_append_many, path)
+    with open(path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 100
+
+
+def test_concurrent_process_fact_writers_do_not_lose_users(tmp_path, monkeypatch):
+    path = str(tmp_path / "facts.json")
+    _run_workers(_write_facts, path, n=10)
+    monkeypatch.setattr(facts_file, "FACTS_FILE", path)
+    assert len(facts_file.load_all_facts()) == 40
+
+
+def test_try_lock_exclusive_is_single_holder(tmp_path):
+    path = str(tmp_path / "sched.lock")
+    held = filelock.try_lock_exclusive(path)
+    assert held is not None
+    assert filelock.try_lock_exclusive(path) is None
+    held.close()
+    again = filelock.try_lock_exclusive(path)
+    assert again is not None
+    again.close()
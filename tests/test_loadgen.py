@@ -0,0 +1,71 @@
+import json
+import threading
+
+from werkzeug.serving import make_server
+
+from dingbot import agent, config, loadgen, memory, memory_file, sender
+import dingbot.server as server
+
+
+def _serve(srv):
+    t = threading.Thread(target=srv.serve_forever, daemon=True)
+    t.start()
+    return t
+
+
+def test_arrival_plan_has_rate_and_bursts():
+    arrivals = loadgen.plan_arrivals(rate=50, duration=10, burst_size=30, burst_every=4, seed=1)
+    assert arrivals == sorted(arrivals) and all(0 <= t < 10 for t in arrivals)
+    # ~500 Poisson arrivals plus two bursts of 30 at t=4 and t=8
+    assert 400 < len(arrivals) - 60 < 600
+    assert arrivals.count(4.0) == 30 and arrivals.count(8.0) == 30
+
+
+def test_load_run_against_webhook_and_fake_dingtalk(monkeypatch, tmp_path):
+    fake = loadgen.make_fake_dingtalk(port=0, rate_per_minute=0)
+    _serve(fake)
+    base = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    monkeypatch.setattr(config, "DINGTALK_API_BASE", base)
+    monkeypatch.setattr(config, "ACCESS_TOKEN", "load-token")
+    monkeypatch.setattr(config, "SECRET", "load-secret")
+    monkeypatch.setattr(config, "DINGTALK_ROBOTS", "")
+    monkeypatch.setattr(config, "OUTBOX_ENABLED", False)
+    monkeypatch.setattr(config, "SENDER_RATE_PER_MINUTE", 0)
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    monkeypatch.setattr(memory, "DB_PATH", str(tmp_path / "load.db"))
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(agent, "_call_model", lambda prompt, timeout=8: json.dumps({"reply": "收到"}))
+    server.init_app(start_scheduler=False, start_summarizer=False)
+    app_server = make_server("127.0.0.1", 0, server.app, threaded=True)
+    _serve(app_server)
+    try:
+        target = f"http://127.0.0.1:{app_server.server_port}/webhook"
+        payloads = loadgen.generate_payloads(users=20, groups=3, command_ratio=0, seed=7)
+        report = loadgen.run_load(target, [i * 0.005 for i in range(40)], payloads, concurrency=8)
+    finally:
+        app_server.shutdown()
+        fake.shutdown()
+
+    assert report["sent"] == 40 and report["ok"] == 40 and report["error_rate"] == 0
+    # ordinary messages are answered with plain text
+    assert report["errcode"] == {} and report["status"] == {"200": 40}
+    assert report["latency"]["p50_ms"] <= report["latency"]["p99_ms"] <= report["latency"]["max_ms"]
+    # every reply reached the stand-in through the configured API base
+    stats = fake.stats()
+    assert stats["received"] == 40 and stats["by_robot"] == {"load-token": 40}
+
+
+def test_fake_dingtalk_throttles_like_the_real_api(tmp_path):
+    import requests
+
+    fake = loadgen.make_fake_dingtalk(port=0, rate_per_minute=6)
+    _serve(fake)
+    try:
+        url = f"http://127.0.0.1:{fake.server_address[1]}/robot/send?access_token=t"
+        codes = [requests.post(url, json={"msgtype": "text"}).json()["errcode"] for _ in range(5)]
+    finally:
+        fake.shutdown()
+    assert codes[:2] == [0, 0] and codes[-1] == 130101
+    assert fake.stats()["throttled"] == 3
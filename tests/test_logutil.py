@@ -0,0 +1,71 @@
+import io
+import json
+import logging
+import logging.handlers
+import queue
+
+from dingbot import config, logutil, tracing
+
+
+def test_payload_is_lazy_redacted_and_truncated(monkeypatch):
+    monkeypatch.setattr(config, "LOG_REDACT_KEYS", "token,webhook")
+
+    class Boom:
+        def __str__(self):
+            raise AssertionError("serialized although the record was filtered")
+
+    logger = logging.getLogger("test.logutil.lazy")
+    logger.setLevel(logging.WARNING)
+    logger.info("payload %s", logutil.Payload(Boom()))
+
+    data = {"text": {"content": "x" * 100}, "sessionWebhook": "https://secret", "meta": [{"access_token": "t"}]}
+    text = str(logutil.Payload(data, max_chars=60))
+    assert "https://secret" not in text and '"t"' not in text
+    assert text.endswith("chars)") and text.startswith('{"text": {"content": "xxx')
+    full = json.loads(str(logutil.Payload(data, max_chars=0)))
+    assert full["sessionWebhook"] == logutil.REDACTED and full["meta"][0]["access_token"] == logutil.REDACTED
+
+
+def test_sampling_filter_by_logger_prefix(monkeypatch):
+    f = logutil.SamplingFilter(logutil._parse_rates("dingbot=1, dingbot.server=0, bad, x=y"))
+    rec = lambda name, level=logging.INFO: logging.LogRecord(name, level, __file__, 1, "m", None, None)
+    assert f.filter(rec("dingbot.server")) is False
+    assert f.filter(rec("dingbot.server.sub")) is False
+    assert f.filter(rec("dingbot.server", logging.WARNING)) is True
+    assert f.filter(rec("dingbot.agent")) is True
+    assert f.filter(rec("werkzeug")) is True
+
+
+def test_json_formatter_includes_request_id_and_extras(monkeypatch):
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 0.0)
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logutil.JsonFormatter())
+    handler.addFilter(logutil.ContextFilter())
+    logger = logging.getLogger("test.logutil.json")
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        with tracing.start_trace("t") as root:
+            logger.warning("hello %s", "world", extra={"user_id": "u1"})
+    finally:
+        logger.removeHandler(handler)
+    out = json.loads(stream.getvalue())
+    assert out["msg"] == "hello world" and out["level"] == "WARNING"
+    assert out["request_id"] == root.trace_id and out["user_id"] == "u1"
+
+
+def test_queue_handler_drops_instead_of_blocking():
+    handler = logutil.DroppingQueueHandler(queue.Queue(maxsize=1))
+    logger = logging.getLogger("test.logutil.queue")
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.warning("one %s", logutil.Payload({"a": 1}))
+        logger.warning("two")
+    finally:
+        logger.removeHandler(handler)
+    assert handler.dropped == 1
+    record = handler.queue.get_nowait()
+    # not formatted on the caller's thread
+    assert isinstance(record.args[0], logutil.Payload)
@@ -0,0 +1,83 @@
+import json
+import time
+
+import dingbot.agent as agent
+import dingbot.server as server
+from dingbot import metrics, memory_file
+
+
+def test_counter_and_histogram_exposition():
+    c = metrics.Counter("t_requests_total", "test counter")
+    c.inc(kind="a")
+    c.inc(2, kind="a")
+    c.inc(kind='we"ird')
+    h = metrics.Histogram("t_latency_seconds", "test histogram", buckets=(0.1, 1.0))
+    h.observe(0.05, stage="x")
+    h.observe(0.5, stage="x")
+    h.observe(5, stage="x")
+
+    lines = c.render() + h.render()
+    assert "# TYPE t_requests_total counter" in lines
+    assert 't_requests_total{kind="a"} 3' in lines
+    assert 't_requests_total{kind="we\\"ird"} 1' in lines
+    assert 't_latency_seconds_bucket{stage="x",le="0.1"} 1' in lines
+    assert 't_latency_seconds_bucket{stage="x",le="1"} 2' in lines
+    assert 't_latency_seconds_bucket{stage="x",le="+Inf"} 3' in lines
+    assert 't_latency_seconds_count{stage="x"} 3' in lines
+
+
+def test_metrics_endpoint_reports_pipeline_stages(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(agent, "_call_model", lambda prompt, timeout=8: json.dumps({"reply": "ok"}))
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: None)
+    server.dedup_cache.clear()
+    before = metrics.MODEL_CALL_SECONDS.count(call_site="reply", model=agent.config.GEMINI_MODEL)
+
+    client = server.app.test_client()
+    payload = {"msgtype": "text", "msgId": "metrics-1", "text": {"content": "hi"}, "senderNick": "M", "senderId": "m1"}
+    assert client.post("/webhook", json=payload).status_code == 200
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    body = r.get_data(as_text=True)
+    for stage in ("webhook_parse", "history_load", "prompt_build", "json_parse"):
+        assert f'dingbot_stage_duration_seconds_count{{stage="{stage}"}}' in body
+    assert 'dingbot_webhook_requests_total{kind="message"}' in body
+    assert "dingbot_webhook_queue_depth 0" in body
+    assert metrics.MODEL_CALL_SECONDS.count(call_site="reply", model=agent.config.GEMINI_MODEL) == before + 1
+
+
+def test_model_calls_are_labelled_with_the_resolved_model(monkeypatch):
+    monkeypatch.setattr(agent.config, "GEMINI_MODEL", "gemini-3")
+    monkeypatch.setattr(agent, "_resolved_models", {})
+
+    def call_and_resolve(prompt, timeout=8):
+        agent._resolved_models["gemini-3"] = "models/gemini-3-pro-preview"
+        return "ok"
+
+    monkeypatch.setattr(agent, "_call_model", call_and_resolve)
+    before = metrics.MODEL_CALL_SECONDS.count(call_site="t", model="models/gemini-3-pro-preview")
+    agent._timed_model_call("t", "hi")
+    assert metrics.MODEL_CALL_SECONDS.count(call_site="t", model="models/gemini-3-pro-preview") == before + 1
+    assert metrics.MODEL_CALL_SECONDS.count(call_site="t", model="gemini-3") == 0
+
+
+def test_metrics_endpoint_merges_process_snapshots(monkeypatch, tmp_path):
+    monkeypatch.setattr(server.config, "METRICS_DIR", str(tmp_path))
+    other = {
+        "process": "web-2:4242",
+        "time": time.time(),
+        "metrics": [{"name": "dingbot_webhook_requests_total", "type": "counter", "help": "h",
+                     "rows": [["dingbot_webhook_requests_total", [["kind", "message"]], 7]]}],
+    }
+    (tmp_path / "metrics-web-2-4242.json").write_text(json.dumps(other))
+    stale = dict(other, process="web-3:1", time=time.time() - 3600)
+    (tmp_path / "metrics-web-3-1.json").write_text(json.dumps(stale))
+    server.WEBHOOK_REQUESTS.inc(kind="message")
+
+    body = server.app.test_client().get("/metrics").get_data(as_text=True)
+    assert 'dingbot_webhook_requests_total{kind="message",process="web-2:4242"} 7' in body
+    assert f'process="{metrics._process_id()}"' in body
+    # one HELP/TYPE per family, and stopped processes drop out
+    assert body.count("# TYPE dingbot_webhook_requests_total counter") == 1
+    assert "web-3:1" not in body and not (tmp_path / "metrics-web-3-1.json").exists()
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+from dingbot import config, sender
+from dingbot.outbound import OutboundQueue, PRIORITY_PUSH, PRIORITY_REPLY
+from dingbot.ratelimit import SharedTokenBucket, TokenBucket
+from dingbot.workqueue import QueueFull
+
+
+def test_replies_go_ahead_of_pushes_and_rate_is_respected():
+    sent = []
+
+    def send(robot, payload):
+        sent.append((robot, payload, time.monotonic()))
+        return {"errcode": 0}
+
+    q = OutboundQueue(send, rate_per_minute=600, burst=1)  # 10/s
+    futures = [q.submit("r1", f"push{i}", PRIORITY_PUSH) for i in range(3)]
+    futures.append(q.submit("r1", "reply", PRIORITY_REPLY))
+    futures.append(q.submit("r2", "other robot", PRIORITY_PUSH))
+    q.start()
+    try:
+        assert q.join(5)
+        assert [f.result(1) for f in futures] == [{"errcode": 0}] * 5
+    finally:
+        q.stop()
+    r1 = [(p, t) for robot, p, t in sent if robot == "r1"]
+    assert [p for p, _ in r1] == ["reply", "push0", "push1", "push2"]
+    # tokens are taken 0.1s apart; the send threads add some scheduling jitter
+    assert min(b[1] - a[1] for a, b in zip(r1, r1[1:])) >= 0.05
+    # another robot has its own bucket and is not held up behind r1
+    assert {p for robot, p, _ in sent[:2]} == {"reply", "other robot"}
+    assert q.stats()["sent"] == 5
+
+
+def test_shared_bucket_limits_several_queues_together(tmp_path):
+    # two queues stand in for two worker processes sending to the same robot
+    path = str(tmp_path / "rate.db")
+    sent = []
+
+    def send(robot, payload):
+        sent.append(time.monotonic())
+        return {"errcode": 0}
+
+    queues = [OutboundQueue(send, rate_per_minute=600, burst=1,  # 10/s for both together
+                            bucket_factory=lambda robot, rate, burst: SharedTokenBucket(path, robot, rate, burst))
+              for _ in range(2)]
+    for q in queues:
+        for i in range(4):
+            q.submit("r1", i)
+    started = time.monotonic()
+    for q in queues:
+        q.start()
+    try:
+        assert all(q.join(5) for q in queues)
+    finally:
+        for q in queues:
+            q.stop()
+    # 8 sends with one token up front need 0.7s at 10/s; separate buckets would take 0.3s
+    assert len(sent) == 8 and max(sent) - started >= 0.6
+
+
+def test_slow_bucket_does_not_block_submitters():
+    # a shared bucket does SQLite calls; they must not run with the queue lock held
+    sent = []
+    checking = threading.Event()
+
+    class SlowBucket(TokenBucket):
+        def time_until(self, n=1, now=None):
+            checking.set()
+            time.sleep(0.3)
+            return super().time_until(n, now)
+
+    q = OutboundQueue(lambda robot, payload: sent.append(payload) or {"errcode": 0},
+                      rate_per_minute=6000, burst=5, bucket_factory=lambda robot, rate, burst: SlowBucket(rate, burst))
+    q.submit("r1", "first")
+    q.start()
+    try:
+        assert checking.wait(2)
+        started = time.monotonic()
+        q.submit("r2", "second")
+        assert q.depth() >= 1
+        assert time.monotonic() - started < 0.1
+        assert q.join(5)
+    finally:
+        q.stop()
+    assert sorted(sent) == ["first", "second"]
+
+
+def test_throttled_send_is_retried_after_backoff():
+    results = [{"errcode": 130101}, {"errcode": 0}]
+    calls = []
+
+    def send(robot, payload):
+        calls.append(time.monotonic())
+        return results[len(calls) - 1]
+
+    q = OutboundQueue(send, rate_per_minute=6000, burst=5, throttle_backoff=0.2,
+                      is_throttled=lambda r: r.get("errcode") == 130101).start()
+    try:
+        assert q.submit("r1", "m").result(5) == {"errcode": 0}
+    finally:
+        q.stop()
+    assert len(calls) == 2 and calls[1] - calls[0] >= 0.2
+    assert q.stats()["throttled"] == 1
+
+
+def test_queue_full_and_send_errors_reach_the_caller():
+    def send(robot, payload):
+        raise RuntimeError("boom")
+
+    q = OutboundQueue(send, max_depth=1)
+    q.submit("r1", "a")
+    with pytest.raises(QueueFull):
+        q.submit("r1", "b")
+    q.start()
+    try:
+        assert q.join(5)
+    finally:
+        q.stop()
+    assert q.stats()["failed"] == 1
+
+
+def test_send_text_from_env_uses_priority_class(monkeypatch):
+    seen = []
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    monkeypatch.setattr(config, "ACCESS_TOKEN", "tok")
+    monkeypatch.setattr(config, "SECRET", "sec")
+    monkeypatch.setattr(config, "SENDER_RATE_PER_MINUTE", 600)
+    monkeypatch.setattr(config, "OUTBOX_ENABLED", False)
+
+    class FakeQueue:
+        def submit(self, robot, payload, priority):
+            seen.append((robot, payload["body"]["text"]["content"], priority))
+
+    monkeypatch.setattr(sender, "get_outbound", lambda: FakeQueue())
+    sender.send_text_from_env("hi")
+    with sender.priority_class(sender.PRIORITY_PUSH):
+        sender.send_text_from_env("push")
+    assert seen == [("tok", "hi", PRIORITY_REPLY), ("tok", "push", PRIORITY_PUSH)]
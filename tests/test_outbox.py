@@ -0,0 +1,133 @@
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import Future
+
+from dingbot import config, sender
+from dingbot.outbox import Outbox, OutboxDrainer
+
+
+def _done(result=None, exc=None):
+    f = Future()
+    if exc is not None:
+        f.set_exception(exc)
+    else:
+        f.set_result(result)
+    return f
+
+
+def _connect_error():
+    import requests
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+    reason = NewConnectionError(None, "Failed to establish a new connection")
+    return requests.exceptions.ConnectionError(MaxRetryError(None, "/robot/send", reason))
+
+
+def test_failed_send_is_retried_then_delivered(tmp_path):
+    box = Outbox(str(tmp_path / "outbox.db"))
+    answers = [_connect_error(), {"errcode": sender.THROTTLED_ERRCODE, "errmsg": "send too fast"}, {"errcode": 0}]
+    calls = []
+
+    def submit(robot, body, priority):
+        calls.append(body)
+        a = answers[len(calls) - 1]
+        return _done(exc=a) if isinstance(a, Exception) else _done(a)
+
+    drainer = OutboxDrainer(box, submit, sender._classify, sender._classify_error, retry_base=0)
+    waiter = drainer.enqueue("tok", {"msgtype": "text", "text": {"content": "hi"}})
+    assert not waiter.done()
+    assert drainer.drain_once() == 1
+    assert not waiter.done()
+    assert drainer.drain_once() == 1
+    assert drainer.drain_once() == 0 and waiter.result(1) == {"errcode": 0}
+    assert len(calls) == 3 and calls[0]["text"]["content"] == "hi"
+    assert box.counts() == {"delivered": 1}
+    assert box.get(1)["attempts"] == 3
+
+
+def test_sends_that_may_have_been_posted_are_not_retried(tmp_path):
+    import requests
+
+    # a read timeout or a gateway error page can come after DingTalk posted the message
+    for i, answer in enumerate([_done(exc=requests.exceptions.ReadTimeout("read timed out")),
+                                _done({"status_code": 502, "text": "bad gateway"})]):
+        box = Outbox(str(tmp_path / f"outbox{i}.db"))
+        drainer = OutboxDrainer(box, lambda r, b, p: answer, sender._classify, sender._classify_error, retry_base=0)
+        waiter = drainer.enqueue("tok", {"msgtype": "text"})
+        assert waiter.exception(1) is not None
+        assert box.counts() == {"failed": 1} and drainer.stats()["retried"] == 0
+
+
+def test_permanent_error_gives_up(tmp_path):
+    box = Outbox(str(tmp_path / "outbox.db"))
+    drainer = OutboxDrainer(box, lambda r, b, p: _done({"errcode": 310000, "errmsg": "sign not match"}), sender._classify)
+    waiter = drainer.enqueue("tok", {"msgtype": "text"})
+    assert "310000" in str(waiter.exception(1))
+    assert box.counts() == {"failed": 1}
+
+
+def test_pending_messages_are_replayed_by_the_next_process(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    # first process crashes before its send completes
+    crashed = OutboxDrainer(Outbox(path, lease_seconds=0.05), lambda r, b, p: Future(), sender._classify)
+    crashed.enqueue("tok", {"n": 1})
+    crashed.enqueue("tok", {"n": 2}, priority=1)
+
+    sent = []
+    replay = OutboxDrainer(Outbox(path), lambda r, b, p: sent.append(b) or _done({"errcode": 0}), sender._classify)
+    assert replay.drain_once() == 0  # still leased by the crashed process
+    time.sleep(0.1)
+    assert replay.drain_once() == 2
+    assert sent == [{"n": 1}, {"n": 2}]
+    assert replay.drain_once() == 0
+    assert Outbox(path).counts() == {"delivered": 2}
+
+
+def test_starting_drainer_takes_back_rows_of_a_dead_process(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    host = socket.gethostname()
+    dead = Outbox(path, owner=f"{host}:{child.pid}:dead0000")
+    dead.add("tok", {"n": 1})
+    dead.add("tok", {"n": 2})
+    Outbox(path, owner="other-host:1:abcd0000").add("tok", {"n": 3})
+
+    sent = []
+    drainer = OutboxDrainer(Outbox(path), lambda r, b, p: sent.append(b) or _done({"errcode": 0}),
+                            sender._classify, poll_seconds=60).start()
+    try:
+        deadline = time.time() + 2
+        while len(sent) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        drainer.stop()
+    # delivered on start rather than after the 300s lease; the other host's row waits
+    assert sent == [{"n": 1}, {"n": 2}]
+    assert Outbox(path).counts() == {"delivered": 2, "pending": 1}
+
+
+def test_send_text_from_env_writes_outbox_first(monkeypatch, tmp_path):
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    monkeypatch.setattr(config, "ACCESS_TOKEN", "tok")
+    monkeypatch.setattr(config, "SECRET", "sec")
+    monkeypatch.setattr(config, "OUTBOX_ENABLED", True)
+    submitted = []
+
+    class FakeQueue:
+        def submit(self, robot, payload, priority):
+            submitted.append((robot, payload, priority))
+            return Future()
+
+    box = Outbox(str(tmp_path / "outbox.db"))
+    drainer = OutboxDrainer(box, sender._submit_outbound, sender._classify)
+    monkeypatch.setattr(sender, "get_outbound", lambda: FakeQueue())
+    monkeypatch.setattr(sender, "get_drainer", lambda: drainer)
+
+    sender.send_text_from_env("hello", at_user_ids=["u1"])
+    assert box.counts() == {"pending": 1}
+    robot, payload, priority = submitted[0]
+    assert robot == "tok" and payload["secret"] == "sec"
+    assert payload["body"]["text"]["content"] == "hello" and priority == sender.PRIORITY_REPLY
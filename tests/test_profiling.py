@@ -0,0 +1,119 @@
+import json
+import pstats
+import threading
+
+import dingbot.agent as agent
+import dingbot.server as server
+from dingbot import activity, config, facts_file, memory_file, profiling, scheduler
+from dingbot.workqueue import KeyedWorkQueue
+
+
+def test_sampled_webhook_writes_profile(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(agent, "_call_model", lambda prompt, timeout=8: json.dumps({"reply": "ok"}))
+    monkeypatch.setattr(server.sender, "DISABLE_NETWORK", "1")
+    monkeypatch.setattr(profiling, "_settings", {"sample_rate": 1.0, "scheduler_every": 0})
+    server.dedup_cache.clear()
+
+    client = server.app.test_client()
+    r = client.post("/webhook", json={"msgtype": "text", "msgId": "prof-1", "text": {"content": "hi"}, "senderId": "p1"})
+    assert r.status_code == 200
+
+    files = list((tmp_path / "profiles").glob("webhook-*.prof"))
+    assert len(files) == 1
+    names = {func[2] for func in pstats.Stats(str(files[0])).stats}
+    assert "analyze_and_reply" in names
+
+
+def test_scheduler_profiles_every_nth_cycle_and_prunes(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "PROFILE_MAX_FILES", 2)
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(profiling, "_settings", {"sample_rate": 0.0, "scheduler_every": 2})
+    monkeypatch.setattr(profiling, "_cycles", iter(range(1, 100)))
+
+    for _ in range(4):
+        scheduler.run_cycle()
+    assert len(list(tmp_path.glob("scheduler-*.prof"))) == 2
+
+    for _ in range(4):
+        scheduler.run_cycle()
+    assert len(list(tmp_path.glob("*.prof"))) == 2
+
+
+def test_scheduler_jobs_are_part_of_the_cycle_profile(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(activity, "ACTIVITY_FILE", str(tmp_path / "activity.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(config, "SCHEDULER_WORKERS", 2)
+    monkeypatch.setattr(profiling, "_settings", {"sample_rate": 0.0, "scheduler_every": 1})
+    monkeypatch.setattr(scheduler.sender, "send_text_from_env", lambda text, at_user_ids=None: None)
+
+    def extract_facts_in_pool_thread(uid):
+        return [{"fact": "x"}]
+
+    monkeypatch.setattr(agent, "extract_facts_for_user", extract_facts_in_pool_thread)
+    monkeypatch.setattr(agent, "generate_push_from_facts", lambda uid, facts: "push")
+    for uid in ("u1", "u2", "u3"):
+        memory_file.append_user_message(uid, "hi")
+
+    scheduler.run_cycle()
+    files = list((tmp_path / "profiles").glob("scheduler-*.prof"))
+    assert len(files) == 1
+    calls = {func[2]: stat[1] for func, stat in pstats.Stats(str(files[0])).stats.items()}
+    # the per-user jobs ran on pool threads and are still in the cycle's file
+    assert calls["extract_facts_in_pool_thread"] == 3
+    assert not profiling._active.locked()
+
+
+def test_async_webhook_turn_is_profiled(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(config, "PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(profiling, "_settings", {"sample_rate": 1.0, "scheduler_every": 0})
+    q = KeyedWorkQueue(workers=1, max_depth=10, name="test").start()
+    monkeypatch.setattr(server, "work_queue", q)
+    release = threading.Event()
+
+    def agent_on_worker_thread(content, sender_name, user_id=None):
+        release.wait(5)
+        return {"reply": "ok"}
+
+    monkeypatch.setattr(server.agent, "analyze_and_reply", agent_on_worker_thread)
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: None)
+    server.dedup_cache.clear()
+
+    r = server.app.test_client().post(
+        "/webhook", json={"msgtype": "text", "msgId": "prof-async", "text": {"content": "hi"}, "senderId": "p2"})
+    assert r.get_json()["errmsg"] == "queued"
+    release.set()
+    assert q.join(timeout=5)
+    q.stop()
+
+    # joined into the request's profile if it started before the request ended, else its own
+    files = list((tmp_path / "profiles").glob("webhook-*.prof"))
+    names = set()
+    for f in files:
+        names |= {func[2] for func in pstats.Stats(str(f)).stats}
+    assert "agent_on_worker_thread" in names and "_webhook" in names
+    assert not profiling._active.locked()
+
+
+def test_admin_endpoint_toggles_sampling(monkeypatch):
+    monkeypatch.setattr(profiling, "_settings", {"sample_rate": 0.0, "scheduler_every": 0})
+    client = server.app.test_client()
+
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "")
+    assert client.get("/admin/profiling").status_code == 403
+
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "secret")
+    assert client.post("/admin/profiling", json={"sample_rate": 1}, headers={"X-Admin-Token": "nope"}).status_code == 403
+    r = client.post("/admin/profiling", json={"sample_rate": 0.5, "scheduler_every": 3},
+                    headers={"X-Admin-Token": "secret"})
+    assert r.status_code == 200
+    assert r.get_json()["sample_rate"] == 0.5 and r.get_json()["scheduler_every"] == 3
+    assert client.post("/admin/profiling", json={"sample_rate": "x"},
+                       headers={"X-Admin-Token": "secret"}).status_code == 400
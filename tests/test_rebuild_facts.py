@@ -0,0 +1,75 @@
+import json
+
+from dingbot import agent, facts_file, memory_file, rebuild_facts, sender
+
+
+def _setup(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(agent, "_user_summary", lambda uid: "")
+    monkeypatch.setattr(sender, "send_text_from_env", lambda *a, **k: (_ for _ in ()).throw(AssertionError("no pushes")))
+    for i in range(6):
+        for j in range(3):
+            memory_file.append_user_message(f"u{i}", f"u{i} m{j}")
+    facts_file.set_user_facts("u5", [{"fact": "old"}])
+    return str(tmp_path / "ckpt.json")
+
+
+def test_rebuild_writes_facts_in_batches(monkeypatch, tmp_path):
+    checkpoint = _setup(monkeypatch, tmp_path)
+    prompts = []
+
+    def fake_call(prompt, timeout=10):
+        prompts.append(prompt)
+        return "[]" if "- u5 " in prompt else json.dumps([{"fact": prompt.count("\n- ")}])
+
+    monkeypatch.setattr(agent, "_call_model", fake_call)
+
+    stats = rebuild_facts.rebuild(workers=2, max_messages=2, batch=2, checkpoint=checkpoint, threads=True)
+    facts = facts_file.load_all_facts()
+    # the last two messages of each user, from the single pass over the log
+    u0_prompt = next(p for p in prompts if "- u0 " in p)
+    assert facts["u0"] == [{"fact": 2}] and "- u0 m2" in u0_prompt and "- u0 m0" not in u0_prompt
+    # an empty result keeps the previous facts
+    assert facts["u5"] == [{"fact": "old"}]
+    assert stats["users"] == 6 and stats["written"] == 5 and stats["empty"] == 1 and stats["messages"] == 18
+    assert stats["users_per_second"] > 0
+    assert not (tmp_path / "ckpt.json").exists()
+
+
+def test_rebuild_resumes_from_checkpoint(monkeypatch, tmp_path):
+    checkpoint = _setup(monkeypatch, tmp_path)
+    seen = []
+
+    def flaky(uid, max_messages=50, messages=None, strict=False):
+        seen.append(uid)
+        if uid == "u3":
+            raise RuntimeError("quota")
+        return [{"fact": uid}]
+
+    monkeypatch.setattr(rebuild_facts.agent, "extract_facts_for_user", flaky)
+    stats = rebuild_facts.rebuild(workers=1, batch=1, checkpoint=checkpoint, threads=True)
+    assert stats["failed"] == 1
+    assert json.load(open(checkpoint))["done"] == ["u0", "u1", "u2", "u4", "u5"]
+
+    seen.clear()
+    monkeypatch.setattr(rebuild_facts.agent, "extract_facts_for_user", lambda uid, **kwargs: [{"fact": uid}])
+    stats = rebuild_facts.rebuild(workers=1, batch=1, checkpoint=checkpoint, threads=True)
+    assert stats["users"] == 1 and stats["skipped"] == 5 and stats["failed"] == 0
+    assert facts_file.get_user_facts("u3") == [{"fact": "u3"}]
+
+
+def test_failed_model_call_is_not_checkpointed(monkeypatch, tmp_path):
+    checkpoint = _setup(monkeypatch, tmp_path)
+
+    def fake_call(prompt, timeout=10):
+        if "- u2 " in prompt:
+            raise RuntimeError("503 model overloaded")
+        return "[]" if "- u4 " in prompt else json.dumps([{"fact": "x"}])
+
+    monkeypatch.setattr(agent, "_call_model", fake_call)
+    stats = rebuild_facts.rebuild(workers=1, batch=1, checkpoint=checkpoint, threads=True)
+    # a genuinely empty answer is done; the failed call is not
+    assert stats["failed"] == 1 and stats["empty"] == 1 and stats["written"] == 4
+    assert json.load(open(checkpoint))["done"] == ["u0", "u1", "u3", "u4", "u5"]
+    assert facts_file.get_user_facts("u2") == []
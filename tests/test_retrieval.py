@@ -0,0 +1,113 @@
+import json
+
+import dingbot.agent as agent
+from dingbot import config, memory_file, facts_file, retrieval
+
+
+def _use_tmp_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    # keep a summarizer started by another test from folding these messages in the background
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    retrieval.reset()
+
+
+def test_relevant_older_message_is_retrieved(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    memory_file.append_user_message("u1", "我养了一只猫叫咪咪", timestamp=1)
+    for i in range(20):
+        memory_file.append_user_message("u1", f"今天天气不错 {i}", timestamp=10 + i)
+    memory_file.append_user_message("u2", "我的猫生病了", timestamp=50)
+
+    ctx = retrieval.build_context("u1", "我的猫最近怎么样", top_k=2, recent=3)
+    contents = [m["content"] for m in ctx["messages"]]
+    assert "我养了一只猫叫咪咪" in contents
+    # recent window is kept and other users never leak in
+    assert "今天天气不错 19" in contents
+    assert "我的猫生病了" not in contents
+    # chronological order
+    assert [m["timestamp"] for m in ctx["messages"]] == sorted(m["timestamp"] for m in ctx["messages"])
+
+
+def test_index_picks_up_appends_incrementally(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    memory_file.append_user_message("u1", "hello there", timestamp=1)
+    retrieval.build_context("u1", "hello", recent=0)
+
+    memory_file.append_user_message("u1", "my favourite coffee is latte", timestamp=2)
+    ctx = retrieval.build_context("u1", "coffee", top_k=1, recent=0)
+    assert [m["content"] for m in ctx["messages"]] == ["my favourite coffee is latte"]
+
+
+def test_token_budget_and_facts(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    for i in range(10):
+        memory_file.append_user_message("u1", "x" * 400 + f" {i}", timestamp=i)
+    facts_file.set_user_facts("u1", [{"fact": "likes hiking"}, {"fact": "works in Beijing"}])
+
+    ctx = retrieval.build_context("u1", "hiking plans", top_k=3, recent=10, token_budget=250)
+    assert sum(retrieval.estimate_tokens(m["content"]) for m in ctx["messages"]) <= 250
+    assert len(ctx["messages"]) == 2
+    assert ctx["facts"] == [{"fact": "likes hiking"}]
+
+
+def test_analyze_and_reply_prompt_uses_retrieved_context(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    memory_file.append_user_message("u1", "my dog is called Rex", timestamp=1)
+    for i in range(15):
+        memory_file.append_user_message("u1", f"filler message {i}", timestamp=10 + i)
+
+    prompts = []
+
+    def fake_call(prompt, timeout=8):
+        prompts.append(prompt)
+        return json.dumps({"reply": "ok"})
+
+    monkeypatch.setattr(agent, "_call_model", fake_call)
+    res = agent.analyze_and_reply("what is my dog called?", "Tester", user_id="u1")
+    assert res["reply"] == "ok"
+    assert "my dog is called Rex" in prompts[0]
+    assert "filler message 0" not in prompts[0]
+
+
+def test_first_query_scans_without_blocking_others(monkeypatch, tmp_path):
+    import threading
+
+    _use_tmp_files(monkeypatch, tmp_path)
+    memory_file.append_user_message("u1", "tea with lemon", timestamp=1)
+    memory_file.append_user_message("u2", "coffee beans", timestamp=2)
+    retrieval.build_context("u1", "tea")
+
+    scanning, release = threading.Event(), threading.Event()
+    real_scan = retrieval._scan
+
+    def slow_scan(path, start, end, indexes):
+        if "u2" in indexes and start == 0:
+            scanning.set()
+            release.wait(5)
+        real_scan(path, start, end, indexes)
+
+    monkeypatch.setattr(retrieval, "_scan", slow_scan)
+    result = {}
+    t = threading.Thread(target=lambda: result.update(retrieval.build_context("u2", "coffee", recent=0)))
+    t.start()
+    assert scanning.wait(5)
+    # u1 is served while u2's index is being built, and appends meanwhile are not lost
+    memory_file.append_user_message("u2", "more coffee please", timestamp=3)
+    assert retrieval.build_context("u1", "tea", recent=0)["messages"][0]["content"] == "tea with lemon"
+    release.set()
+    t.join(5)
+    assert sorted(m["content"] for m in result["messages"]) == ["coffee beans", "more coffee please"]
+
+
+def test_indexes_are_capped(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    monkeypatch.setattr(config, "RETRIEVAL_MAX_INDEXES", 2)
+    for uid in ("u1", "u2", "u3"):
+        memory_file.append_user_message(uid, f"hello from {uid}", timestamp=1)
+    for uid in ("u1", "u2", "u1", "u3"):
+        retrieval.build_context(uid, "hello")
+    assert list(retrieval._indexes) == ["u1", "u3"]
+    assert list(retrieval._facts_indexes) == ["u1", "u3"]
+    # a dropped user is rebuilt from the log on the next query
+    assert retrieval.build_context("u2", "hello")["messages"][0]["content"] == "hello from u2"
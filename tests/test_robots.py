@@ -0,0 +1,130 @@
+import json
+import time
+
+from dingbot import config, hashing, robots, sender
+from dingbot.outbound import OutboundQueue
+
+ROBOTS = [
+    {"name": "ops", "access_token": "t-ops", "secret": "s-ops", "conversation_ids": ["cid-ops"], "shard": False},
+    {"name": "p1", "access_token": "t-p1", "secret": "s-p1"},
+    {"name": "p2", "access_token": "t-p2", "secret": "s-p2"},
+    {"name": "p3", "access_token": "t-p3", "secret": "s-p3"},
+]
+
+
+def test_rendezvous_is_stable_and_moves_few_keys():
+    keys = [f"user{i}" for i in range(300)]
+    before = {k: hashing.rendezvous(k, ["a", "b", "c"]) for k in keys}
+    assert before == {k: hashing.rendezvous(k, ["c", "b", "a"]) for k in keys}
+    assert len(set(before.values())) == 3
+    after = {k: hashing.rendezvous(k, ["a", "b"]) for k in keys}
+    # only keys that lived on the removed node move
+    assert all(after[k] == before[k] for k in keys if before[k] != "c")
+
+
+def test_routing_by_conversation_and_user(monkeypatch):
+    monkeypatch.setattr(config, "DINGTALK_ROBOTS", json.dumps(ROBOTS))
+    monkeypatch.setattr(config, "ROBOT_UNHEALTHY_AFTER", 2)
+    assert robots.for_conversation("cid-ops").name == "ops"
+    assert robots.for_conversation("unknown").name == "ops"
+    owners = {robots.for_user(f"u{i}").name for i in range(50)}
+    assert owners == {"p1", "p2", "p3"}
+
+    victim = robots.for_user("u1")
+    victim.record(0.1, False, "boom")
+    victim.record(0.1, False, "boom")
+    assert not victim.healthy and robots.for_user("u1") is not victim
+    victim.record(0.1, True)
+    assert robots.for_user("u1") is victim
+    assert robots.stats()[victim.name]["errors"] == 2
+
+
+def test_unhealthy_robot_gets_a_trial_and_its_users_back(monkeypatch):
+    monkeypatch.setattr(config, "DINGTALK_ROBOTS", json.dumps(ROBOTS))
+    monkeypatch.setattr(config, "ROBOT_UNHEALTHY_AFTER", 2)
+    monkeypatch.setattr(config, "ROBOT_RETRY_AFTER_SECONDS", 30)
+    now = [1000.0]
+    monkeypatch.setattr(robots.time, "monotonic", lambda: now[0])
+    users = [f"u{i}" for i in range(50)]
+    victim = robots.for_user("u1")
+    owned = [u for u in users if robots.for_user(u) is victim]
+
+    # throttling is not a health failure
+    for _ in range(3):
+        victim.record(0.1, False, "130101", throttled=True)
+    assert victim.healthy and victim.stats()["throttled"] == 3
+
+    victim.record(0.1, False, "boom")
+    victim.record(0.1, False, "boom")
+    assert all(robots.for_user(u) is not victim for u in owned)
+
+    # after the cooldown one push goes through as a trial, the rest still avoid it
+    now[0] += 31
+    assert robots.for_user(owned[0]) is victim
+    assert all(robots.for_user(u) is not victim for u in owned[1:])
+    # a failed trial waits for the next cooldown
+    victim.record(0.1, False, "boom")
+    now[0] += 10
+    assert robots.for_user(owned[0]) is not victim
+    now[0] += 31
+    assert robots.for_user(owned[0]) is victim
+    victim.record(0.1, True)
+    assert [u for u in users if robots.for_user(u) is victim] == owned
+
+
+def test_broadcast_and_routed_sends(monkeypatch):
+    monkeypatch.setattr(config, "DINGTALK_ROBOTS", json.dumps(ROBOTS))
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    monkeypatch.setattr(config, "SENDER_RATE_PER_MINUTE", 0)
+    sent = []
+    monkeypatch.setattr(sender, "post_message", lambda token, secret, body: sent.append((token, secret)) or {"errcode": 0})
+
+    futures = sender.broadcast_text("hello all")
+    assert set(futures) == {"ops", "p1", "p2", "p3"}
+    assert sorted(sent) == sorted((r["access_token"], r["secret"]) for r in ROBOTS)
+
+    sent.clear()
+    with sender.route(conversation_id="cid-ops"):
+        sender.send_text_from_env("reply")
+    with sender.route(user_id="u7"):
+        sender.send_text_from_env("push")
+    assert sent[0] == ("t-ops", "s-ops")
+    assert sent[1][0] == robots.for_user("u7").access_token
+
+
+def test_digest_goes_to_a_push_robot(monkeypatch):
+    monkeypatch.setattr(config, "DINGTALK_ROBOTS", json.dumps(ROBOTS))
+    monkeypatch.setattr(config, "ROBOT_UNHEALTHY_AFTER", 1)
+    monkeypatch.setattr(config, "PUSH_DIGEST_ROBOT", "")
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    monkeypatch.setattr(config, "SENDER_RATE_PER_MINUTE", 0)
+    sent = []
+    monkeypatch.setattr(sender, "post_message", lambda token, secret, body: sent.append(token) or {"errcode": 0})
+
+    # "ops" comes first but is not a shard robot
+    with sender.route(digest=True):
+        sender.send_markdown_from_env("digest", "text")
+    assert sent == ["t-p1"]
+    robots.all_robots()[1].record(0.1, False, "boom")
+    assert robots.for_digest().name == "p2"
+    robots.all_robots()[1].record(0.1, True)
+
+    monkeypatch.setattr(config, "PUSH_DIGEST_ROBOT", "ops")
+    assert robots.for_digest().name == "ops"
+
+
+def test_outbound_sends_to_robots_concurrently():
+    def send(robot, payload):
+        time.sleep(0.2)
+        return {"errcode": 0}
+
+    q = OutboundQueue(send, rate_per_minute=6000, burst=5, concurrency=4)
+    for r in ("a", "b", "c", "d"):
+        q.submit(r, "m")
+    start = time.monotonic()
+    q.start()
+    try:
+        assert q.join(5)
+    finally:
+        q.stop()
+    assert time.monotonic() - start < 0.6
@@ -0,0 +1,77 @@
+import os
+import urllib.parse
+
+from dingbot import config, sender
+
+
+class FakeResponse:
+    status_code = 200
+    text = ""
+
+    def json(self):
+        return {"errcode": 0, "errmsg": "ok"}
+
+
+class FakeSession:
+    def __init__(self):
+        self.calls = []
+
+    def post(self, url, json=None, timeout=None):
+        self.calls.append((url, json, timeout))
+        return FakeResponse()
+
+
+def test_sends_reuse_session_and_signature(monkeypatch):
+    fake = FakeSession()
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    monkeypatch.setattr(sender, "_session", fake)
+    monkeypatch.setattr(sender, "_session_pid", os.getpid())
+    monkeypatch.setattr(sender, "_signed_cache", {})
+    monkeypatch.setattr(config, "SENDER_SIGN_REUSE_SECONDS", 60)
+    clock = [1000.0]
+    monkeypatch.setattr(sender.time, "time", lambda: clock[0])
+
+    assert sender.send_text("tok", "sec", "a", at_user_ids=["u1"])["errcode"] == 0
+    clock[0] += 30
+    sender.send_text("tok", "sec", "b")
+    clock[0] += 31
+    sender.send_text("tok", "sec", "c")
+
+    urls = [c[0] for c in fake.calls]
+    assert urls[0] == urls[1] != urls[2]
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(urls[2]).query)
+    assert query["timestamp"] == ["1061000"] and query["access_token"] == ["tok"]
+    assert fake.calls[0][1]["at"]["atUserIds"] == ["u1"]
+    assert fake.calls[0][2] == (config.SENDER_CONNECT_TIMEOUT, config.SENDER_READ_TIMEOUT)
+
+
+def test_session_pool_and_retry_policy(monkeypatch):
+    monkeypatch.setattr(config, "SENDER_POOL_MAXSIZE", 7)
+    monkeypatch.setattr(config, "SENDER_RETRIES", 3)
+    monkeypatch.setattr(sender, "_session", None)
+    session = sender.get_session()
+    assert sender.get_session() is session
+    adapter = session.get_adapter("https://oapi.dingtalk.com")
+    assert adapter._pool_maxsize == 7
+    retry = adapter.max_retries
+    assert retry.connect == 3 and retry.read == 0 and 500 not in retry.status_forcelist
+    assert sender.stats()["pools"] == []
+
+
+def test_split_markdown_respects_byte_limit():
+    sections = [f"#### user{i}\n\n" + "提醒" * 30 for i in range(10)]
+    text = "\n\n".join(sections)
+    chunks = sender.split_markdown(text, 300)
+    assert len(chunks) > 1
+    assert all(len(c.encode("utf-8")) <= 300 for c in chunks)
+    # sections are kept whole and in order
+    assert "\n\n".join(chunks) == text
+    assert sender.split_markdown("short", 300) == ["short"]
+    # a heading is never left at the end of a chunk without its body
+    sections = [f"#### user{i}\n\n" + "提醒" * 20 + "\n\n" + "第二段" * 10 for i in range(6)]
+    chunks = sender.split_markdown("\n\n".join(sections), 300)
+    assert all(c.startswith("#### ") and not c.rstrip().splitlines()[-1].startswith("#") for c in chunks)
+
+    long_line = "字" * 500
+    parts = sender.split_markdown(long_line, 100)
+    assert "".join(parts) == long_line and all(len(p.encode("utf-8")) <= 100 for p in parts)
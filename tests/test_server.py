@@ -87,3 +87,16 @@ def test_remember_and_normal_message(monkeypatch, tmp_path):
     assert any(call for call in sent if call[1] == ["bobid"])
 
     config.DATABASE_PATH = original
+
+
+def test_failed_reply_send_is_logged(monkeypatch, caplog):
+    from concurrent.futures import Future
+
+    failed = Future()
+    monkeypatch.setattr(server.agent, "analyze_and_reply", lambda content, sender_name, user_id=None: {"reply": "hi"})
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: failed)
+
+    assert server._process_message("hello", "Bob", "bobid") == "hi"
+    # the send completes after the request returned
+    failed.set_exception(RuntimeError("message 7 not delivered"))
+    assert "Reply was not delivered" in caplog.text and "message 7" in caplog.text
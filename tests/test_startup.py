@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# generous enough for a slow CI box; a regression that pulls a heavy SDK back in blows it
+BUDGET_SECONDS = float(os.getenv("DINGBOT_IMPORT_BUDGET_SECONDS", "1.5"))
+HEAVY = ("google.genai", "requests", "urllib3", "apscheduler")
+
+_probe = """
+import json, sys, time
+start = time.perf_counter()
+import {modules}
+print(json.dumps({{"seconds": time.perf_counter() - start,
+                  "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _import_in_fresh_process(modules):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.run([sys.executable, "-c", _probe.format(modules=modules, heavy=HEAVY)],
+                         cwd=ROOT, env=env, capture_output=True, text=True, timeout=60, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_cli_and_worker_modules_skip_heavy_dependencies():
+    result = _import_in_fresh_process("dingbot.agent, dingbot.sender, dingbot.scheduler, dingbot.rebuild_facts")
+    assert result["heavy"] == []
+
+
+def test_server_import_time_within_budget():
+    # best of three, so one slow run on a busy machine doesn't fail the suite
+    runs = [_import_in_fresh_process("dingbot.server") for _ in range(3)]
+    assert all(r["heavy"] == [] for r in runs)
+    assert min(r["seconds"] for r in runs) < BUDGET_SECONDS
@@ -0,0 +1,113 @@
+import json
+
+import dingbot.agent as agent
+from dingbot import config, memory_file, summary_file, summarizer, retrieval
+
+
+def _use_tmp_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    # keep a summarizer started by another test from folding these messages in the background
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    monkeypatch.setattr(summary_file, "SUMMARY_FILE", str(tmp_path / "summary.json"))
+    retrieval.reset()
+
+
+def test_update_user_summary_folds_in_chunks(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    monkeypatch.setattr(config, "SUMMARY_MAX_FOLD", 4)
+    for i in range(10):
+        memory_file.append_user_message("u1", f"msg {i}", timestamp=100 + i)
+    memory_file.append_user_message("u2", "other user", timestamp=200)
+
+    calls = []
+
+    def fake_summarize(previous, messages):
+        calls.append((previous, [m["content"] for m in messages]))
+        return (previous + " " if previous else "") + "+".join(m["content"] for m in messages)
+
+    monkeypatch.setattr(agent, "summarize_conversation", fake_summarize)
+    rec = summarizer.update_user_summary("u1")
+
+    assert [len(c[1]) for c in calls] == [4, 4, 2]
+    assert rec["count"] == 10
+    assert rec["last_timestamp"] == 109
+    assert "msg 9" in rec["summary"] and "other user" not in rec["summary"]
+
+    # nothing new: no model call
+    calls.clear()
+    assert summarizer.update_user_summary("u1") is None
+    assert calls == []
+
+
+def test_failed_fold_keeps_previous_summary(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    summary_file.set_user_summary("u1", "old summary", 0)
+    memory_file.append_user_message("u1", "hello")
+    monkeypatch.setattr(agent, "summarize_conversation", lambda previous, messages: None)
+    assert summarizer.update_user_summary("u1") is None
+    assert summary_file.get_user_summary("u1")["summary"] == "old summary"
+
+
+def test_concurrent_fold_from_another_process_is_not_overwritten(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    for i in range(6):
+        memory_file.append_user_message("u1", f"msg {i}", timestamp=100 + i)
+    calls = []
+
+    def fake_summarize(previous, messages):
+        calls.append((previous, [m["content"] for m in messages]))
+        if len(calls) == 1:
+            # another worker folds the first four messages while our model call runs
+            summary_file.set_user_summary("u1", "other worker", 4, last_timestamp=103)
+        return (previous + " " if previous else "") + "+".join(m["content"] for m in messages)
+
+    monkeypatch.setattr(agent, "summarize_conversation", fake_summarize)
+    rec = summarizer.update_user_summary("u1")
+    # our first fold lost; we continued from the other worker's summary
+    assert calls[1] == ("other worker", ["msg 4", "msg 5"])
+    assert rec["count"] == 6 and rec["summary"] == "other worker msg 4+msg 5"
+
+
+def test_note_message_schedules_every_n(monkeypatch):
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 3)
+    submitted = []
+    monkeypatch.setattr(summarizer, "_submit", submitted.append)
+    monkeypatch.setattr(summarizer, "_new_counts", {})
+    for _ in range(7):
+        summarizer.note_message({"user_id": "u1", "content": "x"})
+    assert submitted == ["u1", "u1"]
+
+
+def test_prompts_use_summary_and_short_window(monkeypatch, tmp_path):
+    _use_tmp_files(monkeypatch, tmp_path)
+    monkeypatch.setattr(config, "SUMMARY_RECENT_WINDOW", 2)
+    for i in range(30):
+        memory_file.append_user_message("u1", f"message number {i}", timestamp=i + 1)
+    summary_file.set_user_summary("u1", "用户喜欢猫，住在北京", 28)
+
+    prompts = []
+
+    def fake_call(prompt, timeout=8):
+        prompts.append(prompt)
+        return json.dumps([{"fact": "喜欢猫"}])
+
+    monkeypatch.setattr(agent, "_call_model", fake_call)
+    facts = agent.extract_facts_for_user("u1")
+    assert facts == [{"fact": "喜欢猫"}]
+    assert "用户喜欢猫，住在北京" in prompts[0]
+    assert "message number 29" in prompts[0]
+    assert "message number 27" not in prompts[0]
+
+    # messages newer than the summary are all seen, not just the recent window
+    prompts.clear()
+    summary_file.set_user_summary("u1", "用户喜欢猫，住在北京", 20)
+    agent.extract_facts_for_user("u1")
+    assert all(f"message number {i}\n" in prompts[0] + "\n" for i in range(20, 30))
+    assert "message number 19\n" not in prompts[0] + "\n"
+    # capped by max_messages
+    prompts.clear()
+    agent.extract_facts_for_user("u1", max_messages=4)
+    assert "message number 25\n" not in prompts[0] + "\n" and "message number 26" in prompts[0]
+
+    agent.analyze_and_reply("hi", "Tester", user_id="u1")
+    assert "用户喜欢猫，住在北京" in prompts[1]
@@ -0,0 +1,66 @@
+import io
+import json
+import logging
+import threading
+
+import dingbot.agent as agent
+import dingbot.server as server
+from dingbot import config, memory_file, tracing
+
+
+def _spans(caplog):
+    return [json.loads(r.getMessage()) for r in caplog.records if r.name == "dingbot.trace"]
+
+
+def test_webhook_trace_covers_agent_storage_and_sender(monkeypatch, tmp_path, caplog):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(config, "TRACE_LOG", True)
+    monkeypatch.setattr(agent, "_call_model", lambda prompt, timeout=8: json.dumps({"reply": "ok"}))
+    monkeypatch.setattr(server.sender, "DISABLE_NETWORK", "1")
+    monkeypatch.setattr(server.config, "ACCESS_TOKEN", "t")
+    monkeypatch.setattr(server.config, "SECRET", "s")
+    server.dedup_cache.clear()
+    caplog.set_level(logging.INFO, logger="dingbot.trace")
+
+    client = server.app.test_client()
+    payload = {"msgtype": "text", "msgId": "trace-1", "text": {"content": "hi"}, "senderNick": "T", "senderId": "t1"}
+    r = client.post("/webhook", json=payload)
+    assert r.status_code == 200
+    request_id = r.headers["X-Request-Id"]
+
+    spans = _spans(caplog)
+    assert {s["trace_id"] for s in spans} == {request_id}
+    names = {s["name"] for s in spans}
+    assert {"webhook", "memory_file.append", "agent.history_load", "agent.model_call"} <= names
+    root = next(s for s in spans if s["name"] == "webhook")
+    assert root["parent_id"] is None and root["attrs"]["http.status_code"] == 200
+    assert all(s["parent_id"] for s in spans if s["name"] != "webhook")
+
+
+def test_unsampled_trace_is_noop(monkeypatch, caplog):
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 0.0)
+    caplog.set_level(logging.INFO, logger="dingbot.trace")
+    with tracing.start_trace("root") as root:
+        assert root.trace_id
+        assert tracing.span("child") is tracing._NOOP
+    assert _spans(caplog) == []
+
+
+def test_otlp_export_to_collector_stand_in():
+    out = io.StringIO()
+    collector = tracing.make_collector(port=0, out=out)
+    t = threading.Thread(target=collector.serve_forever, daemon=True)
+    t.start()
+    try:
+        endpoint = "http://127.0.0.1:%d/v1/traces" % collector.server_address[1]
+        s = tracing.Span("op", "ab" * 16, None, True, {"user_id": "u1", "n": 3})
+        s.end_ns = s.start_ns + 1000
+        exporter = tracing.OTLPExporter.__new__(tracing.OTLPExporter)
+        exporter.endpoint, exporter.service_name, exporter.exported, exporter.dropped = endpoint, "test", 0, 0
+        assert exporter.export([s])
+    finally:
+        collector.shutdown()
+    received = json.loads(out.getvalue().splitlines()[0])
+    assert received["name"] == "op" and received["traceId"] == "ab" * 16
+    assert {"key": "n", "value": {"intValue": "3"}} in received["attributes"]
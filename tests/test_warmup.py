@@ -0,0 +1,144 @@
+import threading
+from types import SimpleNamespace
+
+from dingbot import agent, config, facts_file, loadgen, memory, memory_file, retrieval, sender
+import dingbot.server as server
+
+
+def _fake_genai(listed):
+    class FakeClient:
+        def __init__(self):
+            self.models = self
+
+        def list(self):
+            listed.append(1)
+            return [SimpleNamespace(name="models/gemini-3-pro-preview")]
+
+    return type("G", (), {"Client": FakeClient})
+
+
+def test_model_name_resolved_once_per_client(monkeypatch):
+    monkeypatch.setattr(agent, "GENAI_CLIENT_AVAILABLE", True)
+    monkeypatch.setattr(config, "GEMINI_API_KEY", "fake")
+    monkeypatch.setattr(config, "GEMINI_MODEL", "gemini-3")
+    listed = []
+    monkeypatch.setattr(agent, "genai", _fake_genai(listed))
+
+    assert agent.warmup() == {"model": "models/gemini-3-pro-preview"}
+    client = agent.get_client()
+    assert agent.resolve_model("gemini-3") == "models/gemini-3-pro-preview"
+    assert agent.get_client() is client and len(listed) == 1
+    # a reported missing model lists again
+    agent.resolve_model("gemini-3", refresh=True)
+    assert len(listed) == 2
+
+    # a different SDK module (or fake) gets a new client and a fresh lookup
+    monkeypatch.setattr(agent, "genai", _fake_genai(listed))
+    assert agent.get_client() is not client
+    agent.resolve_model("gemini-3")
+    assert len(listed) == 3
+
+
+def test_preload_builds_indexes_of_recent_users(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    retrieval.reset()
+    for i, uid in enumerate(["u1", "u2", "u3", "u1"]):
+        memory_file.append_user_message(uid, f"message {i} about coffee", timestamp=i)
+
+    assert retrieval.preload(2) == 2
+    assert set(retrieval._indexes) == {"u1", "u3"}
+    assert len(retrieval._indexes["u1"].docs) == 2
+    # already built indexes are kept, and queries still see later appends
+    assert retrieval.preload(2) == 0
+    memory_file.append_user_message("u1", "tea today", timestamp=10)
+    ctx = retrieval.build_context("u1", "tea", top_k=1, recent=0)
+    assert [m["content"] for m in ctx["messages"]] == ["tea today"]
+    retrieval.reset()
+
+
+def test_sender_warmup_signs_and_connects(monkeypatch):
+    fake = loadgen.make_fake_dingtalk(port=0)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    monkeypatch.setattr(config, "DINGTALK_API_BASE", f"http://127.0.0.1:{fake.server_address[1]}")
+    monkeypatch.setattr(config, "DINGTALK_ROBOTS", "")
+    monkeypatch.setattr(config, "ACCESS_TOKEN", "warm-token")
+    monkeypatch.setattr(config, "SECRET", "warm-secret")
+    monkeypatch.setattr(sender, "DISABLE_NETWORK", None)
+    try:
+        assert sender.warmup(timeout=2) == {"robots": 1, "connected": True}
+    finally:
+        fake.shutdown()
+    assert (config.DINGTALK_API_BASE, "warm-token", "warm-secret") in sender._signed_cache
+
+
+def test_health_reports_ready_only_after_warmup(monkeypatch, tmp_path):
+    release = threading.Event()
+
+    def slow_model_warmup():
+        release.wait(5)
+        return {"model": "models/fake"}
+
+    monkeypatch.setattr(config, "WARMUP_ENABLED", True)
+    monkeypatch.setattr(config, "WARMUP_TIMEOUT_SECONDS", 30)
+    monkeypatch.setattr(memory, "DB_PATH", str(tmp_path / "warm.db"))
+    monkeypatch.setattr(agent, "warmup", slow_model_warmup)
+    monkeypatch.setattr(sender, "warmup", lambda timeout=5: {"robots": 0, "connected": False})
+    monkeypatch.setattr(retrieval, "preload", lambda n: 0)
+    monkeypatch.setattr(server, "ready", threading.Event())
+    monkeypatch.setattr(server, "_warmup_started", None)
+    monkeypatch.setitem(server.startup, "warmup", None)
+    client = server.app.test_client()
+
+    server.init_app(start_scheduler=False, start_summarizer=False)
+    r = client.get("/")
+    assert r.status_code == 503 and r.get_json()["status"] == "warming_up"
+
+    release.set()
+    assert server.ready.wait(5)
+    r = client.get("/")
+    assert r.status_code == 200 and r.get_json()["status"] == "ok"
+    warmup = client.get("/stats").get_json()["startup"]["warmup"]
+    assert warmup["model"]["model"] == "models/fake"
+    assert set(warmup) == {"model", "dingtalk", "history", "seconds"}
+
+
+def test_health_gives_up_waiting_after_timeout(monkeypatch):
+    monkeypatch.setattr(config, "WARMUP_TIMEOUT_SECONDS", 0)
+    monkeypatch.setattr(server, "ready", threading.Event())
+    monkeypatch.setattr(server, "_warmup_started", 0.0)
+    assert server.app.test_client().get("/").status_code == 200
+
+
+def test_preload_scans_without_holding_the_lock(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    monkeypatch.setattr(facts_file, "FACTS_FILE", str(tmp_path / "facts.json"))
+    monkeypatch.setattr(config, "SUMMARY_EVERY_N", 0)
+    retrieval.reset()
+    memory_file.append_user_message("u1", "tea with lemon", timestamp=1)
+    memory_file.append_user_message("u2", "coffee beans", timestamp=2)
+    retrieval.build_context("u1", "tea")
+
+    scanning, release = threading.Event(), threading.Event()
+    real_scan = retrieval._scan
+
+    def slow_scan(path, start, end, indexes):
+        if start == 0 and "u2" in indexes:
+            scanning.set()
+            release.wait(5)
+        real_scan(path, start, end, indexes)
+
+    monkeypatch.setattr(retrieval, "_scan", slow_scan)
+    result = []
+    t = threading.Thread(target=lambda: result.append(retrieval.preload(5)))
+    t.start()
+    assert scanning.wait(5)
+    # queries go on during the preload scan, and its appends reach the preloaded index
+    memory_file.append_user_message("u2", "more coffee please", timestamp=3)
+    assert retrieval.build_context("u1", "tea", recent=0)["messages"][0]["content"] == "tea with lemon"
+    release.set()
+    t.join(5)
+    assert result == [1]
+    assert [d["content"] for d in retrieval._indexes["u2"].docs] == ["coffee beans", "more coffee please"]
+    retrieval.reset()
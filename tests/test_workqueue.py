@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+import dingbot.server as server
+from dingbot import memory_file
+from dingbot.workqueue import KeyedWorkQueue, QueueFull
+
+
+def test_per_key_ordering_is_preserved():
+    q = KeyedWorkQueue(workers=4, max_depth=1000, name="test").start()
+    seen = {}
+    lock = threading.Lock()
+
+    def job(key, i):
+        time.sleep(0.001 * (i % 3))
+        with lock:
+            seen.setdefault(key, []).append(i)
+
+    for i in range(30):
+        for key in ("a", "b", "c"):
+            q.submit(key, job, key, i)
+    assert q.join(timeout=10)
+    q.stop()
+    for key in ("a", "b", "c"):
+        assert seen[key] == list(range(30))
+
+
+def test_queue_depth_limit():
+    q = KeyedWorkQueue(workers=1, max_depth=2, name="test").start()
+    gate = threading.Event()
+    q.submit("a", gate.wait)
+    q.submit("a", lambda: None)
+    with pytest.raises(QueueFull):
+        q.submit("b", lambda: None)
+    assert q.stats()["rejected"] == 1
+    gate.set()
+    assert q.join(timeout=5)
+    q.stop()
+
+
+def test_async_webhook_acks_then_replies_in_background(monkeypatch, tmp_path):
+    monkeypatch.setattr(memory_file, "MEMORY_FILE", str(tmp_path / "mem.jsonl"))
+    q = KeyedWorkQueue(workers=2, max_depth=10, name="test").start()
+    monkeypatch.setattr(server, "work_queue", q)
+
+    release = threading.Event()
+
+    def slow_agent(content, sender_name, user_id=None):
+        release.wait(5)
+        return {"reply": f"Echo: {content}"}
+
+    sent = []
+    monkeypatch.setattr(server.agent, "analyze_and_reply", slow_agent)
+    monkeypatch.setattr(server.sender, "send_text_from_env", lambda msg, at_user_ids=None: sent.append((msg, at_user_ids)))
+
+    client = server.app.test_client()
+    payload = {"msgtype": "text", "text": {"content": "hello"}, "senderNick": "Bob", "senderId": "bobid"}
+    r = client.post("/webhook", json=payload)
+    assert r.status_code == 200
+    assert r.get_json()["errmsg"] == "queued"
+    assert sent == []
+
+    release.set()
+    assert q.join(timeout=5)
+    q.stop()
+    assert sent == [("Echo: hello", ["bobid"])]